@@ -1,12 +1,18 @@
+import copy
 import json
+import time
+import uuid
+from collections import OrderedDict
 from logging import DEBUG
 from logging import Logger
+from threading import Lock
+from types import MethodType
+from typing import TYPE_CHECKING
 
-from transitions import EventData
-from transitions import Machine
-
+from .clients import Backoff
 from .clients import Clients
 from .entity import CommandRepository
+from .entity import ContinuationRepository
 from .entity import Node
 from .entity import NodeRepository
 from .entity import Repositories
@@ -16,10 +22,20 @@ from .exceptions import ConfigurationError
 from .exceptions import EventNotSupportedError
 from .exceptions import StopIterationAfterTrigger
 from .exceptions import StopProcessingAfterStateChange
+from .exceptions import SuspendProcessing
 from .exceptions import TriggerParameterConfigurationError
+from .exceptions import WaitTimeoutError
+from .ledger import CallLedger
 from .logging import Formatter
+from .logging import Lazy
 from .logging import Logging
 from .logging import MessageFormatter
+from .notifications import NotificationQueue
+
+if TYPE_CHECKING:
+    # transitions is imported when the first transition table is compiled
+    from transitions import EventData
+    from transitions import Machine
 
 
 def listify(obj):
@@ -116,6 +132,8 @@ class Event(object):
     name = None
     _event = None
     _lifecycle_data = None
+    _command_results = None
+    _command_error_limit = 0
 
     has_failure = False
 
@@ -214,6 +232,46 @@ class Event(object):
         return self._ABANDON
 
 
+    def set_command_results(self, results: dict, error_limit: int = 0):
+        """
+        :type results: dict
+        :param results: The status of the command by target instance
+        :type error_limit: int
+        :param error_limit: The number of failed targets tolerated
+        """
+        self._command_results = results
+        self._command_error_limit = error_limit
+
+
+    def get_command_results(self) -> dict:
+        """
+        :rtype: dict
+        :return: The status of the command by target instance. Contains only the target of this event, if results
+                 are not tracked for the command.
+        """
+        if self._command_results is None:
+            return { self.get_resources()[0]: self.get_detail().get('status') }
+
+        return self._command_results
+
+
+    def get_command_error_limit(self) -> int:
+        return self._command_error_limit
+
+
+    def to_json(self) -> str:
+        """
+        :rtype: str
+        :return: The raw event as json, as it has been received
+        """
+        event = self._event
+        if self.is_command():
+            event = copy.deepcopy(event)
+            event.get('detail').update({ 'parameters': json.dumps(event.get('detail').get('parameters')) })
+
+        return json.dumps(event)
+
+
     def to_str(self):
         msg = self.get_name()
 
@@ -245,6 +303,10 @@ class Event(object):
               but not used
         """
         if self.is_command():
+            if self._command_results is not None:
+                failed = [target for target, status in self._command_results.items() if status != 'Success']
+                return not self.has_failure and len(failed) <= self._command_error_limit
+
             return not self.has_failure and self._event.get('detail').get('status') == 'Success'
 
         return not self.has_failure
@@ -274,6 +336,52 @@ class Model(object):
     :type event: Event
     :param node:
     :type node: Node
+    :param write_behind: Keep changes of the node in memory and persist them with a single update at the next flush.
+                         Changes are flushed after processing has stopped (also on errors), when entering failure
+                         handling, before sending commands and whenever flush() is called. Otherwise every change
+                         is written immediately.
+    :type write_behind: bool
+    :param cloud_init_backoff: The backoff to poll the node with while waiting for cloud init to finish
+    :type cloud_init_backoff: Backoff
+    :param digest_notifications: Collect reports in the background and publish them as a single digest when
+                                 processing has finished. Otherwise every report is published immediately, which
+                                 is the default.
+    :type digest_notifications: bool
+    :param notification_queue_size: The maximum number of reports waiting to be added to the digest
+    :type notification_queue_size: int
+    :param ledger: Records the aws calls of the current invocation
+    :type ledger: CallLedger
+    :param call_metrics: Emit the aws calls of an invocation per trigger in embedded metric format when processing
+                         has finished. Disabled by default.
+    :type call_metrics: bool
+    :param metrics_namespace: The CloudWatch namespace of the call metrics
+    :type metrics_namespace: str
+    :param suspend_waits: Instead of blocking until the invocation times out, persist a continuation of a wait
+                          shortly before the end of the invocation and exit. Requires the remaining time of the
+                          invocation to be passed to initialize() and a continuation repository.
+    :type suspend_waits: bool
+    :param suspend_margin: The seconds reserved at the end of an invocation to persist a continuation
+    :type suspend_margin: float
+    :param activity_backoff: The backoff to poll a scaling activity with, if waits can be suspended
+    :type activity_backoff: Backoff
+    :param snapshot_backoff: The backoff to poll a snapshot with, if waits can be suspended
+    :type snapshot_backoff: Backoff
+    :param deadline: The time.monotonic() value waits are suspended at or None
+    :type deadline: float
+    :param continuation: The continuation the model has been resumed from
+    :type continuation: dict
+    :param suspended: Whether a wait has been suspended in this invocation
+    :type suspended: bool
+    :param trigger: The trigger currently pulled
+    :type trigger: str
+    :param trigger_state: The state the current trigger has been pulled in
+    :type trigger_state: str
+    :param waits_for_event: Whether the destination state of the current trigger waits for the next event
+    :type waits_for_event: bool
+    :param next_event: The event to continue with instead of waiting for the next one, e.g. the status event of a
+                       command that has completed synchronously. The handler continues with it when a state that
+                       waits for the next event is entered, or once processing has stopped.
+    :type next_event: Event
     """
     logger = None
     formatter = None
@@ -287,10 +395,34 @@ class Model(object):
     _state = None
     allow_state_updates = False
     passed_states = []
+    write_behind = False
+    cloud_init_backoff = Backoff(delay = 2, max_delay = 15, timeout = 600)
+    digest_notifications = False
+    notification_queue_size = 100
+    _notifications = None
+    ledger = None
+    call_metrics = False
+    metrics_namespace = 'AutoscalingLifecycle'
+    suspend_waits = False
+    suspend_margin = 10
+    activity_backoff = Backoff(delay = 5, max_delay = 20, timeout = 120)
+    snapshot_backoff = Backoff(delay = 15, max_delay = 15, timeout = 600)
+    deadline = None
+    continuation = None
+    suspended = False
+    trigger = None
+    trigger_state = None
+    waits_for_event = False
+    next_event = None
 
     EVENT = 'event'
     NODE = 'node'
     COMMAND = 'command'
+    CONTINUATION = 'continuation'
+
+    WAIT_CLOUD_INIT = 'cloud_init'
+    WAIT_ACTIVITY = 'activity'
+    WAIT_SNAPSHOT = 'snapshot'
 
 
     def __init__(self, clients: Clients, repositories: Repositories, logging: Logging, environment: str, account: str):
@@ -300,6 +432,7 @@ class Model(object):
         self.formatter = logging.get_formatter()
         self.environment = environment
         self.account = account
+        self.ledger = CallLedger()
         self.node = None
         self.state = None
 
@@ -335,20 +468,59 @@ class Model(object):
     def node(self, node: Node):
         if node is not None:
             self._node = node
+            self._node.set_write_behind(self.write_behind)
             if self.node.is_new():
                 self._wait_for_cloud_init()
 
 
-    def initialize(self, event: Event):
+    def initialize(self, event: Event, remaining_time: int = None, continuation: dict = None):
+        """
+        :type event: Event
+        :param event: The event to process
+        :type remaining_time: int
+        :param remaining_time: The remaining time of the invocation in milliseconds, e.g.
+                               context.get_remaining_time_in_millis()
+        :type continuation: dict
+        :param continuation: The continuation to resume, see resume()
+        """
+        # clients are reused across invocations, drop what they cached for the previous one
+        self.clients.reset()
+        self.ledger = CallLedger().activate()
+        self._notifications = None
+        self.suspended = False
+        self.trigger = None
+        self.trigger_state = None
+        self.waits_for_event = False
+        self.next_event = None
+        self.continuation = continuation
+        self.deadline = None
+        if remaining_time is not None:
+            self.deadline = time.monotonic() + remaining_time / 1000 - self.suspend_margin
+        # custom waits end at the deadline, like the waits that can be suspended
+        self.clients.set_deadline(self.deadline)
         self.event = event
-        if self.event.is_command():
+        # the command of a resumed event has been popped when the event was received
+        if self.event.is_command() and self.continuation is None:
+            command_id = self.event.get_detail().get('command-id')
             try:
-                command = self.get_command_repository().pop(self.event.get_raw().get('detail').get('command-id'))
+                command = self.get_command_repository().complete(
+                    command_id,
+                    self.event.get_resources()[0],
+                    self.event.get_detail().get('status')
+                )
             except CommandNotFoundError:
                 raise EventNotSupportedError('This event does not support this event.')
 
+            if command is None:
+                raise EventNotSupportedError('Command %s has not completed on all targets yet.' % command_id)
+
             self.event.set_lifecycle_data(command.get('LifecycleData', dict()))
             self.event.set_name(command.get('EventName', ''))
+            if command.get('Results', None) is not None:
+                self.event.set_command_results(
+                    command.get('Results'),
+                    CommandRepository.get_error_limit(command)
+                )
 
         if self.event.is_lifecycle():
             self.node = self.get_node_repository().get(self.event.get_lifecycle_data().get_instance_id())
@@ -364,43 +536,249 @@ class Model(object):
         self.passed_states = []
 
 
+    def resume(self, continuation: dict, remaining_time: int = None) -> bool:
+        """
+        Initialize the model from a continuation and wait for its condition again. Once the condition is met, the
+        continuation is removed and the handler can process the model from the state the wait was suspended in.
+        The trigger is pulled again, built-in trigger functions skip what they did before suspending.
+
+        :type continuation: dict
+        :param continuation: A continuation as returned by ContinuationRepository.get_all()
+        :type remaining_time: int
+        :param remaining_time: The remaining time of the invocation in milliseconds
+
+        :rtype: bool
+        :return: Whether the handler has to process the model: the condition is met or the wait has expired, in
+                 which case the trigger raises the WaitTimeoutError. Otherwise the wait has been suspended again.
+        :raises WaitTimeoutError: If a suspended wait for cloud init has expired
+        """
+        event = Event(json.loads(continuation.get('Event')))
+        event.set_name(continuation.get('EventName', ''))
+        if continuation.get('LifecycleData', None) is not None:
+            event.set_lifecycle_data(json.loads(continuation.get('LifecycleData')))
+        if continuation.get('CommandResults', None) is not None:
+            event.set_command_results(
+                json.loads(continuation.get('CommandResults')),
+                int(continuation.get('CommandErrorLimit', '0'))
+            )
+
+        self.logger.info('Resuming wait %s of %s', continuation.get('Wait'), continuation.get('Ident'))
+        # a suspended cloud init wait is resumed when the node is loaded
+        try:
+            self.initialize(event, remaining_time, continuation)
+        except WaitTimeoutError:
+            # fail like a cloud init wait that has not been suspended
+            self.get_continuation_repository().delete(ContinuationRepository.get_id(continuation))
+            raise
+        if self.suspended:
+            return False
+
+        if continuation.get('Wait') == self.WAIT_CLOUD_INIT:
+            self.continuation = None
+        else:
+            self._state = continuation.get('State', self._state)
+            try:
+                self._wait(continuation.get('Wait'), json.loads(continuation.get('Arguments')))
+            except SuspendProcessing as e:
+                self.logger.info(e.get_message())
+                return False
+            except WaitTimeoutError as e:
+                # the trigger raises the error when it picks up the wait and enters failure handling
+                self.logger.warning('Wait %s of %s has expired.', continuation.get('Wait'), continuation.get('Ident'))
+                self.continuation = dict(self.continuation, Error = e.get_message())
+
+        self.get_continuation_repository().delete(self.__get_continuation_id())
+
+        return True
+
+
     def _wait_for_cloud_init(self):
         if self.node.get_state() != 'finished_cloud_init':
-            self.logger.debug("Waiting for node to be registered and cloud init to finish ...")
-            self.clients.get('dynamodb').wait_for_scan_count_is(
-                1,
-                'Ident = :id and ItemStatus = :status',
-                {
-                    ":id": self.node.get_id(),
-                    ":status": 'finished_cloud_init'
-                }
-            )
+            if self.suspend_waits:
+                try:
+                    self._wait(self.WAIT_CLOUD_INIT, { })
+                except SuspendProcessing as e:
+                    # the node is processed when the wait is resumed
+                    self.logger.info(e.get_message())
+                    return
+            else:
+                self.logger.debug("Waiting for node to be registered and cloud init to finish ...")
+                self.clients.get('dynamodb').wait_for_item(
+                    self.node.get_id(),
+                    lambda item: item.get('ItemStatus') == 'finished_cloud_init',
+                    self.cloud_init_backoff
+                )
 
         # fetch the node again to pick up all data probably set by cloud init
         # !! use self._node here to ensure this method is not called again
         self._node = self.repositories.get('node').get(self.node.get_id())
+        self._node.set_write_behind(self.write_behind)
+
+
+    def _get_wait_condition(self, name: str) -> tuple:
+        """
+        Override to add waits that can be suspended.
+
+        :type name: str
+        :param name: The name of the wait
+
+        :rtype: tuple
+        :return: A callable that receives the arguments of the wait and returns whether the condition is met, and
+                 the backoff to poll it with
+        """
+        if name == self.WAIT_CLOUD_INIT:
+            return lambda arguments: self.clients.get('dynamodb').get_item(self.node.get_id(), True).get(
+                'ItemStatus') == 'finished_cloud_init', self.cloud_init_backoff
+
+        if name == self.WAIT_ACTIVITY:
+            return lambda arguments: self.clients.get('autoscaling').is_activity_complete(
+                arguments.get('AutoScalingGroupName'),
+                arguments.get('IsLaunching') == 'true',
+                arguments.get('InstanceId')
+            ), self.activity_backoff
+
+        if name == self.WAIT_SNAPSHOT:
+            return lambda arguments: self.clients.get('ec2').is_snapshot_completed(
+                arguments.get('SnapshotId')
+            ), self.snapshot_backoff
+
+        raise self.formatter.get_error(ConfigurationError, 'Unknown wait %s', name)
+
+
+    def _wait(self, name: str, arguments: dict):
+        """
+        Poll the condition of a wait until it is met. If waits can be suspended and the invocation ends before,
+        a continuation is persisted. The timeout of the backoff applies to the wait as a whole, across suspensions.
+
+        A resumed model pulls the trigger again from the state it has been suspended in. Waits in callbacks that
+        run after the state has changed, e.g. after callbacks, are therefore not suspended.
+
+        :type name: str
+        :param name: The name of the wait, see _get_wait_condition()
+        :type arguments: dict
+        :param arguments: str values the condition depends on
+
+        :raises SuspendProcessing: If the wait has been suspended
+        :raises WaitTimeoutError: If the condition is not met before the backoff times out
+        """
+        condition, backoff = self._get_wait_condition(name)
+        if self.continuation is not None and self.continuation.get('Wait') == name:
+            expires = float(self.continuation.get('Expires'))
+        else:
+            expires = time.time() + backoff.timeout
+
+        can_suspend = self.suspend_waits
+        if can_suspend and self.trigger is not None and self._state != self.trigger_state:
+            self.logger.warning(
+                'Wait %s cannot be suspended, trigger %s has changed the state to %s already.',
+                name,
+                self.trigger,
+                self._state
+            )
+            can_suspend = False
+
+        deadline = time.monotonic() + expires - time.time()
+        if can_suspend and self.deadline is not None:
+            deadline = min(deadline, self.deadline)
+
+        self.logger.debug('Waiting for %s with %s', name, arguments)
+        try:
+            backoff.wait(lambda: condition(arguments), lambda is_met: is_met, name, deadline)
+        except WaitTimeoutError:
+            if time.time() >= expires or not can_suspend:
+                raise
+
+            self._suspend(name, arguments, expires)
+            raise SuspendProcessing('Suspended wait %s of %s until the next event.' % (
+                name,
+                self.__get_continuation_id()
+            ))
+
+
+    def _suspend(self, name: str, arguments: dict, expires: float):
+        """
+        Persist the node and a continuation of a wait.
+        """
+        self.flush()
+        continuation = {
+            'Wait': name,
+            'Arguments': json.dumps(arguments),
+            'Expires': str(expires),
+            'Event': self.event.to_json(),
+            'EventName': self.event.get_name()
+        }
+        if self.node is not None:
+            continuation.update({ 'NodeId': self.node.get_id() })
+        if self._state is not None and name != self.WAIT_CLOUD_INIT:
+            continuation.update({ 'State': self._state })
+        if self.trigger is not None:
+            continuation.update({ 'Trigger': self.trigger })
+        if self.event.is_lifecycle():
+            continuation.update({ 'LifecycleData': json.dumps(self.event.get_lifecycle_data().to_dict()) })
+        if self.event.is_command():
+            continuation.update({
+                'CommandResults': json.dumps(self.event.get_command_results()),
+                'CommandErrorLimit': str(self.event.get_command_error_limit())
+            })
+
+        self.get_continuation_repository().register(self.__get_continuation_id(), continuation)
+        self.suspended = True
+
+
+    def _pop_resumed_arguments(self, name: str):
+        """
+        :type name: str
+        :param name: The name of a wait
+
+        :rtype: dict
+        :return: The arguments of the wait, if the model has been resumed from it, otherwise None
+        :raises WaitTimeoutError: If the wait has expired while it was suspended
+        """
+        if self.continuation is None or self.continuation.get('Wait') != name:
+            return None
+
+        continuation = self.continuation
+        self.continuation = None
+        if continuation.get('Error', None) is not None:
+            raise WaitTimeoutError(continuation.get('Error'))
+
+        return json.loads(continuation.get('Arguments'))
+
+
+    def __get_continuation_id(self) -> str:
+        if self.node is not None:
+            return self.node.get_id()
+
+        return self.event.get_name()
 
 
     def get_transitions(self):
         raise NotImplementedError()
 
 
-    def report(self, direction, event_data: EventData, force_report_autoscaling_activity: bool = False):
+    def flush(self):
+        """
+        Persist pending changes of the node. This is a no-op, if write_behind is disabled.
+        """
+        if self.node is not None:
+            self.get_node_repository().flush(self.node)
+
+
+    def report(self, direction, event_data: 'EventData', force_report_autoscaling_activity: bool = False):
         status = 'INFO' if self.event.is_successful() else "ERROR"
-        if self.logger.level == DEBUG or status == 'ERROR':
-            self.logger.debug('Reporting activity: %s', repr(event_data))
+        if self.logger.isEnabledFor(DEBUG) or status == 'ERROR':
+            self.logger.debug('Reporting activity: %s', Lazy(repr, event_data))
             subject = '%s from %s to %s via %s' % (
                 direction,
                 event_data.transition.source,
                 event_data.transition.dest,
                 event_data.event.name
             )
-            self.clients.get('sns').publish_activity(
-                status,
-                subject,
-                self.event.to_str() + ' : ' + repr(event_data),
-                'eu-west-1'
-            )
+            detail = self.event.to_str() + ' : ' + repr(event_data)
+            if self.digest_notifications:
+                self._get_notifications().put_report(status, subject, detail)
+            else:
+                self.clients.get('sns').publish_activity(status, subject, detail, 'eu-west-1')
 
         if self.event.is_lifecycle() and (force_report_autoscaling_activity or self.event.is_autoscaling()):
             activity = self.clients.get('autoscaling').get_activity(
@@ -409,10 +787,69 @@ class Model(object):
                 self.node.get_id()
             )
             self.logger.debug('Reporting activity: %s', activity)
-            self.clients.get('sns').publish_autoscaling_activity(activity, 'eu-west-1')
+            if self.digest_notifications:
+                self._get_notifications().put_activity(activity)
+            else:
+                self.clients.get('sns').publish_autoscaling_activity(activity, 'eu-west-1')
+
+
+    def flush_notifications(self):
+        """
+        Publish the digest of collected reports. This is a no-op, if nothing has been reported.
+        """
+        if self._notifications is not None:
+            self._notifications.flush(self.event.to_str())
+
+
+    def emit_call_metrics(self):
+        """
+        Log the aws calls of this invocation per trigger and write them as embedded metric format documents.
+        """
+        if not self.call_metrics:
+            return
+
+        self.logger.debug('aws calls by trigger: %s', Lazy(lambda: [
+            { 'trigger': trigger, 'operations': { '.'.join(key): metrics for key, metrics in operations.items() } }
+            for trigger, operations in self.ledger.summarize().items()
+        ]))
+        self.ledger.emit(self.metrics_namespace, {
+            'Event': self.event.get_name() if self.event is not None else None,
+            'Environment': self.environment
+        })
+
+
+    def _get_notifications(self) -> NotificationQueue:
+        if self._notifications is None:
+            self._notifications = NotificationQueue(
+                self.clients.get('sns'),
+                self.logger,
+                self.notification_queue_size,
+                'eu-west-1'
+            )
 
+        return self._notifications
 
-    def _send_command(self, comment: str, commands: list, target_nodes = None, command_timeout = 60):
+
+    def _send_command(self, comment: str, commands: list, target_nodes = None, command_timeout = 60,
+                      max_concurrency: str = None, max_errors: str = None, sync_timeout: float = None):
+        """
+        Send a command to the target nodes. Nodes are dispatched as soon as their ssm agent is online, in chunks of
+        SsmClient.chunk_size. The chunks are registered as a group of all target nodes before the first one is
+        sent, so the status events complete the group once and max_errors applies to all target nodes. Nodes whose
+        agents are not online are recorded as undeliverable in the group. If that completes the group, the handler
+        continues with its result in this invocation.
+
+        :type max_concurrency: str
+        :param max_concurrency: The number or percentage of nodes a command runs on concurrently
+        :type max_errors: str
+        :param max_errors: The number or percentage of nodes that may fail
+        :type sync_timeout: float
+        :param sync_timeout: Poll a single command for up to this many seconds, if the destination state of the
+                             trigger waits for the next event. If it completes in time, the handler continues with its
+                             result in this invocation. Longer running commands complete through their status
+                             events.
+        :raises RuntimeError: If an event completed in this invocation has not been processed yet
+        """
         if target_nodes is not None:
             target_nodes = listify(target_nodes)
         else:
@@ -423,17 +860,132 @@ class Model(object):
             target_node_ids.append(node.get_id())
 
         metadata = {
-            'RunningOn': ', '.join(target_node_ids),
             'Comment': comment,
             'Commands': ', '.join(commands),
-            'EventName': self.event.get_name()
+            'EventName': self.event.get_name(),
+            'RunningOn': ', '.join(target_node_ids)
         }
+        if max_errors is not None:
+            metadata.update({ 'MaxErrors': str(max_errors) })
 
         if self.event.is_lifecycle():
             metadata.update({ 'LifecycleData': self.event.get_lifecycle_data().to_dict() })
 
-        command_id = self.clients.get('ssm').send_command(target_node_ids, comment, commands, command_timeout)
-        self.repositories.get('command').register(command_id, metadata)
+        group_id = str(uuid.uuid4())
+        self.get_command_repository().register_group(group_id, metadata)
+        dispatched = []
+
+
+        def register(command_id: str, instance_ids: list):
+            self.get_command_repository().add_to_group(group_id, command_id, instance_ids)
+            dispatched.append((command_id, instance_ids))
+
+
+        completed = []
+
+
+        def fail(instance_ids: list):
+            # no status event will arrive for these nodes
+            for instance_id in instance_ids:
+                command = self.get_command_repository().complete(group_id, instance_id, CommandRepository.UNDELIVERABLE)
+                if command is not None:
+                    completed.append(command)
+
+
+        # the command status event will load the node again
+        self.flush()
+        self.clients.get('ssm').dispatch_command(
+            target_node_ids,
+            comment,
+            commands,
+            command_timeout,
+            max_concurrency,
+            max_errors,
+            on_dispatch = register,
+            on_failure = fail,
+            deadline = self.deadline
+        )
+
+        if len(completed) > 0:
+            # all other nodes have reported before
+            self.__set_next_event(self.__get_command_event(group_id, completed[0], target_node_ids, commands))
+        elif sync_timeout is not None and len(dispatched) == 1 and self.waits_for_event:
+            self.__set_next_event(
+                self.__wait_for_command(dispatched[0][0], dispatched[0][1], commands, sync_timeout)
+            )
+
+
+    def __set_next_event(self, event: Event = None):
+        if event is None:
+            return
+
+        if self.next_event is not None:
+            # the command has been deleted, its status events will not be processed
+            raise RuntimeError('Event %s of command %s has not been processed yet.' % (
+                self.next_event.get_name(),
+                self.next_event.get_detail().get('command-id')
+            ))
+
+        self.next_event = event
+
+
+    def __wait_for_command(self, command_id: str, instance_ids: list, commands: list, timeout: float):
+        """
+        :rtype: Event
+        :return: The status event of the command, if it has completed in time and in this invocation. Otherwise
+                 None.
+        """
+        deadline = time.monotonic() + timeout
+        if self.deadline is not None:
+            deadline = min(deadline, self.deadline)
+
+        results = self.clients.get('ssm').wait_for_command(command_id, instance_ids, deadline)
+        if results is None:
+            return None
+
+        command = None
+        for instance_id in instance_ids:
+            try:
+                command = self.get_command_repository().complete(
+                    command_id,
+                    instance_id,
+                    results.get(instance_id)
+                ) or command
+            except CommandNotFoundError:
+                # the status event of this target has recorded its result before, or a result recorded here has
+                # completed the command already
+                self.logger.debug('Result of %s for command %s has been recorded before.', instance_id, command_id)
+
+        if command is None:
+            self.logger.info('Command %s is completed by its status events.', command_id)
+            return None
+
+        self.logger.info('Command %s completed in %s.', command_id, results)
+
+        return self.__get_command_event(command_id, command, instance_ids, commands)
+
+
+    def __get_command_event(self, command_id: str, command: dict, instance_ids: list, commands: list) -> Event:
+        """
+        :rtype: Event
+        :return: A status event of a completed command, like the one of the target reporting last
+        """
+        is_successful = all([status == 'Success' for status in command.get('Results').values()])
+        event = Event({
+            'source': 'aws.ssm',
+            'detail-type': 'EC2 Command Status-change Notification',
+            'resources': ['arn:aws:ec2:::instance/' + instance_id for instance_id in instance_ids],
+            'detail': {
+                'command-id': command_id,
+                'status': 'Success' if is_successful else 'Failed',
+                'parameters': json.dumps({ 'commands': commands })
+            }
+        })
+        event.set_lifecycle_data(command.get('LifecycleData', dict()))
+        event.set_name(command.get('EventName', ''))
+        event.set_command_results(command.get('Results'), CommandRepository.get_error_limit(command))
+
+        return event
 
 
     #
@@ -448,28 +1000,75 @@ class Model(object):
         return self.repositories.get(self.COMMAND)
 
 
+    def get_continuation_repository(self) -> ContinuationRepository:
+        return self.repositories.get(self.CONTINUATION)
+
+
+    def create_snapshot(self, description: str, volume_id: str, tags: list) -> str:
+        """
+        Create a snapshot and wait for it to complete. The wait can be suspended.
+
+        :rtype: str
+        :return: The snapshot id
+        """
+        arguments = self._pop_resumed_arguments(self.WAIT_SNAPSHOT)
+        if arguments is not None:
+            return arguments.get('SnapshotId')
+
+        if not self.suspend_waits:
+            return self.clients.get('ec2').create_snapshot(description, volume_id, tags)
+
+        arguments = { 'SnapshotId': self.clients.get('ec2').create_snapshot(description, volume_id, tags, False) }
+        self._wait(self.WAIT_SNAPSHOT, arguments)
+
+        return arguments.get('SnapshotId')
+
+
     #
     # built-in trigger functions
     #
 
-    def do_complete_lifecycle_action(self, event_data: EventData):
-        self.logger.info('completing autoscaling action for node %s', self.node.to_dict())
-        self.clients.get('autoscaling').complete_lifecycle_action(
-            self.event.get_lifecycle_data().get_lifecycle_hook_name(),
-            self.event.get_lifecycle_data().get_autoscaling_group_name(),
-            self.event.get_lifecycle_data().get_lifecycle_action_token(),
-            self.event.get_lifecycle_result(),
-            self.node.get_id()
-        )
+    def do_complete_lifecycle_action(self, event_data: 'EventData'):
+        # the action has been completed before the wait for the activity was suspended
+        try:
+            is_resumed = self._pop_resumed_arguments(self.WAIT_ACTIVITY) is not None
+        except WaitTimeoutError as e:
+            self.logger.exception('Error while waiting for autoscaling activity to complete: %s', repr(e))
+            is_resumed = True
+
+        if not is_resumed:
+            self.logger.info('completing autoscaling action for node %s', self.node.to_dict())
+            self.clients.get('autoscaling').complete_lifecycle_action(
+                self.event.get_lifecycle_data().get_lifecycle_hook_name(),
+                self.event.get_lifecycle_data().get_autoscaling_group_name(),
+                self.event.get_lifecycle_data().get_lifecycle_action_token(),
+                self.event.get_lifecycle_result(),
+                self.node.get_id()
+            )
+
+            if self.event.get_lifecycle_data().is_launching():
+                self.__wait_for_activity_to_complete()
 
-        if self.event.get_lifecycle_data().is_launching():
+        self.report('Finished', event_data, True)
+
+
+    def __wait_for_activity_to_complete(self):
+        if not self.suspend_waits:
             self.clients.get('autoscaling').wait_for_activity_to_complete(
                 self.event.get_lifecycle_data().get_autoscaling_group_name(),
                 self.event.get_lifecycle_data().is_launching(),
                 self.node.get_id()
             )
+            return
 
-        self.report('Finished', event_data, True)
+        try:
+            self._wait(self.WAIT_ACTIVITY, {
+                'AutoScalingGroupName': self.event.get_lifecycle_data().get_autoscaling_group_name(),
+                'IsLaunching': 'true' if self.event.get_lifecycle_data().is_launching() else 'false',
+                'InstanceId': self.node.get_id()
+            })
+        except WaitTimeoutError as e:
+            self.logger.exception('Error while waiting for autoscaling activity to complete: %s', repr(e))
 
 
     def do_remove_from_db(self, *args):
@@ -477,16 +1076,164 @@ class Model(object):
         self.repositories.get('node').delete(self.node)
 
 
+class TransitionTable(object):
+    """
+    A compiled, immutable set of states and transitions.
+
+    Callbacks bound to the model are stored by name and resolved by the machine against the model an event is
+    triggered on. A table can therefore serve every instance of a model class and is cached per process, keyed
+    by the handler class, the model class and a fingerprint of the transition config. Configs containing
+    callbacks that are not bound to the model (e.g. methods of the event) cannot be shared and are compiled
+    for a single handler.
+
+    :type machine: Machine
+    :param machine: A machine without models, holding the compiled states and transitions
+    :type ignore_errors: frozenset
+    :param ignore_errors: (trigger, source state) tuples of triggers configured with ignore_errors
+    :type is_shared: bool
+    :param is_shared: Whether the table is cached and shared between handlers
+    :type wait_states: frozenset
+    :param wait_states: States configured with stop_after_state_change, which wait for the next event
+    """
+
+    max_size = 32
+    __tables = OrderedDict()
+    __lock = Lock()
+
+
+    def __init__(self, machine: 'Machine', ignore_errors: frozenset, is_shared: bool = False,
+                 wait_states: frozenset = frozenset()):
+        self.machine = machine
+        self.ignore_errors = ignore_errors
+        self.is_shared = is_shared
+        self.wait_states = wait_states
+
+
+    def ignores_errors(self, trigger: str, state: str) -> bool:
+        return (trigger, state) in self.ignore_errors
+
+
+    def waits_for_event(self, state: str) -> bool:
+        return state in self.wait_states
+
+
+    @classmethod
+    def get_key(cls, handler_cls, model, config: list):
+        """
+        Build the cache key for a transition config.
+
+        :type handler_cls: class
+        :param handler_cls: The handler class compiling the table
+        :type model: object
+        :param model: The model the config was loaded from
+        :type config: list
+        :param config: The transition config
+
+        :rtype: tuple
+        :return: The key and the config with model callbacks replaced by their names or (None, None) if the config
+                 cannot be shared
+        """
+        try:
+            shared_config, fingerprint = cls.__translate(config, model)
+        except _NotShareable:
+            return None, None
+
+        return (handler_cls, type(model), fingerprint), shared_config
+
+
+    @classmethod
+    def get(cls, key: tuple, compile):
+        """
+        Get a table from the process cache. The table will be compiled and cached on the first call.
+
+        :type key: tuple
+        :param key: A key created by get_key()
+        :type compile: callable
+        :param compile: Compiles the table if it is not cached yet
+
+        :rtype: TransitionTable
+        """
+        with cls.__lock:
+            table = cls.__tables.get(key, None)
+            if table is not None:
+                cls.__tables.move_to_end(key)
+                return table
+
+        table = compile()
+        table.is_shared = True
+
+        with cls.__lock:
+            # another thread might have compiled the same config in the meantime
+            table = cls.__tables.setdefault(key, table)
+            while len(cls.__tables) > cls.max_size:
+                cls.__tables.popitem(last = False)
+
+        return table
+
+
+    @classmethod
+    def clear(cls):
+        with cls.__lock:
+            cls.__tables.clear()
+
+
+    @classmethod
+    def __translate(cls, value, model):
+        """
+        Replace callbacks bound to the model by their names and build a hashable fingerprint in a single pass.
+
+        :rtype: tuple
+        :return: The translated value and its fingerprint
+        """
+        value_type = type(value)
+        if value_type is dict:
+            translated = { }
+            fingerprint = []
+            for k, v in value.items():
+                translated[k], v_fingerprint = cls.__translate(v, model)
+                fingerprint.append((k, v_fingerprint))
+
+            return translated, (dict, tuple(fingerprint))
+
+        if value_type is list or value_type is tuple:
+            translated = []
+            fingerprint = []
+            for v in value:
+                v_translated, v_fingerprint = cls.__translate(v, model)
+                translated.append(v_translated)
+                fingerprint.append(v_fingerprint)
+
+            return value_type(translated), (value_type, tuple(fingerprint))
+
+        if value is None or value_type is str or value_type is bool or value_type is int:
+            return value, value
+
+        if value_type is MethodType and value.__self__ is model:
+            name = value.__name__
+            bound = getattr(model, name, None)
+            if type(bound) is MethodType and bound.__func__ is value.__func__:
+                # the machine resolves callbacks given by name against the model of the current event
+                return name, name
+
+        raise _NotShareable()
+
+
+class _NotShareable(Exception):
+    pass
+
+
 class LifecycleHandler(object):
     """
     :type machine: Machine
     :type model: Model
+    :type table: TransitionTable
     :type __in_failure_handling: bool
     :type __raise_on_operation_failure: bool
     """
-    machine_cls = Machine
+    machine_cls = None
     machine = None
     model = None
+    table = None
     __in_failure_handling = False
     __raise_on_operation_failure = True
     __default_trigger = {
@@ -516,19 +1263,37 @@ class LifecycleHandler(object):
 
     def __init__(self, model: Model):
         self.model = model
-        self.machine = self.machine_cls(self.model, auto_transitions = False, send_event = True, queued = False)
-        self.__add_transitions()
+        self.table = self.__get_transition_table()
+        self.machine = self.table.machine
+        self.model.allow_state_updates = True
+
+
+    def __get_transition_table(self) -> TransitionTable:
+        config = self.model.get_transitions()
+        key, shared_config = TransitionTable.get_key(type(self), self.model, config)
+        if key is not None:
+            return TransitionTable.get(key, lambda: self.__compile(shared_config))
+
+        table = self.__compile(config)
         # set the initial state after initializing transitions
         # to avoid duplicate destination state errors
-        self.machine.initial = self.model.state
-        self.model.allow_state_updates = True
+        table.machine.initial = self.model.state
+
+        return table
 
 
-    def __add_transitions(self):
+    def __compile(self, config: list) -> TransitionTable:
         self.__get_logger().debug('initializing transitions')
-        for config in self.model.get_transitions():
+        machine_cls = self.machine_cls
+        if machine_cls is None:
+            from transitions import Machine as machine_cls
+
+        machine = machine_cls(None, auto_transitions = False, send_event = True, queued = False)
+        ignore_errors = set()
+        wait_states = set()
+        for transition_config in config:
             transition = self.__default_transition.copy()
-            transition.update(config)
+            transition.update(transition_config)
 
             sources = listify(transition.pop('source'))
             dest = transition.pop('dest')
@@ -539,32 +1304,40 @@ class LifecycleHandler(object):
                 raise ConfigurationError(
                     'unknown options %s in transition config' % ", ".join(transition.keys()))
 
-            if dest in self.machine.states.keys():
+            if dest in machine.states.keys():
                 raise ConfigurationError(
                     'Duplicate destination state %s. Multiple transitions with the same destination are not allowed.' % dest
                 )
 
-            self.machine.add_state(dest)
+            machine.add_state(dest)
             if stop_after_state_change and dest is not None:
-                state = self.machine.get_state(dest)
+                state = machine.get_state(dest)
                 state.on_enter = [self.__wait_for_next_event]
+                wait_states.add(dest)
 
-            states = self.machine.states.keys()
+            states = machine.states.keys()
             for state in sources:
                 if state not in states:
-                    self.machine.add_state(state)
+                    machine.add_state(state)
 
             for trigger in triggers:
                 try:
-                    self.__add_transition(sources, dest, trigger)
+                    if self.__add_transition(machine, sources, dest, trigger):
+                        ignore_errors.update([(trigger.get('name'), source) for source in sources])
                 except TriggerParameterConfigurationError as e:
                     msg = "Configuration error for source states '%s' in trigger '%s': '%s'" % (
                         ', '.join(sources), trigger.get('name'), e.get_message())
                     self.__get_logger().error(msg)
                     raise ConfigurationError(msg)
 
+        return TransitionTable(machine, frozenset(ignore_errors), wait_states = frozenset(wait_states))
 
-    def __add_transition(self, sources: list, dest: str, config: dict):
+
+    def __add_transition(self, machine: 'Machine', sources: list, dest: str, config: dict) -> bool:
+        """
+        :rtype: bool
+        :return: Whether errors of this trigger are ignored
+        """
         trigger = self.__default_trigger.copy()
         trigger.update(config)
 
@@ -583,8 +1356,7 @@ class LifecycleHandler(object):
         ignore_errors = trigger.get('ignore_errors')
         trigger.pop('ignore_errors')
         if ignore_errors:
-            # set ignore errors before any other function
-            # so we set this as early as possible (in prepare)
+            # report ignoring errors before any other function
             prepare = [self.__ignore_operation_failure] + prepare
 
         conditions = trigger.get('conditions')
@@ -621,7 +1393,7 @@ class LifecycleHandler(object):
             raise TriggerParameterConfigurationError(
                 'unknown options %s for trigger %s' % (", ".join(trigger.keys()), name))
 
-        self.machine.add_transition(
+        machine.add_transition(
             name,
             sources,
             dest,
@@ -632,13 +1404,22 @@ class LifecycleHandler(object):
             after = after
         )
 
+        return bool(ignore_errors)
+
 
     #
     # processing
     #
     def __call__(self):
+        if self.model.suspended:
+            # a wait has been suspended while loading the node, the model is processed when it is resumed
+            self.__get_logger().info('model %s is suspended', Lazy(repr, self.model))
+            self.__finish()
+            return
+
         # fail early, if lifecycle conditions do not pass
-        if self.model.event.is_lifecycle():
+        # a resumed model continues a transition that has passed them before
+        if self.model.event.is_lifecycle() and self.model.continuation is None:
             if self.model.event.get_lifecycle_data().is_launching() and self.model.event.is_autoscaling() and not self.model.node.is_new():
                 raise self.__get_formatter().get_error(RuntimeError, "Only new nodes can be launched.")
 
@@ -650,11 +1431,67 @@ class LifecycleHandler(object):
         if len(triggers) < 1:
             raise RuntimeError('no trigger could be found for %s' % self.model.state)
 
-        self.__get_logger().info('processing model %s', repr(self.model))
+        if self.model.continuation is not None and self.model.continuation.get('Trigger', None) in triggers:
+            # finish the trigger a wait has been suspended in first
+            trigger = self.model.continuation.get('Trigger')
+            triggers = [trigger] + [other for other in triggers if other != trigger]
+
+        self.__get_logger().info('processing model %s', Lazy(repr, self.model))
+
+        try:
+            self.__process(triggers)
+            while self.model.next_event is not None:
+                self.__process_next_event()
+        finally:
+            self.__finish()
+
+        self.__get_logger().info('processed model %s', Lazy(repr, self.model))
+
+
+    def __finish(self):
+        self.model.ledger.set_trigger('flush')
+        try:
+            # processing stopped: persist the state we reached
+            self.model.flush()
+        finally:
+            try:
+                self.model.flush_notifications()
+            finally:
+                self.model.emit_call_metrics()
+
+
+    def __process_next_event(self):
+        """
+        Continue with an event that is known already, but has not been processed, because processing stopped
+        before a state waiting for it, e.g. after a trigger configured with stop_after_trigger. The event is
+        processed like it would be in the next invocation.
+        """
+        if self.__in_failure_handling:
+            self.__get_logger().warning(
+                'Ignoring event %s, as it completed during failure handling.',
+                self.model.next_event.get_name()
+            )
+            self.model.next_event = None
+            return
+
+        if self.model.suspended:
+            raise RuntimeError('Event %s cannot be processed, as model %s has been suspended.' % (
+                self.model.next_event.get_name(),
+                repr(self.model)
+            ))
+
+        self.__continue_with_next_event()
+        triggers = self.machine.get_triggers(self.model.state)
+        if len(triggers) < 1:
+            raise RuntimeError('no trigger could be found for %s' % self.model.state)
 
         self.__process(triggers)
 
-        self.__get_logger().info('processed model %s', repr(self.model))
+
+    def __continue_with_next_event(self):
+        self.__get_logger().info('Continuing with event %s', self.model.next_event.get_name())
+        self.model.event = self.model.next_event
+        self.model.next_event = None
 
 
     def __process(self, triggers: list):
@@ -664,11 +1501,19 @@ class LifecycleHandler(object):
                 self.__get_logger().debug('possible triggers for state %s: %s', state, triggers)
                 for trigger in triggers:
                     # reset trigger condition
-                    self.__raise_on_operation_failure = True
+                    self.__raise_on_operation_failure = not self.table.ignores_errors(trigger, state)
 
                     try:
                         self.__get_logger().info('pulling trigger %s', trigger)
-                        self.machine.dispatch(trigger)
+                        self.model.ledger.set_trigger(trigger)
+                        self.model.trigger = trigger
+                        self.model.trigger_state = state
+                        transitions = self.machine.events.get(trigger).transitions.get(state)
+                        self.model.waits_for_event = transitions is not None and self.table.waits_for_event(
+                            transitions[0].dest
+                        )
+                        # trigger the event on our model only, as the machine may be shared
+                        self.machine.events.get(trigger).trigger(self.model)
 
                     except StopProcessingAfterStateChange as e:
                         self.__get_logger().info(e.get_message())
@@ -678,6 +1523,10 @@ class LifecycleHandler(object):
                         self.__get_logger().info(e.get_message())
                         return
 
+                    except SuspendProcessing as e:
+                        self.__get_logger().info(e.get_message())
+                        return
+
                     except Exception as e:
                         transitions = self.machine.events.get(trigger).transitions.get(self.model.state)
                         self.__get_clients().get('sns').publish_error(
@@ -704,6 +1553,9 @@ class LifecycleHandler(object):
                     if self.model.state != state:
                         # the state change has been applied
                         # proceed with triggers for the updated state
+                        if self.model.next_event is not None and self.table.waits_for_event(self.model.state):
+                            # the event the state waits for is known already
+                            self.__continue_with_next_event()
                         break
 
                 if self.model.state == state:
@@ -716,7 +1568,7 @@ class LifecycleHandler(object):
 
         except Exception as e:
             if self.__in_failure_handling:
-                self.__get_logger().exception("An error occured during failure handling.", repr(e))
+                self.__get_logger().exception("An error occured during failure handling: %s", repr(e))
                 self.__get_clients().get('sns').publish_error(
                     e,
                     'fail',
@@ -730,6 +1582,7 @@ class LifecycleHandler(object):
 
             self.model.event.set_has_failure()
             self.model.state = 'failure'
+            self.model.flush()
             triggers = self.machine.get_triggers(self.model.state)
             if len(triggers) < 1:
                 self.__get_logger().warning("No triggers for state failure found.")
@@ -739,72 +1592,92 @@ class LifecycleHandler(object):
 
     #
     # private built-in trigger functions
+    # these are bound to the class, as transition tables are shared between handlers
+    # the model is always taken from the event data
     #
 
-    def __log_transition(self, direction: str, event_data: EventData):
-        self.__get_logger().info(
+    @classmethod
+    def __log_transition(cls, direction: str, event_data: 'EventData'):
+        model = event_data.model
+        model.logger.info(
             '%s from %s to %s via %s%s',
             direction,
             event_data.transition.source,
             event_data.transition.dest,
             event_data.event.name,
-            ' on node %s' % (self.model.node.get_id() if self.model.node is not None else " ")
+            ' on node %s' % (model.node.get_id() if model.node is not None else " ")
         )
-        self.__log_autoscaling_activity(event_data)
+        cls.__log_autoscaling_activity(event_data)
 
 
-    def __log_before(self, event_data: EventData):
-        self.__log_transition('Transitioning', event_data)
-        self.model.report('Transitioning', event_data)
+    @classmethod
+    def __log_before(cls, event_data: 'EventData'):
+        cls.__log_transition('Transitioning', event_data)
+        event_data.model.report('Transitioning', event_data)
 
 
-    def __log_after(self, event_data: EventData):
-        self.__log_transition('Transitioned', event_data)
-        self.model.report('Transitioned', event_data)
+    @classmethod
+    def __log_after(cls, event_data: 'EventData'):
+        cls.__log_transition('Transitioned', event_data)
+        event_data.model.report('Transitioned', event_data)
 
 
-    def __is_event_successful(self, event_data: EventData) -> bool:
-        self.__get_logger().debug("Check event status: %s", repr(event_data))
-        status = self.model.event.is_successful()
-        if self.model.event.is_command():
+    @classmethod
+    def __is_event_successful(cls, event_data: 'EventData') -> bool:
+        model = event_data.model
+        model.logger.debug("Check event status: %s", Lazy(repr, event_data))
+        status = model.event.is_successful()
+        if model.event.is_command():
             if status:
-                self.__get_logger().debug("Command was successful.")
+                model.logger.debug("Command was successful.")
             else:
-                self.__get_logger().error("Command was not successful.")
+                model.logger.error("Command was not successful.")
                 raise RuntimeError("Command was not successful.")
 
         return status
 
 
-    def __stop_after_trigger(self, event_data: EventData):
+    @classmethod
+    def __stop_after_trigger(cls, event_data: 'EventData'):
         raise StopIterationAfterTrigger("Trigger forces to continue with next trigger. %s" % repr(event_data))
 
 
-    def __wait_for_next_event(self, event_data: EventData):
+    @classmethod
+    def __wait_for_next_event(cls, event_data: 'EventData'):
+        model = event_data.model
+        if model.next_event is not None:
+            # the next event is already known, e.g. a command has completed synchronously
+            # the handler continues with it once the transition has finished
+            return
+
         raise StopProcessingAfterStateChange("State requires to wait for the next event. %s" % repr(event_data))
 
 
-    def __ignore_operation_failure(self, event_data: EventData):
-        self.__get_logger().debug("%s requires to ignore exceptions.", repr(event_data))
-        self.__raise_on_operation_failure = False
+    @classmethod
+    def __ignore_operation_failure(cls, event_data: 'EventData'):
+        # the handler looks up ignored triggers in the transition table before dispatching
+        event_data.model.logger.debug("%s requires to ignore exceptions.", Lazy(repr, event_data))
 
 
-    def __log_autoscaling_activity(self, event_data: EventData):
-        if self.model.event.is_lifecycle():
-            _lifecycle_data = self.model.event.get_lifecycle_data()
-            activity = self.model.clients.get('autoscaling').get_activity(
+    @classmethod
+    def __log_autoscaling_activity(cls, event_data: 'EventData'):
+        model = event_data.model
+        if model.event.is_lifecycle():
+            _lifecycle_data = model.event.get_lifecycle_data()
+            activity = model.clients.get('autoscaling').get_activity(
                 _lifecycle_data.get_autoscaling_group_name(),
                 _lifecycle_data.is_launching(),
                 _lifecycle_data.get_instance_id()
             )
 
-            self.__get_logger().info('%s %s autoscaling activity on event %s: %s', activity.get('StatusCode').upper(),
-                                     'launching' if _lifecycle_data.is_launching else 'terminating',
-                                     repr(event_data), activity)
+            model.logger.info('%s %s autoscaling activity on event %s: %s',
+                              activity.get('StatusCode', 'unknown').upper(),
+                              'launching' if _lifecycle_data.is_launching() else 'terminating',
+                              Lazy(repr, event_data), activity)
 
             if activity == dict():
-                self.__get_logger().warning('Could not find autoscaling activity for node %s',
-                                            _lifecycle_data.get_instance_id())
+                model.logger.warning('Could not find autoscaling activity for node %s',
+                                     _lifecycle_data.get_instance_id())
 
     #
     # convenience methods
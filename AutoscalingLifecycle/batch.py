@@ -0,0 +1,186 @@
+import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from logging import Logger
+
+from . import Event
+from . import LifecycleHandler
+from .exceptions import EventNotSupportedError
+
+
+class RecordResult(object):
+    """
+    :type id: str
+    :param id: The message id of the record
+    :type instance_id: str
+    :param instance_id: The EC2 instance the event belongs to, if any
+    :type error: Exception
+    :param error: The error that occurred while processing the record
+    :type skipped: bool
+    :param skipped: Whether the record has not been processed, because a previous record of the instance failed
+    """
+
+
+    def __init__(self, id: str, instance_id: str = None, error: Exception = None, skipped: bool = False):
+        self.id = id
+        self.instance_id = instance_id
+        self.error = error
+        self.skipped = skipped
+
+
+    def is_successful(self) -> bool:
+        return self.error is None and not self.skipped
+
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'instance_id': self.instance_id,
+            'successful': self.is_successful(),
+            'skipped': self.skipped,
+            'error': repr(self.error) if self.error is not None else None
+        }
+
+
+class BatchProcessor(object):
+    """
+    Process a batch of SNS or SQS records, e.g. from a lambda event.
+
+    Records are grouped by the EC2 instance their event belongs to. Groups are processed in parallel, records of
+    the same instance strictly in order. Once a record of an instance fails, the remaining records of that instance
+    are skipped and reported as failed as well, so they can be retried in order.
+
+    Every record is processed by a new model from the model factory and a LifecycleHandler, just like a single
+    event. Unsupported events are ignored.
+
+    :type model_factory: callable
+    :param model_factory: Returns a new model instance for each record
+    :type logger: Logger
+    :param logger: A logger instance
+    :type max_workers: int
+    :param max_workers: The maximum number of instances to process in parallel
+    """
+    handler_cls = LifecycleHandler
+
+
+    def __init__(self, model_factory, logger: Logger, max_workers: int = 8):
+        self.model_factory = model_factory
+        self.logger = logger
+        self.max_workers = max_workers
+
+
+    def __call__(self, records: list) -> dict:
+        return self.get_batch_response(self.process(records))
+
+
+    def process(self, records: list) -> list:
+        """
+        :type records: list
+        :param records: SNS or SQS records or plain events
+
+        :rtype: list
+        :return: A RecordResult for each record in the order of the records
+        """
+        results = [None] * len(records)
+        groups = OrderedDict()
+        for index, record in enumerate(records):
+            try:
+                record_id, event = self.__parse(record)
+            except Exception as e:
+                self.logger.exception('Could not parse record %s: %s', index, repr(e))
+                results[index] = RecordResult(self.__get_record_id(record), error = e)
+                continue
+
+            instance_id = self.__get_instance_id(event)
+            # events without an instance do not depend on each other
+            key = instance_id if instance_id is not None else record_id
+            groups.setdefault(key, []).append((index, record_id, instance_id, event))
+
+        self.logger.info('Processing %s records of %s groups', len(records), len(groups))
+        if len(groups) > 0:
+            with ThreadPoolExecutor(max_workers = max(1, min(self.max_workers, len(groups)))) as executor:
+                for group_results in executor.map(self.__process_group, groups.values()):
+                    for index, result in group_results:
+                        results[index] = result
+
+        return results
+
+
+    def get_batch_response(self, results: list) -> dict:
+        """
+        :type results: list
+        :param results: The results returned by process()
+
+        :rtype: dict
+        :return: A partial batch failure response
+        """
+        return {
+            'batchItemFailures': [
+                { 'itemIdentifier': result.id } for result in results if not result.is_successful()
+            ]
+        }
+
+
+    def __process_group(self, group: list) -> list:
+        results = []
+        failed = False
+        for index, record_id, instance_id, event in group:
+            if failed:
+                self.logger.warning('Skipping record %s, as a previous record of %s failed.', record_id, instance_id)
+                results.append((index, RecordResult(record_id, instance_id, skipped = True)))
+                continue
+
+            try:
+                self.__process_event(event)
+                results.append((index, RecordResult(record_id, instance_id)))
+            except Exception as e:
+                self.logger.exception('Failed to process record %s: %s', record_id, repr(e))
+                results.append((index, RecordResult(record_id, instance_id, error = e)))
+                failed = True
+
+        return results
+
+
+    def __process_event(self, event: Event):
+        model = self.model_factory()
+        try:
+            model.initialize(event)
+        except EventNotSupportedError as e:
+            self.logger.warning('Ignoring event %s: %s', event.get_name(), e.get_message())
+            return
+
+        self.handler_cls(model)()
+
+
+    def __parse(self, record: dict) -> tuple:
+        if 'Sns' in record:
+            record_id = record.get('Sns').get('MessageId')
+            data = json.loads(record.get('Sns').get('Message'))
+        elif 'body' in record:
+            record_id = record.get('messageId')
+            data = json.loads(record.get('body'))
+            if data.get('Type') == 'Notification' and 'Message' in data:
+                # sns notification delivered through sqs
+                data = json.loads(data.get('Message'))
+        else:
+            record_id = record.get('id')
+            data = record
+
+        return record_id, Event(data)
+
+
+    def __get_record_id(self, record: dict) -> str:
+        if 'Sns' in record:
+            return record.get('Sns').get('MessageId')
+
+        return record.get('messageId', record.get('id'))
+
+
+    def __get_instance_id(self, event: Event):
+        if event.is_lifecycle():
+            return event.get_lifecycle_data().get_instance_id()
+
+        if event.is_command() and len(event.get_resources()) > 0:
+            return event.get_resources()[0]
+
+        return None
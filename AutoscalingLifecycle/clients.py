@@ -1,23 +1,73 @@
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from logging import Logger
-
-import botocore.waiter as waiter
-from boltons.tbutils import ExceptionInfo
-import boto3
-from botocore.client import BaseClient as BotoClient
-from botocore.exceptions import WaiterError, ClientError
-
+from queue import Queue
+from threading import Event
+from threading import Lock
+from threading import RLock
+from threading import Thread
+from threading import local
+from typing import TYPE_CHECKING
+
+from .exceptions import WaitTimeoutError
+from .ledger import CallLedger
 from .logging import Logging
 from .logging import MessageFormatter
+from .waiters import Acceptor
+from .waiters import Backoff
+from .waiters import Waiter
+from .waiters import WaiterConfig
+from .waiters import WaiterEngine
+from .waiters import WaiterRegistry
+
+if TYPE_CHECKING:
+    # boto3 and botocore are imported when they are first used to keep cold starts fast
+    import boto3
+    from botocore.client import BaseClient as BotoClient
 
 
 class ClientFactory(object):
     """
     A simple class that creates boto3 service clients. Each client will be created only once
     and than returned from local cache
+
+    Clients are created with a botocore Config built from the default profile, updated with the profile of the
+    service. Clients are thread safe and shared by all threads, so the connection pool of a service must be large
+    enough for the work that runs in parallel.
+
+    A boto3 Session is not thread safe. It loads credentials, endpoints and service data when the first client is
+    created, so the first client is created while all other creations wait. Further clients can be created in
+    parallel.
+
+    Every client is instrumented: its calls are recorded with latency, retries and error code in the CallLedger
+    active on the calling thread.
+
+    :type default_profile: dict
+    :param default_profile: botocore Config parameters used for all services
+    :type service_profiles: dict
+    :param service_profiles: botocore Config parameters by service name, updating the default profile
     """
 
+    default_profile = {
+        'max_pool_connections': 10,
+        'connect_timeout': 5,
+        'read_timeout': 30,
+        'retries': { 'mode': 'standard', 'max_attempts': 5 },
+        'tcp_keepalive': True,
+    }
+    service_profiles = {
+        # parallel scan segments and write-behind flushes of batches
+        'dynamodb': { 'max_pool_connections': 25, 'read_timeout': 10 },
+        # fan out of commands and agent checks
+        'ssm': { 'max_pool_connections': 25 },
+        # route53 allows five requests per second per account
+        'route53': { 'retries': { 'mode': 'adaptive', 'max_attempts': 10 } },
+        'sns': { 'read_timeout': 10 },
+    }
+
 
-    def __init__(self, session: boto3.Session, default_region: str, logger: Logger):
+    def __init__(self, session: 'boto3.Session', default_region: str, logger: Logger, profiles: dict = None):
         """
 
         :param session: A boto3 boto3.Session instamce
@@ -26,11 +76,39 @@ class ClientFactory(object):
         :type default_region: str
         :param logger: A LifecycleLogger instance
         :type logger: LifecycleLogger
+        :param profiles: botocore Config parameters by service name, updating the service profiles of the class
+        :type profiles: dict
         """
         self.session = session
         self.logger = logger
         self.default_region = default_region
         self.clients = {}
+        self.profiles = dict(self.service_profiles)
+        self.profiles.update(profiles if profiles is not None else { })
+        self.lock = Lock()
+        self.locks = { }
+        self.session_lock = Lock()
+        self.is_session_loaded = False
+
+
+    def get_profile(self, name: str) -> dict:
+        """
+        :type name: str
+        :param name: The service name
+
+        :rtype: dict
+        :return: The botocore Config parameters of a service
+        """
+        # copy nested dicts, botocore updates the retry config it is given
+        profile = { }
+        for key, value in self.default_profile.items():
+            profile.update({ key: dict(value) if isinstance(value, dict) else value })
+        for key, value in self.profiles.get(name, { }).items():
+            if isinstance(value, dict):
+                value = dict(profile.get(key, { }), **value)
+            profile.update({ key: value })
+
+        return profile
 
 
     def get(self, name: str, region_name: str = ''):
@@ -55,98 +133,228 @@ class ClientFactory(object):
         key = name + '_' + region_name
         client = self.clients.get(key, None)
         if client is None:
-            self.logger.debug('Client %s in region %s not created. Creating ...', name, region_name)
-            client = self.session.client(name, region_name = region_name)
-            self.clients.update({key: client})
+            # concurrent callers must share one client and its pool, different clients can be created in parallel
+            with self.__get_lock(key):
+                client = self.clients.get(key, None)
+                if client is None:
+                    client = self.__create(name, region_name)
+                    self.clients.update({key: client})
 
         return client
 
 
+    def prewarm(self, services: list, max_workers: int = 8):
+        """
+        Create clients concurrently, e.g. in the init phase of a lambda function, to keep their creation off the
+        path of the first event. Clients that cannot be created are skipped and created again on first use.
+
+        :type services: list
+        :param services: Service names or tuples of service name and region
+
+        :rtype: list
+        :return: The names of the clients that could not be created
+        """
+        services = [service if isinstance(service, tuple) else (service, '') for service in services]
+        if len(services) == 0:
+            return []
+
+
+        def create(service: tuple):
+            try:
+                self.get(*service)
+            except Exception as e:
+                self.logger.warning('Could not prewarm client %s: %s', service[0], repr(e))
+                return service[0]
+
+
+        # the first client loads the session, the others are created in parallel
+        failed = [name for name in [create(services[0])] if name is not None]
+        with ThreadPoolExecutor(max_workers = max(1, min(max_workers, len(services) - 1))) as executor:
+            return failed + [name for name in executor.map(create, services[1:]) if name is not None]
+
+
+    def __get_lock(self, key: str) -> Lock:
+        with self.lock:
+            return self.locks.setdefault(key, Lock())
+
+
+    def __create(self, name: str, region_name: str) -> 'BotoClient':
+        from botocore.config import Config
+
+        profile = self.get_profile(name)
+        self.logger.debug('Client %s in region %s not created. Creating with %s ...', name, region_name, profile)
+        if self.is_session_loaded:
+            client = self.session.client(name, region_name = region_name, config = Config(**profile))
+        else:
+            with self.session_lock:
+                client = self.session.client(name, region_name = region_name, config = Config(**profile))
+                self.is_session_loaded = True
+        self.instrument(client, name)
+
+        return client
+
+
+    def instrument(self, client: 'BotoClient', name: str):
+        """
+        Record the calls of a client in the active CallLedger.
+
+        :type client: BotoClient
+        :param client: The client to instrument
+        :type name: str
+        :param name: The service name to record calls with
+        """
+
+
+        def before_call(model, context, **kwargs):
+            ledger = CallLedger.get_current()
+            if ledger is not None:
+                context.update({
+                    'ledger': ledger,
+                    'ledger_trigger': ledger.trigger,
+                    'ledger_operation': model.name,
+                    'ledger_start': time.perf_counter()
+                })
+
+
+        def after_call(context, parsed, **kwargs):
+            parsed = parsed if isinstance(parsed, dict) else { }
+            record(
+                context,
+                parsed.get('ResponseMetadata', { }).get('RetryAttempts', 0),
+                parsed.get('Error', { }).get('Code', None)
+            )
+
+
+        def after_call_error(context, exception, **kwargs):
+            record(context, 0, type(exception).__name__)
+
+
+        def record(context, retries, error_code):
+            if 'ledger_start' not in context:
+                return
+
+            context.get('ledger').record(
+                name,
+                context.get('ledger_operation'),
+                context.get('client_region'),
+                time.perf_counter() - context.pop('ledger_start'),
+                retries,
+                error_code,
+                context.get('ledger_trigger')
+            )
+
+
+        # first, as handlers returning a response (e.g. stubs) stop the emission
+        client.meta.events.register_first('before-call.*.*', before_call)
+        client.meta.events.register('after-call.*.*', after_call)
+        client.meta.events.register('after-call-error.*.*', after_call_error)
+
+
+def get_activity_progress(response: dict, arguments: dict):
+    """
+    :rtype: int
+    :return: The progress of the scaling activity described by arguments['description'] or None
+    """
+    for activity in response['Activities']:
+        if arguments['description'] in activity['Description']:
+            return activity['Progress']
+
+    return None
+
+
 class CustomWaiters(object):
-    model_configs = {
-        'ScanCountGt0': {
-            'client': 'dynamodb',
-            'model': {
-                "version": 2,
-                "waiters": {
-                    "ScanCountGt0": {
-                        "delay": 15,
-                        "operation": "Scan",
-                        "maxAttempts": 40,
-                        "acceptors": [
-                            {
-                                "expected": True,
-                                "matcher": "path",
-                                "state": "success",
-                                "argument": "length(Items[]) > `0`"
-                            },
-                            {
-                                "expected": True,
-                                "matcher": "path",
-                                "state": "retry",
-                                "argument": "length(Items[]) == `0`"
-                            }
-                        ]
-                    }
-                }
-            }
-        },
-        'InstancesInService': {
-            'client': 'autoscaling',
-            'model': {
-                "version": 2,
-                "waiters": {
-                    "InstancesInService": {
-                        "delay": 5,
-                        "operation": "DescribeAutoScalingInstances",
-                        "maxAttempts": 10,
-                        "acceptors": [
-                            {
-                                "expected": "InService",
-                                "matcher": "pathAny",
-                                "state": "success",
-                                "argument": "AutoScalingInstances[].LifecycleState"
-                            }
-                        ]
-                    }
-                }
-            }
-        },
-        'AgentIsOnline': {
-            'client': 'ssm',
-            'model': {
-                "version": 2,
-                "waiters": {
-                    "AgentIsOnline": {
-                        "delay": 10,
-                        "operation": "DescribeInstanceInformation",
-                        "maxAttempts": 20,
-                        "acceptors": [
-                            {
-                                "expected": "Online",
-                                "matcher": "pathAny",
-                                "state": "success",
-                                "argument": "InstanceInformationList[].PingStatus"
-                            },
-                            {
-                                "expected": "ConnectionLost",
-                                "matcher": "pathAny",
-                                "state": "retry",
-                                "argument": "InstanceInformationList[].PingStatus"
-                            },
-                            {
-                                "expected": "Inactive",
-                                "matcher": "pathAny",
-                                "state": "failure",
-                                "argument": "InstanceInformationList[].PingStatus"
-                            }
-                        ]
-                    }
-                }
-            }
-        }
+    """
+    Waiters for conditions botocore has no waiter for. Acceptors are python predicates and waits run on a
+    WaiterEngine with exponential backoff, jitter and an optional overall deadline.
+
+    Configs are static. Values like an instance id or an item count are passed to the acceptors as arguments of
+    the wait, so the number of waiters does not grow with the instances seen by a process.
+
+    :type configs: dict
+    :param configs: The waiter configs by name
+    :type max_waiters: int
+    :param max_waiters: The maximum number of waiters kept in the registry
+    :type waiters: WaiterRegistry
+    :param waiters: Waiters bound to their clients by name
+    :type engine: WaiterEngine
+    :param engine: The engine running the waits
+    """
+    configs = {
+        'ScanCountGt0': WaiterConfig(
+            'ScanCountGt0',
+            'dynamodb',
+            'scan',
+            [
+                Acceptor(Acceptor.SUCCESS, lambda response, arguments: len(response['Items']) > 0),
+                Acceptor(Acceptor.RETRY, lambda response, arguments: len(response['Items']) == 0),
+            ],
+            Backoff(delay = 2, max_delay = 15, timeout = 600)
+        ),
+        'InstancesInService': WaiterConfig(
+            'InstancesInService',
+            'autoscaling',
+            'describe_auto_scaling_instances',
+            [
+                Acceptor(Acceptor.SUCCESS, lambda response, arguments: any(
+                    instance['LifecycleState'] == 'InService' for instance in response['AutoScalingInstances']
+                )),
+            ],
+            Backoff(delay = 1, max_delay = 5, timeout = 50)
+        ),
+        'AgentIsOnline': WaiterConfig(
+            'AgentIsOnline',
+            'ssm',
+            'describe_instance_information',
+            [
+                Acceptor(Acceptor.SUCCESS, lambda response, arguments: any(
+                    info['PingStatus'] == 'Online' for info in response['InstanceInformationList']
+                )),
+                Acceptor(Acceptor.RETRY, lambda response, arguments: any(
+                    info['PingStatus'] == 'ConnectionLost' for info in response['InstanceInformationList']
+                )),
+                Acceptor(Acceptor.FAILURE, lambda response, arguments: any(
+                    info['PingStatus'] == 'Inactive' for info in response['InstanceInformationList']
+                )),
+            ],
+            Backoff(delay = 2, max_delay = 10, timeout = 200)
+        ),
+        'ScanCountIs': WaiterConfig(
+            'ScanCountIs',
+            'dynamodb',
+            'scan',
+            [
+                Acceptor(Acceptor.SUCCESS, lambda response, arguments: len(response['Items']) == arguments['size']),
+            ],
+            Backoff(delay = 2, max_delay = 15, timeout = 600)
+        ),
+        'AutoscalingComplete': WaiterConfig(
+            'AutoscalingComplete',
+            'autoscaling',
+            'describe_scaling_activities',
+            [
+                Acceptor(Acceptor.FAILURE, lambda response, arguments: (
+                    get_activity_progress(response, arguments) is None
+                )),
+                Acceptor(Acceptor.RETRY, lambda response, arguments: get_activity_progress(response, arguments) < 100),
+                Acceptor(Acceptor.SUCCESS, lambda response, arguments: (
+                    get_activity_progress(response, arguments) == 100
+                )),
+            ],
+            Backoff(delay = 5, max_delay = 20, timeout = 120)
+        ),
+        'ChangeInSync': WaiterConfig(
+            'ChangeInSync',
+            'route53',
+            'get_change',
+            [
+                Acceptor(Acceptor.SUCCESS, lambda response, arguments: response['ChangeInfo']['Status'] == 'INSYNC'),
+            ],
+            # route53 allows five requests per second per account, changes are usually in sync within a minute
+            Backoff(delay = 5, max_delay = 15, timeout = 300)
+        ),
     }
-    waiters = {}
+    max_waiters = 64
+    waiters = None
 
 
     def __init__(self, clients: ClientFactory, logger: Logger):
@@ -159,6 +367,8 @@ class CustomWaiters(object):
         self.clients = clients
         self.logger = logger
         self.message_formatter = MessageFormatter(logger.name)
+        self.engine = WaiterEngine(logger)
+        self.waiters = WaiterRegistry(self.max_waiters)
 
 
     def get_waiter_names(self):
@@ -166,119 +376,112 @@ class CustomWaiters(object):
         :rtype: list
         :return: A list of waiter names
         """
-        return self.model_configs.keys()
+        return self.configs.keys()
 
 
-    def get(self, name):
+    def set_deadline(self, deadline: float = None):
+        """
+        Limit the waits of the current thread, e.g. to the remaining time of the invocation.
+
+        :type deadline: float
+        :param deadline: A time.monotonic() value or None
+        """
+        self.engine.set_deadline(deadline)
+
+
+    def prewarm(self, names: list = None, max_workers: int = 8) -> list:
+        """
+        Create waiters and their clients ahead of the first event. Clients are created concurrently.
+
+        :type names: list
+        :param names: The waiters to create. Defaults to all waiters.
+        :type max_workers: int
+        :param max_workers: The maximum number of clients created in parallel
+
+        :rtype: list
+        :return: The names of the waiters that could not be created
+        """
+        names = list(self.get_waiter_names()) if names is None else names
+        services = []
+        for name in names:
+            service = self.configs.get(name).service
+            if service not in services:
+                services.append(service)
+        self.clients.prewarm(services, max_workers)
+
+        failed = []
+        for name in names:
+            try:
+                self.get(name)
+            except Exception as e:
+                self.logger.warning('Could not prewarm waiter %s: %s', name, repr(e))
+                failed.append(name)
+
+        return failed
+
+
+    def get(self, name) -> Waiter:
         """
         :type name: str
         :param name: The name of the waiter
 
-        :rtype: botocore.waiter.Waiter
+        :rtype: Waiter
         :return: The waiter object.
         """
 
         if not self.__has(name):
-            config = self.model_configs.get(name)
-            model = waiter.WaiterModel(config.get('model'))
-            client = self.clients.get(config.get('client'))
-            self.__create(name, model, client)
+            config = self.configs.get(name, None)
+            if config is None:
+                raise self.message_formatter.get_error(KeyError, 'Waiter %s does not exist', name)
+            self.__create(config)
 
         return self.waiters.get(name)
 
 
-    def get_dynamodb_scan_count_is(self, size):
+    def wait_all(self, waits: list) -> list:
+        """
+        Wait for several conditions at once. The waits are polled interleaved on the calling thread.
+
+        :type waits: list
+        :param waits: Tuples of waiter and operation parameters
+
+        :rtype: list
+        :return: The responses that satisfied the waiters
+        """
+        return self.engine.wait_all(waits)
+
+
+    def get_dynamodb_scan_count_is(self, size) -> Waiter:
         """
         :type size: int or str
         :param size: The number of expected scan items to find
 
-        :rtype: botocore.waiter.Waiter
+        :rtype: Waiter
         :return: The waiter object.
         """
-        name = "ScanCountIs" + str(size)
-
-        if not self.__has(name):
-            model = waiter.WaiterModel({
-                "version": 2,
-                "waiters": {
-                    name: {
-                        "delay": 15,
-                        "operation": "Scan",
-                        "maxAttempts": 40,
-                        "acceptors": [
-                            {
-                                "expected": True,
-                                "matcher": "path",
-                                "state": "success",
-                                "argument": "length(Items[]) == " f"`{size}`"
-                            }
-                        ]
-                    }
-                }
-            })
-            self.__create(name, model, self.clients.get('dynamodb'))
-
-        return self.get(name)
+        return self.get('ScanCountIs').with_arguments(size = int(size))
 
 
-    def get_autoscaling_complete_for(self, instance_id, is_launching):
+    def get_autoscaling_complete_for(self, instance_id, is_launching) -> Waiter:
         """
-        :rtype: botocore.waiter.Waiter
+        :rtype: Waiter
         :return: The waiter object.
         """
-
         if is_launching:
-            desc = "Launching a new EC2 instance: " + instance_id
-            name = "AutoscalingCompleteForLaunching" + instance_id
+            description = "Launching a new EC2 instance: " + instance_id
         else:
-            desc = "Terminating EC2 instance: " + instance_id
-            name = "AutoscalingCompleteForTerminating" + instance_id
-
-        if not self.__has(name):
-            model = waiter.WaiterModel({
-                "version": 2,
-                "waiters": {
-                    name: {
-                        "delay": 20,
-                        "operation": "DescribeScalingActivities",
-                        "maxAttempts": 6,
-                        "acceptors": [
-                            {
-                                "expected": True,
-                                "matcher": "path",
-                                "state": "failure",
-                                "argument": "length(Activities[?contains(Description, '" f"{desc}""')]) < `1`"
-                            },
-                            {
-                                "expected": True,
-                                "matcher": "path",
-                                "state": "retry",
-                                "argument": "Activities[?contains(Description, '" f"{desc}""')] | [0].Progress < `100`"
-                            },
-                            {
-                                "expected": True,
-                                "matcher": "path",
-                                "state": "success",
-                                "argument": "Activities[?contains(Description, '" f"{desc}""')] | [0].Progress == `100`"
-                            }
-                        ]
-                    }
-                }
-            })
-            self.__create(name, model, self.clients.get('autoscaling'))
+            description = "Terminating EC2 instance: " + instance_id
 
-        return self.get(name)
+        return self.get('AutoscalingComplete').with_arguments(description = description)
 
 
     def __has(self, name: str):
-        return name in self.waiters.keys()
+        return name in self.waiters
 
 
-    def __create(self, name: str, model: waiter.WaiterModel, client: BotoClient):
-        if name not in model.waiter_names:
-            raise self.message_formatter.get_error(KeyError, 'Waiter %s does not exist', name)
-
-        self.waiters.update({name: waiter.create_waiter_with_client(name, model, client)})
+    def __create(self, config: WaiterConfig):
+        client = self.clients.get(config.service)
+        self.waiters.add(Waiter(config, client, self.engine))
 
 
 class Clients(object):
@@ -291,12 +494,14 @@ class Clients(object):
     """
     __client_specs = dict()
     __clients = dict()
+    __lock = RLock()
 
 
     def __init__(self, client_factory: ClientFactory, waiters: CustomWaiters, logging: Logging):
         self.client_factory = client_factory
         self.waiters = waiters
         self.logging = logging
+        self.logger = logging.get_logger()
 
 
     def add_client_spec(self, name, cls, *args):
@@ -316,12 +521,74 @@ class Clients(object):
         cname = '{}-{}'.format(name, region)
         client = self.__clients.get(cname, None)
         if client is None:
-            client = spec.get('class')(self.client_factory.get(name, region), self.waiters, self.logging, *spec.get('args'))
-            self.__clients.update({cname: client})
+            with self.__lock:
+                client = self.__clients.get(cname, None)
+                if client is None:
+                    client = spec.get('class')(
+                        self.client_factory.get(name, region),
+                        self.waiters,
+                        self.logging,
+                        *spec.get('args')
+                    )
+                    self.__clients.update({cname: client})
 
         return client
 
 
+    def prewarm(self, names: list = None, region: str = '', max_workers: int = 8, waiters: bool = True) -> list:
+        """
+        Create clients and waiters ahead of the first event, e.g. in the init phase of a lambda function. The boto
+        clients are created concurrently on a thread pool. Clients that cannot be created are created again on first
+        use.
+
+        :type names: list
+        :param names: The clients to create. Defaults to all clients with a spec.
+        :type region: str
+        :param region: The region to create the clients in
+        :type max_workers: int
+        :param max_workers: The maximum number of clients created in parallel
+        :type waiters: bool
+        :param waiters: Whether to create the custom waiters as well
+
+        :rtype: list
+        :return: The names of the clients and waiters that could not be created
+        """
+        names = list(self.__client_specs.keys()) if names is None else names
+        failed = self.client_factory.prewarm([(name, region) for name in names], max_workers)
+        for name in names:
+            if name in failed:
+                continue
+            try:
+                self.get(name, region)
+            except Exception as e:
+                self.logger.warning('Could not prewarm client %s: %s', name, repr(e))
+                failed.append(name)
+
+        if waiters:
+            failed.extend(self.waiters.prewarm(max_workers = max_workers))
+
+        return failed
+
+
+    def set_deadline(self, deadline: float = None):
+        """
+        Limit the custom waits of the current thread, e.g. to the remaining time of the invocation it processes.
+
+        :type deadline: float
+        :param deadline: A time.monotonic() value or None
+        """
+        self.waiters.set_deadline(deadline)
+
+
+    def reset(self):
+        """
+        Reset the state clients keep for the invocation processed on the current thread, e.g. cached api responses.
+        The state of invocations processed on other threads, e.g. by a BatchProcessor, is kept.
+        """
+        for client in list(self.__clients.values()):
+            client.reset()
+
+
 class BaseClient(object):
     """
     :type client: BotoClient
@@ -332,93 +599,235 @@ class BaseClient(object):
     :param logger: A logger instance
     :type formater: MessageFormatter
     :param formater: A formatter instance
+    :type local: local
+    :param local: The state kept for the invocation processed on the current thread
     """
 
     client = None
     waiters = None
     logger = None
     formatter = None
+    local = None
 
 
-    def __init__(self, client: BotoClient, waiters: CustomWaiters, logging: Logging, *args):
+    def __init__(self, client: 'BotoClient', waiters: CustomWaiters, logging: Logging, *args):
         self.client = client
         self.waiters = waiters
         self.logger = logging.get_logger()
         self.formatter = logging.get_formatter()
+        self.local = local()
+
+
+    def reset(self):
+        """
+        Reset state kept for the invocation processed on the current thread. Clients are reused across invocations
+        and shared by the threads of a BatchProcessor, so every thread keeps its own state.
+        """
+        vars(self.local).clear()
+
+
+    def get_local(self, name: str, factory):
+        """
+        :type name: str
+        :param name: The name of the state
+        :type factory: callable
+        :param factory: Creates the initial state, e.g. dict
+
+        :rtype: object
+        :return: The state of the invocation processed on the current thread
+        """
+        if not hasattr(self.local, name):
+            setattr(self.local, name, factory())
+
+        return getattr(self.local, name)
 
 
 class Ec2Client(BaseClient):
+    """
+    :type resource: boto3.resources.base.ServiceResource
+    :param resource: The ec2 service resource. It is created on first use.
+    :type chunk_size: int
+    :param chunk_size: The maximum number of instance ids per describe call
+    :type instances: dict
+    :param instances: Running instances described in the invocation of the current thread by instance id. Instances
+        that are not running or do not exist are not kept, as pending instances will be running soon.
+    """
+
+    __resource = None
+    chunk_size = 200
 
-    def __init__(self, client: BotoClient, waiters: CustomWaiters, logging: Logging, *args):
+
+    def __init__(self, client: 'BotoClient', waiters: CustomWaiters, logging: Logging, *args):
         super().__init__(client, waiters, logging)
-        self.resource = boto3.resource('ec2')
+        self.lock = Lock()
+
+
+    @property
+    def instances(self) -> dict:
+        return self.get_local('instances', dict)
+
+
+    @instances.setter
+    def instances(self, instances: dict):
+        self.local.instances = instances
+
+
+    @property
+    def resource(self):
+        if self.__resource is None:
+            import boto3
+
+            self.__resource = boto3.resource('ec2')
+
+        return self.__resource
 
 
     def find_instances_by_name(self, name) -> list:
-        response = self.client.describe_instances(
-            Filters=[
-                {
-                    'Name': 'tag:Name',
-                    'Values': [
-                        name,
-                    ]
-                },
-                {
-                    'Name': 'instance-state-name',
-                    'Values': [
-                        'running',
-                    ]
-                },
-            ]
-        )
+        instances = self.__describe([
+            {
+                'Name': 'tag:Name',
+                'Values': [
+                    name,
+                ]
+            },
+        ])
 
-        instances = []
-        for reservation in response.get('Reservations', []):
-            for instance in reservation.get('Instances', []):
-                instances.append(instance)
+        with self.lock:
+            for instance in instances:
+                self.instances[instance.get('InstanceId')] = instance
 
         return instances
 
 
     def get_instance(self, instance_id) -> dict:
-        response = self.client.describe_instances(
-            InstanceIds=[instance_id],
-            Filters=[
-                {
-                    'Name': 'instance-state-name',
-                    'Values': [
-                        'running',
-                    ]
-                },
-            ]
-        )
+        return self.get_instances([instance_id]).get(instance_id, dict())
+
+
+    def get_instances(self, instance_ids: list) -> dict:
+        """
+        Describe running instances with one paginated call per chunk of ids. Running instances described before in
+        this invocation are not described again, instances that were not running are.
+
+        :type instance_ids: list
+        :param instance_ids: The instance ids
+
+        :rtype: dict
+        :return: The running instances by instance id. Instances that are not running or do not exist are missing.
+        """
+        with self.lock:
+            missing = [instance_id for instance_id in instance_ids if instance_id not in self.instances]
+
+        missing = list(OrderedDict.fromkeys(missing))
+        for index in range(0, len(missing), self.chunk_size):
+            chunk = missing[index:index + self.chunk_size]
+            # unlike InstanceIds, a filter does not fail on ids that do not exist
+            instances = self.__describe([{ 'Name': 'instance-id', 'Values': chunk }])
+            with self.lock:
+                for instance in instances:
+                    self.instances[instance.get('InstanceId')] = instance
+
+        with self.lock:
+            return {
+                instance_id: self.instances.get(instance_id)
+                for instance_id in instance_ids
+                if instance_id in self.instances
+            }
 
-        for reservation in response.get('Reservations', []):
-            for instance in reservation.get('Instances', []):
-                return instance
 
-        return dict()
+    def invalidate_instances(self, instance_ids: list = None):
+        """
+        :type instance_ids: list
+        :param instance_ids: Drop these instances from the cache. Defaults to all instances.
+        """
+        with self.lock:
+            if instance_ids is None:
+                self.instances = { }
+            else:
+                for instance_id in instance_ids:
+                    self.instances.pop(instance_id, None)
+
+
+    def __describe(self, filters: list) -> list:
+        """
+        :rtype: list
+        :return: The running instances matching the filters of all pages
+        """
+        paginator = self.client.get_paginator('describe_instances')
+        pages = paginator.paginate(Filters = filters + [{ 'Name': 'instance-state-name', 'Values': ['running'] }])
 
+        return [
+            instance
+            for page in pages
+            for reservation in page.get('Reservations', [])
+            for instance in reservation.get('Instances', [])
+        ]
 
-    def create_snapshot(self, description, volume_id, tags: list):
+
+    def create_snapshot(self, description, volume_id, tags: list, wait: bool = True) -> str:
+        """
+        :type wait: bool
+        :param wait: Whether to block until the snapshot is completed. Use is_snapshot_completed() otherwise.
+
+        :rtype: str
+        :return: The snapshot id
+        """
         response = self.client.create_snapshot(
             Description=description,
             VolumeId=volume_id,
         )
 
-        self.client.get_waiter('snapshot_completed').wait(
-            SnapshotIds=[response.get('SnapshotId')],
-        )
+        if wait:
+            self.client.get_waiter('snapshot_completed').wait(
+                SnapshotIds=[response.get('SnapshotId')],
+            )
 
         if len(tags) > 0:
             snapshot = self.resource.Snapshot(response.get('SnapshotId'))
             snapshot.create_tags(Tags=tags)
 
+        return response.get('SnapshotId')
+
+
+    def is_snapshot_completed(self, snapshot_id: str) -> bool:
+        """
+        :rtype: bool
+        :return: Whether the snapshot is completed
+        :raises RuntimeError: If the snapshot failed
+        """
+        snapshot = self.client.describe_snapshots(SnapshotIds=[snapshot_id]).get('Snapshots')[0]
+        if snapshot.get('State') == 'error':
+            raise RuntimeError('Snapshot %s failed: %s' % (snapshot_id, snapshot.get('StateMessage', 'unknown')))
+
+        return snapshot.get('State') == 'completed'
+
 
 class AutoscalingClient(BaseClient):
+    """
+    :type activities: dict
+    :param activities: Scaling activities per group, indexed by instance id and direction (launching or terminating).
+        They are kept for the invocation of the current thread.
+    """
+
+    __LAUNCHING = 'Launching a new EC2 instance: '
+    __TERMINATING = 'Terminating EC2 instance: '
+
+
+    def __init__(self, client: 'BotoClient', waiters: CustomWaiters, logging: Logging, *args):
+        super().__init__(client, waiters, logging)
+        self.lock = Lock()
+
+
+    @property
+    def activities(self) -> dict:
+        return self.get_local('activities', dict)
+
 
     def complete_lifecycle_action(self, hook_name, group_name, token, result, instance_id):
+        from botocore.exceptions import ClientError
+
         self.logger.debug('Completing lifecycle action for %s with %s', instance_id, result)
+        # the activity of this instance will change from now on
+        self.invalidate_activities(group_name)
         try:
             _ = self.client.complete_lifecycle_action(
                 LifecycleHookName = hook_name,
@@ -456,40 +865,83 @@ class AutoscalingClient(BaseClient):
 
 
     def get_autoscaling_activity(self, group, action, instance_id):
-        activities = self.client.describe_scaling_activities(
-            AutoScalingGroupName = group
-        )['Activities']
+        is_launching = action == "is launching" or action == "has launched"
 
-        if action == "is launching" or action == "has launched":
-            desc = "Launching a new EC2 instance: " + instance_id
-        else:
-            desc = "Terminating EC2 instance: " + instance_id
+        return self.get_activity(group, is_launching, instance_id)
 
-        for activity in activities:
-            if activity.get('Description') == desc:
-                return activity
 
-        return { }
+    def get_activity(self, group, is_launching, instance_id):
+        """
+        Get the latest scaling activity for an instance. Activities are loaded once per group and invocation.
 
+        :type group: str
+        :param group: The autoscaling group name
+        :type is_launching: bool
+        :param is_launching: Whether to look up the launching or the terminating activity
+        :type instance_id: str
+        :param instance_id: The instance id
 
-    def get_activity(self, group, is_launching, instance_id):
-        activities = self.client.describe_scaling_activities(
-            AutoScalingGroupName = group
-        )['Activities']
+        :rtype: dict
+        :return: The activity or an empty dict if no activity could be found
+        """
+        with self.lock:
+            index = self.activities.get(group, None)
+            if index is None:
+                index = self.__load_activities(group)
+                self.activities.update({ group: index })
 
-        if is_launching:
-            desc = "Launching a new EC2 instance: " + instance_id
-        else:
-            desc = "Terminating EC2 instance: " + instance_id
+        return index.get((instance_id, is_launching), { })
 
-        for activity in activities:
-            if activity.get('Description') == desc:
-                return activity
 
-        return { }
+    def invalidate_activities(self, group: str):
+        with self.lock:
+            self.activities.pop(group, None)
+
+
+    def __load_activities(self, group: str) -> dict:
+        self.logger.debug('Autoscaling: Loading scaling activities of group %s', group)
+        index = { }
+        pages = self.client.get_paginator('describe_scaling_activities').paginate(
+            AutoScalingGroupName = group,
+            PaginationConfig = { 'PageSize': 100 }
+        )
+        for page in pages:
+            for activity in page.get('Activities', []):
+                description = activity.get('Description', '')
+                if description.startswith(self.__LAUNCHING):
+                    key = (description[len(self.__LAUNCHING):], True)
+                elif description.startswith(self.__TERMINATING):
+                    key = (description[len(self.__TERMINATING):], False)
+                else:
+                    continue
+
+                # activities are returned latest first
+                if key not in index:
+                    index.update({ key: activity })
+
+        return index
+
+
+    def is_activity_complete(self, group: str, is_launching: bool, instance_id: str) -> bool:
+        """
+        Check the progress of the latest scaling activity of an instance. Activities are loaded again for each
+        check.
+
+        :rtype: bool
+        :return: Whether the activity is complete. True if no activity could be found.
+        """
+        self.invalidate_activities(group)
+        activity = self.get_activity(group, is_launching, instance_id)
+        if activity == { }:
+            self.logger.warning('Autoscaling: Activity not found for %s in %s', instance_id, group)
+            return True
+
+        return activity.get('Progress', 0) == 100
 
 
     def wait_for_activity_to_complete(self, group: str, is_launching: bool, instance_id: str):
+        from botocore.exceptions import WaiterError
+
         self.logger.debug('Autoscaling: Waiting for autoscaling activity to complete.')
 
         try:
@@ -505,13 +957,17 @@ class DynamoDbClient(BaseClient):
     """
     Proxy for get_item, delete_item, scan etc. calls to the dynamodb service client
     Parameters and returned data is transfomed from/to dynamodb data structure automatically
+
+    :type backoff: Backoff
+    :param backoff: The default backoff of wait methods
     """
 
 
-    def __init__(self, client: BotoClient, waiters: CustomWaiters, logging: Logging, *args):
+    def __init__(self, client: 'BotoClient', waiters: CustomWaiters, logging: Logging, *args):
         super().__init__(client, waiters, logging)
         state_table, = args
         self.state_table = state_table
+        self.backoff = Backoff()
 
 
     def get_state_table(self) -> str:
@@ -526,26 +982,127 @@ class DynamoDbClient(BaseClient):
         return converted_values
 
 
-    def scan(self, expression: str, attribute_values: dict):
-        converted_items = []
+    def scan(self, expression: str, attribute_values: dict, segments: int = 1):
+        """
+        Scan the state table. Pages are fetched following LastEvaluatedKey and converted items are yielded as
+        they arrive, so the result is never held in memory as a whole.
+
+        :type expression: str
+        :param expression: The filter expression
+        :type attribute_values: dict
+        :param attribute_values: The expression attribute values
+        :type segments: int
+        :param segments: The number of segments to scan in parallel. 1 scans sequentially.
+
+        :rtype: generator
+        :return: The converted items
+        """
+        parameters = {
+            'TableName': self.state_table,
+            'FilterExpression': expression,
+            'ExpressionAttributeValues': self.convert_expression_attribute_values(attribute_values)
+        }
+
+        if segments > 1:
+            return self.__scan_parallel(parameters, segments)
+
+        return self.__fetch_pages('scan', parameters)
 
-        items = self.client.scan(
-            TableName = self.state_table,
-            FilterExpression = expression,
-            ExpressionAttributeValues = self.convert_expression_attribute_values(attribute_values)
-        ).get('Items')
 
-        for item in items:
-            converted_items.append(self.__convert_dynamodb_map_to_dict(item))
+    def query(self, key_expression: str, attribute_values: dict, filter_expression: str = None,
+              index_name: str = None):
+        """
+        Query the state table or one of its indexes. Pages are fetched following LastEvaluatedKey and converted
+        items are yielded as they arrive.
+
+        :type key_expression: str
+        :param key_expression: The key condition expression
+        :type attribute_values: dict
+        :param attribute_values: The expression attribute values of the key condition and filter expressions
+        :type filter_expression: str
+        :param filter_expression: An optional filter expression. Must not contain key attributes.
+        :type index_name: str
+        :param index_name: An optional secondary index to query
+
+        :rtype: generator
+        :return: The converted items
+        """
+        parameters = {
+            'TableName': self.state_table,
+            'KeyConditionExpression': key_expression,
+            'ExpressionAttributeValues': self.convert_expression_attribute_values(attribute_values)
+        }
+
+        if filter_expression is not None:
+            parameters.update({ 'FilterExpression': filter_expression })
+
+        if index_name is not None:
+            parameters.update({ 'IndexName': index_name })
+
+        return self.__fetch_pages('query', parameters)
+
 
-        return converted_items
+    def __fetch_pages(self, operation: str, parameters: dict):
+        while True:
+            response = getattr(self.client, operation)(**parameters)
+            for item in response.get('Items', []):
+                yield self.__convert_dynamodb_map_to_dict(item)
 
+            last_key = response.get('LastEvaluatedKey', None)
+            if last_key is None:
+                return
 
-    def get_item(self, id):
+            parameters = dict(parameters, ExclusiveStartKey = last_key)
+
+
+    def __scan_parallel(self, parameters: dict, segments: int):
+        self.logger.debug('Scanning %s in %s parallel segments', self.state_table, segments)
+        items = Queue()
+        stop = Event()
+        ledger = CallLedger.get_current()
+
+
+        def scan_segment(segment: int):
+            if ledger is not None:
+                ledger.activate()
+            try:
+                segment_parameters = dict(parameters, Segment = segment, TotalSegments = segments)
+                for item in self.__fetch_pages('scan', segment_parameters):
+                    if stop.is_set():
+                        break
+                    items.put(item)
+            except Exception as e:
+                items.put(e)
+            finally:
+                # signal the end of this segment
+                items.put(None)
+
+
+        with ThreadPoolExecutor(max_workers = segments) as executor:
+            for segment in range(segments):
+                executor.submit(scan_segment, segment)
+
+            try:
+                running = segments
+                while running > 0:
+                    item = items.get()
+                    if item is None:
+                        running -= 1
+                    elif isinstance(item, Exception):
+                        raise item
+                    else:
+                        yield item
+            finally:
+                # stop the remaining segments if the consumer stopped early or a segment failed
+                stop.set()
+
+
+    def get_item(self, id, consistent: bool = False):
         try:
             item = self.client.get_item(
                 TableName = self.state_table,
-                Key = self.__build_dynamodb_key(id)
+                Key = self.__build_dynamodb_key(id),
+                ConsistentRead = consistent
             ).get('Item')
         except Exception as e:
             self.logger.warning('Could not get item %s; %s', id, repr(e))
@@ -573,19 +1130,43 @@ class DynamoDbClient(BaseClient):
         )
 
 
-    def update_item(self, id: str, expression: str, values: dict = None):
+    def update_item(self, id: str, expression: str, values: dict = None, names: dict = None, condition: str = None,
+                    return_values: str = None) -> dict:
+        """
+        :type names: dict
+        :param names: Expression attribute names
+        :type condition: str
+        :param condition: A condition expression the update is applied on only
+        :type return_values: str
+        :param return_values: Which values to return, e.g. ALL_NEW
+
+        :rtype: dict
+        :return: The converted attributes, if return_values is set
+        """
         self.logger.info('Updating item %s with %s', id, values)
 
         if type(values) is dict:
             for k, v in values.items():
                 values.update({ k: self.__build_dynamodb_value(v) })
 
-        _ = self.client.update_item(
-            TableName = self.state_table,
-            Key = self.__build_dynamodb_key(id),
-            UpdateExpression = expression,
-            ExpressionAttributeValues = values
-        )
+        parameters = {
+            'TableName': self.state_table,
+            'Key': self.__build_dynamodb_key(id),
+            'UpdateExpression': expression,
+            'ExpressionAttributeValues': values
+        }
+        if names is not None:
+            parameters.update({ 'ExpressionAttributeNames': names })
+        if condition is not None:
+            parameters.update({ 'ConditionExpression': condition })
+        if return_values is not None:
+            parameters.update({ 'ReturnValues': return_values })
+
+        response = self.client.update_item(**parameters)
+        if return_values is None:
+            return { }
+
+        return self.__convert_dynamodb_map_to_dict(response.get('Attributes', { }))
 
 
     def unset(self, id: str, properties: list):
@@ -669,9 +1250,6 @@ class DynamoDbClient(BaseClient):
         :rtype: dict
         :return: The converted dynamodb map
         """
-        if log:
-            self.logger.debug('Converting dict to dynamodb item: %s', data)
-
         dynamodb_map = { }
         for key, value in data.items():
             value = self.__build_dynamodb_value(value, False)
@@ -679,7 +1257,7 @@ class DynamoDbClient(BaseClient):
                 dynamodb_map.update({ key: value })
 
         if log:
-            self.logger.debug('Result: %s', dynamodb_map)
+            self.logger.debug('Converted dict to dynamodb item: %s', dynamodb_map)
 
         return dynamodb_map
 
@@ -696,9 +1274,6 @@ class DynamoDbClient(BaseClient):
         :rtype: dict
         :return: The converted data
         """
-        if log:
-            self.logger.debug('Converting dynamodb item to dict: %s', dynamodb_map)
-
         data = { }
         for key, value in dynamodb_map.items():
             if value.get('S', None) is not None:
@@ -709,62 +1284,435 @@ class DynamoDbClient(BaseClient):
                 self.logger.warning('Cannot convert %s. Ignoring. Valid types are M,S. Value: %s', key, value)
 
         if log:
-            self.logger.debug('Result: %s', data)
+            self.logger.debug('Converted dynamodb item to dict: %s', data)
 
         return data
 
 
-    def wait_for_scan_count_is(self, size: int, expression: str, attribute_values: dict):
+    def wait_for_item(self, id: str, predicate, backoff: Backoff = None) -> dict:
+        """
+        Wait for an item to satisfy a predicate. The item is fetched by key with consistent reads.
+
+        :type id: str
+        :param id: The key of the item
+        :type predicate: callable
+        :param predicate: Receives the item (an empty dict if it does not exist) and returns whether waiting is
+                          complete
+        :type backoff: Backoff
+        :param backoff: The backoff configuration
+
+        :rtype: dict
+        :return: The item
+        """
+        if backoff is None:
+            backoff = self.backoff
+        self.logger.debug('Waiting for item %s.', id)
+
+        return backoff.wait(lambda: self.get_item(id, True), predicate, 'item %s' % id)
+
+
+    def wait_for_scan_count_is(self, size: int, expression: str, attribute_values: dict, backoff: Backoff = None):
+        """
+        Wait for a scan to return a number of items. Scans read the whole table, use wait_for_item() if the key
+        is known.
+        """
         self.logger.debug('Waiting for scan %s to return %s items.', expression, size)
-        self.waiters.get_dynamodb_scan_count_is(size).wait(
-            TableName = self.get_state_table(),
-            FilterExpression = expression,
-            ExpressionAttributeValues = self.convert_expression_attribute_values(attribute_values)
-        )
+        self.__wait_for_scan(expression, attribute_values, lambda count: count == size, backoff)
 
 
-    def wait_for_scan_count_gt0(self, expression: str, attribute_values: dict):
+    def wait_for_scan_count_gt0(self, expression: str, attribute_values: dict, backoff: Backoff = None):
+        """
+        Wait for a scan to return at least one item. Scans read the whole table, use wait_for_item() if the key
+        is known.
+        """
         self.logger.debug('Waiting for scan %s to return at leat one item.', expression)
-        self.waiters.get('ScanCountGt0').wait(
-            TableName = self.get_state_table(),
-            FilterExpression = expression,
-            ExpressionAttributeValues = self.convert_expression_attribute_values(attribute_values)
+        self.__wait_for_scan(expression, attribute_values, lambda count: count > 0, backoff)
+
+
+    def __wait_for_scan(self, expression: str, attribute_values: dict, predicate, backoff: Backoff = None):
+        if backoff is None:
+            backoff = self.backoff
+
+        backoff.wait(
+            lambda: sum(1 for _ in self.scan(expression, attribute_values)),
+            predicate,
+            'scan %s' % expression
         )
 
 
 class Route53Client(BaseClient):
-    dns_change_set = []
+    """
+    Collects record changes and applies them with as few calls as possible. Changes are merged per zone, name and
+    type, so only the last change of a record is sent, and split into batches at the limits of
+    change_resource_record_sets. Changes are applied without waiting by default. The returned change ids can be
+    waited for later, e.g. after other work of the invocation, with wait_for_changes().
+
+    Before changes are applied, they are compared with the current records of the zone. Changes that would not modify
+    a record are not sent, so an invocation that does not change the dns costs no write and no wait.
+
+    :type max_records: int
+    :param max_records: The maximum number of record values per request. Values of UPSERT changes count twice.
+    :type max_characters: int
+    :param max_characters: The maximum number of characters of all record values per request. Values of UPSERT
+        changes count twice.
+    :type max_changes: int
+    :param max_changes: The maximum number of changes per request
+    :type change_sets: dict
+    :param change_sets: Changes by zone id and (name, type). Changes without a zone are stored with zone None and
+        are applied to the zone passed to apply_dns_change_set(). Changes, change ids and records are kept for the
+        invocation of the current thread, so invocations processed in parallel do not apply each other's changes.
+    :type changes: list
+    :param changes: The ids of the changes applied in this invocation
+    :type diff_changes: bool
+    :param diff_changes: Compare changes with the records of the zone and only apply the differences. Off by default,
+        as every changed record costs one list_resource_record_sets call per invocation
+    :type records: dict
+    :param records: The record sets of the names changed in this invocation by zone id and (name, type). Records
+        that do not exist are None. Each record is loaded once per invocation and updated with every applied
+        change.
+    """
+
+    CREATE = 'CREATE'
+    DELETE = 'DELETE'
+    UPSERT = 'UPSERT'
 
+    max_records = 1000
+    max_characters = 32000
+    max_changes = 1000
+    diff_changes = False
 
-    def reset_dns_change_set(self):
-        self.dns_change_set = []
 
+    def __init__(self, client: 'BotoClient', waiters: CustomWaiters, logging: Logging, *args):
+        super().__init__(client, waiters, logging)
+        self.lock = Lock()
+
+
+    @property
+    def change_sets(self) -> dict:
+        return self.get_local('change_sets', dict)
+
+
+    @change_sets.setter
+    def change_sets(self, change_sets: dict):
+        self.local.change_sets = change_sets
+
+
+    @property
+    def changes(self) -> list:
+        return self.get_local('changes', list)
+
+
+    @changes.setter
+    def changes(self, changes: list):
+        self.local.changes = changes
+
+
+    @property
+    def records(self) -> dict:
+        return self.get_local('records', dict)
+
+
+    @records.setter
+    def records(self, records: dict):
+        self.local.records = records
+
+
+    @property
+    def dns_change_set(self) -> list:
+        """
+        :rtype: list
+        :return: The pending changes of all zones
+        """
+        with self.lock:
+            return [change for changes in self.change_sets.values() for change in changes.values()]
+
+
+    @dns_change_set.setter
+    def dns_change_set(self, changes: list):
+        """
+        Replace the pending changes of all zones, e.g. with [] to drop them. The changes are applied to the zone
+        passed to apply_dns_change_set().
+
+        :type changes: list
+        :param changes: Changes in the format of change_resource_record_sets
+        """
+        with self.lock:
+            self.change_sets = { }
+            for change in changes:
+                self.__merge(self.change_sets.setdefault(None, OrderedDict()), change)
+
+
+    def reset_dns_change_set(self, zone_id: str = None):
+        """
+        Drop pending changes.
+
+        :type zone_id: str
+        :param zone_id: Only drop the changes of this zone and the changes without a zone
+        """
+        with self.lock:
+            if zone_id is None:
+                self.change_sets = { }
+            else:
+                self.change_sets.pop(zone_id, None)
+                self.change_sets.pop(None, None)
 
-    def add_dns_change_set(self, name: str, records: list, ttl: int, action: str = 'UPSERT'):
+
+    def add_dns_change_set(self, name: str, records: list, ttl: int, action: str = UPSERT, zone_id: str = None,
+                           record_type: str = 'A'):
+        """
+        Add a change. A pending change of the same record is replaced: CREATE followed by DELETE cancels both and
+        DELETE followed by CREATE or UPSERT becomes an UPSERT.
+
+        :type records: list
+        :param records: Resource records, e.g. [{ 'Value': '10.0.0.1' }]
+        :type zone_id: str
+        :param zone_id: The hosted zone of the record. Defaults to the zone passed to apply_dns_change_set().
+        """
         self.logger.info('Add dns entry %s with %s to change set.', name, records)
-        self.dns_change_set.append({
+        change = {
             'Action': action,
             'ResourceRecordSet': {
                 'Name': name,
-                'Type': 'A',
+                'Type': record_type,
                 'TTL': ttl,
                 'ResourceRecords': records
             }
-        })
+        }
 
+        with self.lock:
+            self.__merge(self.change_sets.setdefault(zone_id, OrderedDict()), change)
 
-    def apply_dns_change_set(self, zone_id):
-        self.logger.debug("Updating DNS records in zone %s: %s", zone_id, self.dns_change_set)
-        _ = self.client.change_resource_record_sets(
-            HostedZoneId = zone_id,
-            ChangeBatch = { 'Changes': self.dns_change_set }
-        )
-        self.reset_dns_change_set()
+
+    def get_change_batches(self, changes: list) -> list:
+        """
+        Split changes at the limits of a single request.
+
+        :type changes: list
+        :param changes: Changes in order
+
+        :rtype: list
+        :return: Lists of changes
+        """
+        batches = []
+        batch, records, characters = [], 0, 0
+        for change in changes:
+            weight = 2 if change.get('Action') == self.UPSERT else 1
+            values = change.get('ResourceRecordSet').get('ResourceRecords', [])
+            change_records = weight * len(values)
+            change_characters = weight * sum([len(str(value.get('Value', ''))) for value in values])
+            if len(batch) > 0 and (
+                len(batch) >= self.max_changes
+                or records + change_records > self.max_records
+                or characters + change_characters > self.max_characters
+            ):
+                batches.append(batch)
+                batch, records, characters = [], 0, 0
+            batch.append(change)
+            records += change_records
+            characters += change_characters
+
+        if len(batch) > 0:
+            batches.append(batch)
+
+        return batches
+
+
+    def apply_dns_change_set(self, zone_id, wait: bool = False) -> list:
+        """
+        Apply the pending changes of a zone and the pending changes without a zone, with one call per batch.
+
+        :type zone_id: str
+        :param zone_id: The hosted zone id
+        :type wait: bool
+        :param wait: Wait until the changes are in sync on all route53 dns servers
+
+        :rtype: list
+        :return: The change ids
+        """
+        from botocore.exceptions import ClientError
+
+        with self.lock:
+            changes = self.change_sets.pop(None, OrderedDict())
+            for change in self.change_sets.pop(zone_id, OrderedDict()).values():
+                self.__merge(changes, change)
+
+        changes = list(changes.values())
+        if self.diff_changes and len(changes) > 0:
+            changes = self.get_differences(zone_id, changes)
+
+        change_ids = []
+        batches = self.get_change_batches(changes)
+        for index, batch in enumerate(batches):
+            self.logger.debug("Updating DNS records in zone %s: %s", zone_id, batch)
+            try:
+                response = self.client.change_resource_record_sets(
+                    HostedZoneId = zone_id,
+                    ChangeBatch = { 'Changes': batch }
+                )
+            except Exception as e:
+                # keep the changes that have not been applied, unless they have been replaced in the meantime
+                with self.lock:
+                    pending = self.change_sets.setdefault(zone_id, OrderedDict())
+                    for change in [change for batch in batches[index:] for change in batch]:
+                        pending.setdefault(self.__get_key(change), change)
+                if isinstance(e, ClientError) and e.response.get('Error', { }).get('Code') == 'InvalidChangeBatch':
+                    # the records of the zone are not what we think they are
+                    self.invalidate_records(zone_id)
+                raise
+            change_ids.append(response.get('ChangeInfo').get('Id'))
+            with self.lock:
+                self.changes.append(change_ids[-1])
+                view = self.records.get(zone_id, None)
+                if view is not None:
+                    for change in batch:
+                        record_set = change.get('ResourceRecordSet')
+                        view[self.__get_key(change)] = None if change.get('Action') == self.DELETE else record_set
+
+        if wait:
+            self.wait_for_changes(change_ids)
+
+        return change_ids
+
+
+    def get_record_sets(self, zone_id: str, keys: list) -> dict:
+        """
+        Load record sets once per invocation. Each record is looked up with a single call that starts listing the
+        zone at its name and type, so the cost does not grow with the size of the zone.
+
+        :type zone_id: str
+        :param zone_id: The hosted zone id
+        :type keys: list
+        :param keys: Tuples of lower case name without trailing dot and type
+
+        :rtype: dict
+        :return: Record sets by (name, type). Records that do not exist are None.
+        """
+        with self.lock:
+            view = self.records.get(zone_id, { })
+            missing = [key for key in keys if key not in view]
+
+        if len(missing) > 0:
+            loaded = { }
+            for key in missing:
+                response = self.client.list_resource_record_sets(
+                    HostedZoneId = zone_id,
+                    StartRecordName = key[0],
+                    StartRecordType = key[1],
+                    MaxItems = '1'
+                )
+                # the first record at or after the name and type, if any
+                record_sets = response.get('ResourceRecordSets', [])[:1]
+                loaded.update({ key: None })
+                for record_set in record_sets:
+                    if self.__get_key({ 'ResourceRecordSet': record_set }) == key:
+                        loaded.update({ key: record_set })
+
+            with self.lock:
+                view = self.records.setdefault(zone_id, { })
+                for key, record_set in loaded.items():
+                    # records changed while loading are already up to date
+                    view.setdefault(key, record_set)
+
+        with self.lock:
+            return { key: view.get(key) for key in keys }
+
+
+    def invalidate_records(self, zone_id: str = None):
+        """
+        :type zone_id: str
+        :param zone_id: Drop the record view of this zone. Defaults to all zones.
+        """
+        with self.lock:
+            if zone_id is None:
+                self.records = { }
+            else:
+                self.records.pop(zone_id, None)
+
+
+    def get_differences(self, zone_id: str, changes: list) -> list:
+        """
+        Compare changes with the records of a zone. Changes that would not modify a record are dropped and records
+        are deleted with their current values.
+
+        :type zone_id: str
+        :param zone_id: The hosted zone id
+        :type changes: list
+        :param changes: Changes in order
+
+        :rtype: list
+        :return: The changes that modify records
+        """
+        record_sets = self.get_record_sets(zone_id, [self.__get_key(change) for change in changes])
+        differences = []
+        for change in changes:
+            current = record_sets.get(self.__get_key(change))
+            if change.get('Action') == self.DELETE:
+                if current is None:
+                    self.logger.debug('Skipping deletion of %s, it does not exist.', change.get('ResourceRecordSet'))
+                    continue
+                change = dict(change, ResourceRecordSet = current)
+            elif self.__is_equal(current, change.get('ResourceRecordSet')):
+                self.logger.debug('Skipping change of %s, it is up to date.', change.get('ResourceRecordSet'))
+                continue
+            differences.append(change)
+
+        return differences
+
+
+    def wait_for_changes(self, change_ids: list = None):
+        """
+        Wait for changes to be in sync. The changes are polled interleaved.
+
+        :type change_ids: list
+        :param change_ids: The change ids. Defaults to all changes applied in this invocation.
+        """
+        with self.lock:
+            change_ids = list(self.changes) if change_ids is None else change_ids
+
+        if len(change_ids) == 0:
+            return
+
+        waiter = self.waiters.get('ChangeInSync')
+        self.waiters.wait_all([(waiter, { 'Id': change_id }) for change_id in change_ids])
+
+        with self.lock:
+            self.changes = [change_id for change_id in self.changes if change_id not in change_ids]
+
+
+    def __merge(self, changes: OrderedDict, change: dict):
+        key = self.__get_key(change)
+        pending = changes.pop(key, None)
+        if pending is not None:
+            if pending.get('Action') == self.CREATE and change.get('Action') == self.DELETE:
+                self.logger.debug('Dropping creation and deletion of %s.', key[0])
+                return
+            if pending.get('Action') == self.DELETE and change.get('Action') != self.DELETE:
+                change = dict(change, Action = self.UPSERT)
+        changes[key] = change
+
+
+    @classmethod
+    def __get_key(cls, change: dict) -> tuple:
+        record = change.get('ResourceRecordSet')
+        # route53 returns names with a trailing dot and an escaped wildcard
+        name = record.get('Name').rstrip('.').lower().replace('\\052', '*')
+
+        return name, record.get('Type')
+
+
+    @classmethod
+    def __is_equal(cls, current: dict, record_set: dict) -> bool:
+        if current is None or 'AliasTarget' in current or 'AliasTarget' in record_set:
+            return False
+
+        return current.get('TTL') == record_set.get('TTL') and sorted(
+            [str(record.get('Value')) for record in current.get('ResourceRecords', [])]
+        ) == sorted([str(record.get('Value')) for record in record_set.get('ResourceRecords', [])])
 
 
 class SnsClient(BaseClient):
 
-    def __init__(self, client: BotoClient, waiters: CustomWaiters, logging: Logging, *args):
+    def __init__(self, client: 'BotoClient', waiters: CustomWaiters, logging: Logging, *args):
         super().__init__(client, waiters, logging)
         client_eu_west, topic_arn, account, env = args
         self.client_eu_west = client_eu_west
@@ -798,7 +1746,42 @@ class SnsClient(BaseClient):
         self.publish(subject, message, region)
 
 
+    def publish_digest(self, title, reports: list, activities: list, dropped: int = 0, region = "eu-central-1"):
+        """
+        Publish the reports and autoscaling activities of an invocation with a single message.
+
+        :type title: str
+        :param title: The title of the digest, e.g. the event
+        :type reports: list
+        :param reports: Reports with status, subject and detail
+        :type activities: list
+        :param activities: Autoscaling activities
+        :type dropped: int
+        :param dropped: The number of reports that have been dropped
+        """
+        status = 'INFO'
+        if len([report for report in reports if report.get('status') == 'ERROR']) > 0:
+            status = 'ERROR'
+        elif len(activities) > 0 and activities[-1].get('StatusCode') == 'Successful':
+            status = 'SUCCESS'
+
+        subject = self.formatter.format("%s : %s in %s", [status, title, self.env])
+        result = self.formatter.to_str({
+            'reports': reports,
+            'activities': activities,
+            'dropped': dropped
+        })
+        message = self.formatter.to_str({
+            'default': result,
+            'sms': subject,
+            'email': subject + ":\n\n" + result
+        })
+        self.publish(subject, message, region)
+
+
     def publish_error(self, exception, action, region = "eu-central-1"):
+        from boltons.tbutils import ExceptionInfo
+
         subject = self.formatter.format(
             'ERROR : while performing %s in environment %s: %s',
             [repr(action), self.env, repr(exception)]
@@ -826,41 +1809,439 @@ class SnsClient(BaseClient):
 
 
 class SsmClient(BaseClient):
+    """
+    :type chunk_size: int
+    :param chunk_size: The maximum number of instances per command. The api accepts up to 50.
+    :type agent_backoff: Backoff
+    :param agent_backoff: The backoff to poll the agents of instances with before dispatching a command
+    :type command_backoff: Backoff
+    :param command_backoff: The backoff to poll the invocations of a command with
+    :type agent_ttl: float
+    :param agent_ttl: The seconds an agent is known to be online after it has been seen online
+    :type agents: dict
+    :param agents: The time.monotonic() value until which an agent is known to be online by instance id. Clients
+                   are reused across invocations, so are these entries.
+    """
+    chunk_size = 50
+    agent_backoff = Backoff(delay = 2, max_delay = 10, timeout = 200)
+    command_backoff = Backoff(delay = 0.5, max_delay = 2, timeout = 60)
+    agent_ttl = 60
+    agents = None
+
+    FINAL_STATUSES = ['Success', 'Cancelled', 'TimedOut', 'Failed']
+
+
+    def __init__(self, client: 'BotoClient', waiters: CustomWaiters, logging: Logging, *args):
+        super().__init__(client, waiters, logging)
+        self.agents = { }
+        self.lock = Lock()
+
 
     def send_command(self, instance_ids, comment, commands, timeout_in_seconds = 60):
+        """
+        Wait for the agents of all instances and send a single command. Use dispatch_command() for large or
+        rolling target sets.
+
+        :rtype: str
+        :return: The command id
+        """
         if type(instance_ids) is not list:
             instance_ids = [instance_ids]
 
         self.logger.debug('Sending command "%s" to instance %s: %s', comment, instance_ids, commands)
+        self.wait_for_agents(instance_ids)
+
+        return self.__send(instance_ids, comment, commands, timeout_in_seconds)
+
+
+    def wait_for_agents(self, instance_ids: list):
+        """
+        Wait for the agents of all instances to be online.
+
+        :raises botocore.exceptions.WaiterError: If an agent is inactive or not online in time
+        """
+        from botocore.exceptions import WaiterError
+
+
+
+        def is_known(statuses: dict) -> bool:
+            return all([statuses.get(instance_id) in ['Online', 'Inactive'] for instance_id in instance_ids])
+
 
         self.logger.debug('Waiting for ssm agent to become ready.')
-        # can be replaced when https://github.com/boto/botocore/pull/1502 will be accepted
-        # waiter = ssm.get_waiter['AgentIsOnline']
-        self.waiters.get('AgentIsOnline').wait(
-            Filters = [{ 'Key': 'InstanceIds', 'Values': instance_ids }]
-        )
+        try:
+            statuses = self.agent_backoff.wait(
+                lambda: self.get_agent_statuses(instance_ids),
+                is_known,
+                'ssm agents of %s' % ', '.join(instance_ids)
+            )
+        except WaitTimeoutError as e:
+            raise WaiterError(name = 'AgentIsOnline', reason = e.get_message(), last_response = { })
 
-        command_id = self.client.send_command(
-            InstanceIds = instance_ids,
-            DocumentName = 'AWS-RunShellScript',
-            Comment = self.logger.name + ' : ' + comment,
-            Parameters = {
+        failed = [instance_id for instance_id in instance_ids if statuses.get(instance_id) != 'Online']
+        self.__check_errors(failed, 0, statuses)
+
+
+    def dispatch_command(self, instance_ids, comment, commands, timeout_in_seconds = 60, max_concurrency = None,
+                         max_errors = None, on_dispatch = None, on_failure = None, deadline: float = None) -> list:
+        """
+        Send a command to instances as soon as their agents are online. The agents of all pending instances are
+        checked with one describe call per chunk, instances that are ready are dispatched immediately in chunks of
+        chunk_size while the others are polled again.
+
+        :type instance_ids: list
+        :param instance_ids: The target instances
+        :type max_concurrency: str
+        :param max_concurrency: The number (e.g. '10') or percentage (e.g. '25%') of instances a command runs on
+                                concurrently, see the MaxConcurrency parameter of the api
+        :type max_errors: str
+        :param max_errors: The number or percentage of errors tolerated. Applies to agents that do not come online
+                           before the first command has been sent and is passed as MaxErrors to each command.
+                           Defaults to no errors.
+        :type on_dispatch: callable
+        :param on_dispatch: Called with the command id and the instance ids of each command right after it has
+                            been sent, e.g. to register the command before its status events arrive
+        :type on_failure: callable
+        :param on_failure: Called with the ids of instances the command is not sent to, because their agents are
+                           inactive or not online in time, as soon as they are known. No status events arrive for
+                           these instances.
+        :type deadline: float
+        :param deadline: A time.monotonic() value to stop waiting for agents at, in addition to the timeout of
+                         agent_backoff, e.g. the end of the invocation
+
+        :rtype: list
+        :return: The command ids
+        :raises botocore.exceptions.WaiterError: If more agents than max_errors allows are not online, before any
+                                                 command has been sent. Once a command is running, agents that do not
+                                                 come online are only passed to on_failure.
+        """
+        if type(instance_ids) is not list:
+            instance_ids = [instance_ids]
+
+        self.logger.debug('Dispatching command "%s" to %s instances: %s', comment, len(instance_ids), commands)
+        error_limit = self.get_error_limit(max_errors, len(instance_ids))
+        deadline = self.agent_backoff.get_deadline(time.monotonic(), deadline)
+        pending = list(instance_ids)
+        failed = []
+        command_ids = []
+        attempt = 0
+        while len(pending) > 0:
+            attempt += 1
+            statuses = self.get_agent_statuses(pending)
+            ready = [instance_id for instance_id in pending if statuses.get(instance_id) == 'Online']
+            failures = [instance_id for instance_id in pending if statuses.get(instance_id) == 'Inactive']
+            pending = [
+                instance_id for instance_id in pending if statuses.get(instance_id) not in ['Online', 'Inactive']
+            ]
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                failures.extend(pending)
+                pending = []
+            failed.extend(failures)
+            if len(command_ids) == 0:
+                # sent commands complete through their status events, failing now would handle the instances twice
+                self.__check_errors(failed, error_limit, statuses)
+            if len(failures) > 0 and on_failure is not None:
+                on_failure(failures)
+
+            for index in range(0, len(ready), self.chunk_size):
+                chunk = ready[index:index + self.chunk_size]
+                command_id = self.__send(chunk, comment, commands, timeout_in_seconds, max_concurrency, max_errors)
+                command_ids.append(command_id)
+                if on_dispatch is not None:
+                    on_dispatch(command_id, chunk)
+
+            if len(pending) > 0:
+                self.logger.debug('Waiting for the ssm agents of %s instances.', len(pending))
+                time.sleep(min(self.agent_backoff.get_delay(attempt), max(remaining, 0)))
+
+        if len(failed) > 0:
+            self.logger.warning('Skipped instances %s, their ssm agents are not online.', failed)
+
+        return command_ids
+
+
+    def get_command_results(self, command_id: str) -> dict:
+        """
+        :rtype: dict
+        :return: The status of the command by instance id
+        """
+        results = { }
+        for page in self.client.get_paginator('list_command_invocations').paginate(CommandId = command_id):
+            for invocation in page.get('CommandInvocations', []):
+                results.update({ invocation.get('InstanceId'): invocation.get('Status') })
+
+        return results
+
+
+    def wait_for_command(self, command_id: str, instance_ids: list, deadline: float = None):
+        """
+        Poll the invocations of a command until it has finished on all instances.
+
+        :type deadline: float
+        :param deadline: A time.monotonic() value to give up at, in addition to the timeout of command_backoff
+
+        :rtype: dict
+        :return: The status of the command by instance id or None, if it has not finished in time
+        """
+        try:
+            return self.command_backoff.wait(
+                lambda: self.get_command_results(command_id),
+                lambda results: all([results.get(instance_id) in self.FINAL_STATUSES for instance_id in instance_ids]),
+                'command %s' % command_id,
+                deadline
+            )
+        except WaitTimeoutError:
+            self.logger.debug('Command %s has not finished in time.', command_id)
+            return None
+
+
+    def get_agent_statuses(self, instance_ids: list) -> dict:
+        """
+        Agents seen online within agent_ttl are not checked again. The others are checked with one describe call
+        per chunk.
+
+        :rtype: dict
+        :return: The ping status of the agent by instance id. Instances without agent are missing.
+        """
+        now = time.monotonic()
+        statuses = { }
+        unknown = []
+        with self.lock:
+            for instance_id in instance_ids:
+                if self.agents.get(instance_id, 0) > now:
+                    statuses.update({ instance_id: 'Online' })
+                else:
+                    unknown.append(instance_id)
+
+        for index in range(0, len(unknown), self.chunk_size):
+            pages = self.client.get_paginator('describe_instance_information').paginate(
+                Filters = [{ 'Key': 'InstanceIds', 'Values': unknown[index:index + self.chunk_size] }]
+            )
+            for page in pages:
+                for info in page.get('InstanceInformationList', []):
+                    statuses.update({ info.get('InstanceId'): info.get('PingStatus') })
+
+        with self.lock:
+            for instance_id in unknown:
+                if statuses.get(instance_id) == 'Online':
+                    self.agents.update({ instance_id: now + self.agent_ttl })
+                else:
+                    self.agents.pop(instance_id, None)
+
+        return statuses
+
+
+    def invalidate_agents(self, instance_ids: list):
+        """
+        Check the agents of these instances again before the next command.
+        """
+        with self.lock:
+            for instance_id in instance_ids:
+                self.agents.pop(instance_id, None)
+
+
+    @classmethod
+    def get_error_limit(cls, max_errors, total: int) -> int:
+        """
+        :type max_errors: str
+        :param max_errors: A number or a percentage like '10%' or None
+        :type total: int
+        :param total: The number of instances
+
+        :rtype: int
+        :return: The number of errors tolerated
+        """
+        if max_errors is None:
+            return 0
+
+        max_errors = str(max_errors)
+        if max_errors.endswith('%'):
+            return int(total * float(max_errors[:-1]) / 100)
+
+        return int(max_errors)
+
+
+    def __check_errors(self, failed: list, error_limit: int, statuses: dict):
+        from botocore.exceptions import WaiterError
+
+        if len(failed) > error_limit:
+            raise WaiterError(
+                name = 'AgentIsOnline',
+                reason = 'The ssm agents of %s are not online, %s errors are allowed' % (
+                    ', '.join(failed),
+                    error_limit
+                ),
+                last_response = { 'InstanceInformationList': [
+                    { 'InstanceId': instance_id, 'PingStatus': statuses.get(instance_id, 'Unknown') }
+                    for instance_id in failed
+                ] }
+            )
+
+
+    def __send(self, instance_ids: list, comment: str, commands: list, timeout_in_seconds, max_concurrency = None,
+               max_errors = None) -> str:
+        parameters = {
+            'InstanceIds': instance_ids,
+            'DocumentName': 'AWS-RunShellScript',
+            'Comment': self.logger.name + ' : ' + comment,
+            'Parameters': {
                 'commands': commands
             },
-            TimeoutSeconds = timeout_in_seconds
-        ).get('Command').get('CommandId')
+            'TimeoutSeconds': timeout_in_seconds
+        }
+        if max_concurrency is not None:
+            parameters.update({ 'MaxConcurrency': str(max_concurrency) })
+        if max_errors is not None:
+            parameters.update({ 'MaxErrors': str(max_errors) })
+
+        from botocore.exceptions import ClientError
+
+        try:
+            command_id = self.client.send_command(**parameters).get('Command').get('CommandId')
+        except ClientError as e:
+            if e.response.get('Error', { }).get('Code') == 'InvalidInstanceId':
+                # an agent went offline since it has been checked
+                self.invalidate_agents(instance_ids)
+            raise
         self.logger.debug('Command "%s" on instance %s is running: %s', comment, instance_ids, command_id)
 
         return command_id
 
 
 class SecretsmanagerClient(BaseClient):
+    """
+    Secret strings are cached per process by secret id and version stage for ttl seconds. A secret that is used
+    within refresh_margin seconds before it expires is refreshed on a background thread, while callers keep getting
+    the cached value. Concurrent callers of a secret that is not cached share one fetch.
+
+    Secret values are never logged, only secret ids and version stages.
+
+    :type ttl: float
+    :param ttl: The seconds a secret is cached
+    :type refresh_margin: float
+    :param refresh_margin: The seconds before expiry a secret is refreshed in the background
+    :type secrets: dict
+    :param secrets: Cached secrets by (secret id, version stage) with value, expiry and refresh state
+    :type generation: int
+    :param generation: Counts the invalidations. A fetch started before an invalidation is not cached.
+    """
 
-    def get_current_secret_string(self, secret_id):
-        self.logger.debug('Secretsmanager: Fetch secret: %s', secret_id)
-        secret = self.client.get_secret_value(SecretId=secret_id)
+    CURRENT = 'AWSCURRENT'
+
+    ttl = 300
+    refresh_margin = 60
+    secrets = None
+    generation = 0
+
+
+    def __init__(self, client: 'BotoClient', waiters: CustomWaiters, logging: Logging, *args):
+        super().__init__(client, waiters, logging)
+        self.secrets = { }
+        self.generation = 0
+        self.lock = Lock()
+        self.locks = { }
+
+
+    def get_current_secret_string(self, secret_id, version_stage: str = CURRENT) -> str:
+        """
+        :type secret_id: str
+        :param secret_id: The name or arn of the secret
+        :type version_stage: str
+        :param version_stage: The version stage of the secret
+
+        :rtype: str
+        :return: The secret string or an empty string if the secret has no string
+        """
+        key = (secret_id, version_stage)
+        secret = self.__get_cached(key)
+        if secret is not None:
+            return secret
+
+        with self.__get_lock(key):
+            # another caller may have fetched the secret in the meantime
+            secret = self.__get_cached(key)
+            if secret is not None:
+                return secret
+
+            return self.__fetch(key)
+
+
+    def invalidate_secrets(self, secret_id: str = None):
+        """
+        Drop cached secrets, e.g. after a secret has been rotated.
+
+        :type secret_id: str
+        :param secret_id: Only drop the versions of this secret. Defaults to all secrets.
+        """
+        with self.lock:
+            self.generation += 1
+            for key in list(self.secrets.keys()):
+                if secret_id is None or key[0] == secret_id:
+                    del self.secrets[key]
+
+
+    def __get_cached(self, key: tuple):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.secrets.get(key, None)
+            if entry is None or now >= entry.get('expires'):
+                return None
+
+            if now >= entry.get('expires') - self.refresh_margin and not entry.get('refreshing'):
+                entry['refreshing'] = True
+                # the refresh may outlast the invocation, its calls are not recorded in the invocation's ledger
+                Thread(
+                    target = self.__refresh,
+                    args = (key,),
+                    name = 'secret-refresh',
+                    daemon = True
+                ).start()
+
+            return entry.get('value')
+
+
+    def __get_lock(self, key: tuple) -> Lock:
+        with self.lock:
+            return self.locks.setdefault(key, Lock())
+
+
+    def __fetch(self, key: tuple) -> str:
+        secret_id, version_stage = key
+        self.logger.debug('Secretsmanager: Fetch secret %s in stage %s', secret_id, version_stage)
+        with self.lock:
+            generation = self.generation
+        secret = self.client.get_secret_value(SecretId = secret_id, VersionStage = version_stage)
         secret_string = secret.get("SecretString", "")
         if secret_string == "":
             self.logger.warning('Secretsmanager: Could not fetch secret: %s', secret_id)
+            return secret_string
+
+        with self.lock:
+            # the secret may have been rotated while it was fetched
+            if generation == self.generation:
+                self.secrets[key] = {
+                    'value': secret_string,
+                    'expires': time.monotonic() + self.ttl,
+                    'refreshing': False
+                }
 
         return secret_string
+
+
+    def __refresh(self, key: tuple):
+        from botocore.exceptions import ClientError
+
+        try:
+            with self.__get_lock(key):
+                self.__fetch(key)
+        except Exception as e:
+            # the cached value is used until it expires. Only log the error code, never a message or the response.
+            code = e.response.get('Error', { }).get('Code') if isinstance(e, ClientError) else e.__class__.__name__
+            self.logger.warning('Secretsmanager: Could not refresh secret %s: %s', key[0], code)
+        finally:
+            with self.lock:
+                entry = self.secrets.get(key, None)
+                if entry is not None:
+                    entry['refreshing'] = False
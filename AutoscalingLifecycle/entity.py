@@ -1,6 +1,7 @@
 from logging import Logger
 
 from .clients import DynamoDbClient
+from .clients import SsmClient
 from .exceptions import CommandNotFoundError
 
 
@@ -31,11 +32,69 @@ class Repositories(Repository):
 
 
 class CommandRepository(Repository):
+    """
+    Commands sent to one or more instances. SSM emits a status event per target instance. The result of each
+    target is recorded in the Results map of the command with an atomic update, the command completes once with
+    the event that reports the last target or that crosses the error limit.
+
+    A command sent in chunks is registered as a group covering all targets. Each chunk is registered as a command
+    that refers to its group, so the results of all chunks are recorded in the group and the error limit applies to
+    all targets.
+    """
+
+    SUCCESS = 'Success'
+    # the result of targets the command could not be sent to
+    UNDELIVERABLE = 'Undeliverable'
+
 
     def register(self, id: str, data: dict):
+        data = dict(data)
+        data.update({ 'Results': { } })
+        self.client.put_item(id, 'command', data)
+
+
+    def register_group(self, id: str, data: dict):
+        """
+        :type id: str
+        :param id: The group id
+        :type data: dict
+        :param data: The data of the command. RunningOn lists all targets of all chunks.
+        """
+        data = dict(data)
+        data.update({ 'Results': { }, 'Chunks': { } })
         self.client.put_item(id, 'command', data)
 
 
+    def add_to_group(self, group_id: str, id: str, instance_ids: list):
+        """
+        Register a command sent to a chunk of the targets of a group.
+
+        :type group_id: str
+        :param group_id: The group id
+        :type id: str
+        :param id: The command id
+        :type instance_ids: list
+        :param instance_ids: The targets of the command
+        :raises CommandNotFoundError: If the group has completed already
+        """
+        from botocore.exceptions import ClientError
+
+        self.client.put_item(id, 'command', { 'Group': group_id, 'RunningOn': ', '.join(instance_ids) })
+        try:
+            self.client.update_item(
+                group_id,
+                'SET Chunks.#command = :targets',
+                { ':targets': ', '.join(instance_ids) },
+                { '#command': id },
+                'attribute_exists(Chunks)'
+            )
+        except ClientError as e:
+            if e.response.get('Error', { }).get('Code') != 'ConditionalCheckFailedException':
+                raise
+            self.delete(id)
+            raise CommandNotFoundError('Could not load command group %s.' % group_id)
+
+
     def get(self, id: str):
         return self.client.get_item(id)
 
@@ -49,13 +108,153 @@ class CommandRepository(Repository):
         return command
 
 
+    def complete(self, id: str, instance_id: str, status: str):
+        """
+        Record the result of a target instance.
+
+        :type id: str
+        :param id: The command id or the id of its group
+        :type instance_id: str
+        :param instance_id: The target that reported
+        :type status: str
+        :param status: The status of the command on the target
+
+        :rtype: dict
+        :return: The command, or its group, with the results of all targets reported so far, if this result
+                 completes it. Otherwise None.
+        :raises CommandNotFoundError: If the command does not exist or the target has reported before
+        """
+        from botocore.exceptions import ClientError
+
+        command = self.client.get_item(id, True)
+        if command == { }:
+            raise CommandNotFoundError('Could not load command %s.' % id)
+
+        if command.get('Group', None) is not None:
+            id = command.get('Group')
+            command = self.client.get_item(id, True)
+            if command == { }:
+                raise CommandNotFoundError('Could not load command group %s.' % id)
+
+        if command.get('Results', None) is None:
+            # registered without result tracking
+            self.delete(id)
+            return command
+
+        try:
+            # the command may have been completed and deleted since it has been loaded
+            command = self.client.update_item(
+                id,
+                'SET Results.#target = :status',
+                { ':status': status },
+                { '#target': instance_id },
+                'attribute_exists(Results) AND attribute_not_exists(Results.#target)',
+                'ALL_NEW'
+            )
+        except ClientError as e:
+            if e.response.get('Error', { }).get('Code') != 'ConditionalCheckFailedException':
+                raise
+            raise CommandNotFoundError(
+                'Result of %s for command %s has been recorded before or the command has completed.' % (instance_id, id)
+            )
+
+        targets = self.get_targets(command)
+        results = command.get('Results')
+        failed = [target for target, result in results.items() if result != self.SUCCESS]
+        error_limit = self.get_error_limit(command)
+        if len(results) >= len(targets):
+            for command_id in command.get('Chunks', { }).keys():
+                self.delete(command_id)
+            self.delete(id)
+
+        if status != self.SUCCESS and len(failed) == error_limit + 1:
+            self.logger.info('Command %s failed on %s of %s targets.', id, len(failed), len(targets))
+            return command
+
+        if len(results) == len(targets) and len(failed) <= error_limit:
+            self.logger.info('Command %s completed on all %s targets.', id, len(targets))
+            return command
+
+        self.logger.debug('Command %s: %s of %s targets reported.', id, len(results), len(targets))
+
+        return None
+
+
     def delete(self, id: str):
         self.client.delete_item(id)
 
 
+    @classmethod
+    def get_targets(cls, command: dict) -> list:
+        return [target for target in command.get('RunningOn', '').split(', ') if target != '']
+
+
+    @classmethod
+    def get_error_limit(cls, command: dict) -> int:
+        """
+        :rtype: int
+        :return: The number of failed targets tolerated, from the MaxErrors of the command
+        """
+        return SsmClient.get_error_limit(command.get('MaxErrors', None), len(cls.get_targets(command)))
+
+
+class ContinuationRepository(Repository):
+    """
+    Continuations of waits that were suspended at the end of an invocation. There is at most one continuation per
+    node (or per scheduled event, if there is no node), stored under the key continuation:<id>.
+    """
+
+    ITEM_TYPE = 'continuation'
+
+
+    def register(self, id: str, data: dict):
+        self.client.put_item(self.get_key(id), self.ITEM_TYPE, data)
+
+
+    def get(self, id: str) -> dict:
+        return self.client.get_item(self.get_key(id), True)
+
+
+    def delete(self, id: str):
+        self.client.delete_item(self.get_key(id))
+
+
+    def get_all(self) -> list:
+        """
+        :rtype: list
+        :return: All pending continuations
+        """
+        return list(self.client.scan('ItemType = :item_type', { ':item_type': self.ITEM_TYPE }))
+
+
+    @classmethod
+    def get_key(cls, id: str) -> str:
+        return cls.ITEM_TYPE + ':' + id
+
+
+    @classmethod
+    def get_id(cls, continuation: dict) -> str:
+        """
+        :rtype: str
+        :return: The id of a continuation as returned by get_all()
+        """
+        return continuation.get('Ident')[len(cls.ITEM_TYPE) + 1:]
+
+
 class Node(object):
+    """
+    :type write_behind: bool
+    :param write_behind: Whether updates are kept in memory until the node repository flushes them
+    :type pending_changes: dict
+    :param pending_changes: Properties updated since the last flush
+    :type pending_removals: list
+    :param pending_removals: Properties removed since the last flush
+    """
     id = None
     data = { }
+    write_behind = False
+    pending_changes = { }
+    pending_removals = []
 
 
     def __init__(self, id, node_type = 'unknown'):
@@ -66,6 +265,8 @@ class Node(object):
         self.data = { }
         self.data.update({ 'ItemType': node_type })
         self.data.update({ 'ItemStatus': 'new' })
+        self.pending_changes = { }
+        self.pending_removals = []
 
 
     def get_id(self):
@@ -133,9 +334,42 @@ class Node(object):
         self.id = ident
 
 
+    def set_write_behind(self, write_behind: bool):
+        self.write_behind = write_behind
+
+
+    def has_pending_changes(self) -> bool:
+        return len(self.pending_changes) > 0 or len(self.pending_removals) > 0
+
+
+    def pop_pending_changes(self) -> tuple:
+        changes = self.pending_changes
+        removals = self.pending_removals
+        self.pending_changes = { }
+        self.pending_removals = []
+
+        return changes, removals
+
+
 class NodeRepository(Repository):
+    """
+    :type scan_segments: int
+    :param scan_segments: The number of segments to scan in parallel when loading nodes by type
+    :type type_index: str
+    :param type_index: The name of a global secondary index with ItemType as partition key. Nodes will be loaded
+                       by type with one query per type instead of a table scan. The index must project all
+                       attributes.
+    :type type_index_status_key: bool
+    :param type_index_status_key: Whether the type index uses ItemStatus as sort key
+    """
+    scan_segments = 1
+    type_index = None
+    type_index_status_key = False
+
 
     def put(self, node: Node):
+        # the whole item is written, including pending changes
+        node.pop_pending_changes()
         self.client.put_item(node.id, node.get_type(), node.data)
 
 
@@ -153,70 +387,153 @@ class NodeRepository(Repository):
         for p in properties:
             node.unset_property(p)
 
+        if node.write_behind:
+            for p in properties:
+                node.pending_changes.pop(p, None)
+                if p not in node.pending_removals:
+                    node.pending_removals.append(p)
+            return
+
         self.client.unset(node.get_id(), properties)
 
 
     def update(self, node: Node, changes: dict):
-        parts = []
-        values = { }
         for k, v in changes.items():
             node.set_property(k, v)
+
+        if node.write_behind:
+            for k in changes.keys():
+                if k in node.pending_removals:
+                    node.pending_removals.remove(k)
+            node.pending_changes.update(changes)
+            return
+
+        self.__write(node, changes, [])
+
+
+    def flush(self, node: Node):
+        """
+        Persist all pending changes of a node with a single update.
+
+        :type node: Node
+        :param node: The node to flush
+        """
+        if not node.has_pending_changes():
+            return
+
+        changes, removals = node.pop_pending_changes()
+        self.logger.debug('Flushing changes %s and removals %s of node %s', changes, removals, node.get_id())
+        self.__write(node, changes, removals)
+
+
+    def __write(self, node: Node, changes: dict, removals: list):
+        if len(changes) == 0:
+            self.client.unset(node.get_id(), removals)
+            return
+
+        parts = []
+        values = { }
+        for k in changes.keys():
             parts.append(' ' + k + ' = :' + k)
             values.update({ ':' + k: node.get_property(k) })
 
         expression = 'SET' + ','.join(parts)
+        if len(removals) > 0:
+            expression = expression + ' REMOVE ' + ','.join(removals)
 
         self.client.update_item(node.get_id(), expression, values)
 
 
     def delete(self, node: Node):
+        # pending changes would create the item again
+        node.pop_pending_changes()
         self.client.delete_item(node.get_id())
 
 
     def get_by_type(self, types: list, additional_filter: str = None, attribute_values: dict = None,
-                    include_terminating: bool = False):
+                    include_terminating: bool = False, segments: int = None):
         """
         Fetch nodes by type and add custom filters.
 
         :param types:
         :param additional_filter:
         :param attribute_values:
+        :param include_terminating:
+        :param segments: The number of segments to scan in parallel. Defaults to scan_segments.
         :return:
         """
         self.logger.info('Loading nodes of type %s with filter %s and values %s', types, additional_filter,
                          attribute_values)
 
-        filter = ''
-        if not include_terminating:
-            filter = 'and ItemStatus <> :terminating and ItemStatus <> :removing'
-
         if additional_filter is None and attribute_values is not None:
             raise RuntimeError('Filter is not set but attribute values are given.')
         elif additional_filter is not None and attribute_values is None:
             raise RuntimeError('Filter is set but no attribute values are given.')
-        elif additional_filter is not None and attribute_values is not None:
-            filter = filter + ' and (' + additional_filter + ')'
         elif attribute_values is None:
             attribute_values = { }
 
+        if self.type_index is None:
+            items = self.__scan_by_type(types, additional_filter, attribute_values, include_terminating, segments)
+        else:
+            items = self.__query_by_type(types, additional_filter, attribute_values, include_terminating)
+
+        nodes = []
+        for item in items:
+            node = Node(item.pop('Ident'), item.pop('ItemType'))
+            node.set_status(item.pop('ItemStatus'))
+            for k, v in item.items():
+                node.set_property(k, v)
+            nodes.append(node)
+
+        return nodes
+
+
+    def __scan_by_type(self, types: list, additional_filter: str, attribute_values: dict,
+                       include_terminating: bool, segments: int):
+        attribute_values = dict(attribute_values)
+        filter = ''
         if not include_terminating:
+            filter = 'and ItemStatus <> :terminating and ItemStatus <> :removing'
             attribute_values.update({ ':terminating': 'terminating' })
             attribute_values.update({ ':removing': 'removing' })
 
+        if additional_filter is not None:
+            filter = filter + ' and (' + additional_filter + ')'
+
         parts = []
         for index, node_type in enumerate(types):
             attribute_values.update({ ':node_type' + str(index): node_type })
             parts.append('ItemType = :node_type' + str(index))
         expression = '(' + ' or '.join(parts) + ') ' + filter
 
-        items = self.client.scan(expression, attribute_values)
+        if segments is None:
+            segments = self.scan_segments
 
-        nodes = []
-        for item in items:
-            node = Node(item.pop('Ident'), item.pop('ItemType'))
-            node.set_status(item.pop('ItemStatus'))
-            for k, v in item.items():
-                node.set_property(k, v)
-            nodes.append(node)
+        return self.client.scan(expression, attribute_values, segments)
 
-        return nodes
+
+    def __query_by_type(self, types: list, additional_filter: str, attribute_values: dict,
+                        include_terminating: bool):
+        filters = []
+        attribute_values = dict(attribute_values)
+        # key attributes cannot be used in filter expressions
+        # if ItemStatus is the sort key, terminating nodes are removed from the results
+        exclude_terminating = not include_terminating and self.type_index_status_key
+        if not include_terminating and not self.type_index_status_key:
+            filters.append('ItemStatus <> :terminating and ItemStatus <> :removing')
+            attribute_values.update({ ':terminating': 'terminating' })
+            attribute_values.update({ ':removing': 'removing' })
+
+        if additional_filter is not None:
+            filters.append('(' + additional_filter + ')')
+
+        filter_expression = ' and '.join(filters) if len(filters) > 0 else None
+
+        for node_type in types:
+            values = dict(attribute_values)
+            values.update({ ':node_type': node_type })
+            items = self.client.query('ItemType = :node_type', values, filter_expression, self.type_index)
+            for item in items:
+                if exclude_terminating and item.get('ItemStatus') in ['terminating', 'removing']:
+                    continue
+                yield item
@@ -28,3 +28,13 @@ class StopProcessingAfterStateChange(BaseError):
 
 class EventNotSupportedError(BaseError):
     pass
+
+
+class WaitTimeoutError(BaseError):
+    """ A condition was not met before the wait timed out. """
+    pass
+
+
+class SuspendProcessing(BaseError):
+    """ Signal the end from LifecycleHandler.__process() after a continuation of a wait has been persisted. """
+    pass
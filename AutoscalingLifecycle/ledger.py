@@ -0,0 +1,169 @@
+import json
+import sys
+import time
+from collections import OrderedDict
+from threading import Lock
+from threading import local
+
+
+class CallLedger(object):
+    """
+    Records the aws api calls of a single invocation. The ClientFactory instruments every client it creates and
+    records each call in the ledger that is active on the calling thread.
+
+    :type trigger: str
+    :param trigger: The trigger calls are currently recorded for
+    :type entries: list
+    :param entries: The recorded calls
+    """
+
+    INITIALIZE = 'initialize'
+
+    __local = local()
+
+
+    def __init__(self):
+        self.trigger = self.INITIALIZE
+        self.entries = []
+        self.lock = Lock()
+
+
+    def activate(self):
+        """
+        Record calls made on the current thread in this ledger.
+
+        :rtype: CallLedger
+        :return: The ledger itself
+        """
+        self.__local.ledger = self
+
+        return self
+
+
+    @classmethod
+    def deactivate(cls):
+        """
+        Stop recording calls made on the current thread.
+        """
+        cls.__local.ledger = None
+
+
+    @classmethod
+    def get_current(cls):
+        """
+        :rtype: CallLedger
+        :return: The ledger active on the current thread or None
+        """
+        return getattr(cls.__local, 'ledger', None)
+
+
+    def set_trigger(self, trigger: str):
+        self.trigger = trigger
+
+
+    def record(self, service: str, operation: str, region: str, latency: float, retries: int = 0,
+               error_code: str = None, trigger: str = None):
+        """
+        :type latency: float
+        :param latency: The duration of the call including retries in seconds
+        :type retries: int
+        :param retries: The number of retries botocore made
+        :type error_code: str
+        :param error_code: The error code of a failed call
+        :type trigger: str
+        :param trigger: The trigger the call was made for. Defaults to the current trigger.
+        """
+        with self.lock:
+            self.entries.append({
+                'trigger': trigger if trigger is not None else self.trigger,
+                'service': service,
+                'operation': operation,
+                'region': region,
+                'latency': latency,
+                'retries': retries,
+                'error_code': error_code
+            })
+
+
+    def summarize(self) -> OrderedDict:
+        """
+        :rtype: OrderedDict
+        :return: Calls, latency in milliseconds, retries and errors by trigger and (service, operation)
+        """
+        with self.lock:
+            entries = list(self.entries)
+
+        summary = OrderedDict()
+        for entry in entries:
+            operations = summary.setdefault(entry.get('trigger'), OrderedDict())
+            operation = operations.setdefault((entry.get('service'), entry.get('operation')), {
+                'Calls': 0,
+                'Latency': 0.0,
+                'Retries': 0,
+                'Errors': 0,
+                'ErrorCodes': [],
+                'Regions': []
+            })
+            operation['Calls'] += 1
+            operation['Latency'] += entry.get('latency') * 1000
+            operation['Retries'] += entry.get('retries')
+            if entry.get('error_code') is not None:
+                operation['Errors'] += 1
+                if entry.get('error_code') not in operation['ErrorCodes']:
+                    operation['ErrorCodes'].append(entry.get('error_code'))
+            if entry.get('region') not in operation['Regions']:
+                operation['Regions'].append(entry.get('region'))
+
+        return summary
+
+
+    def to_emf(self, namespace: str, properties: dict = None) -> list:
+        """
+        Build one CloudWatch embedded metric format document per trigger and operation.
+
+        :type namespace: str
+        :param namespace: The metric namespace
+        :type properties: dict
+        :param properties: Additional properties added to every document, e.g. the event name
+
+        :rtype: list
+        :return: json strings
+        """
+        timestamp = int(time.time() * 1000)
+        lines = []
+        for trigger, operations in self.summarize().items():
+            for (service, operation), metrics in operations.items():
+                document = {
+                    '_aws': {
+                        'Timestamp': timestamp,
+                        'CloudWatchMetrics': [{
+                            'Namespace': namespace,
+                            'Dimensions': [['Trigger', 'Service', 'Operation'], ['Service', 'Operation']],
+                            'Metrics': [
+                                { 'Name': 'Calls', 'Unit': 'Count' },
+                                { 'Name': 'Latency', 'Unit': 'Milliseconds' },
+                                { 'Name': 'Retries', 'Unit': 'Count' },
+                                { 'Name': 'Errors', 'Unit': 'Count' }
+                            ]
+                        }]
+                    },
+                    'Trigger': trigger,
+                    'Service': service,
+                    'Operation': operation
+                }
+                document.update(properties if properties is not None else { })
+                document.update(metrics)
+                document.update({ 'Latency': round(metrics.get('Latency'), 3) })
+                lines.append(json.dumps(document, sort_keys = True))
+
+        return lines
+
+
+    def emit(self, namespace: str, properties: dict = None, stream = None):
+        """
+        Write the embedded metric format documents to stdout, where the lambda runtime ships them to CloudWatch.
+        """
+        stream = stream if stream is not None else sys.stdout
+        for line in self.to_emf(namespace, properties):
+            stream.write(line + '\n')
+        stream.flush()
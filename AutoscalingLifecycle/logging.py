@@ -1,8 +1,37 @@
 import datetime
 import json
 import logging
+from typing import TYPE_CHECKING
 
-from botocore.client import BaseClient
+if TYPE_CHECKING:
+    from botocore.client import BaseClient
+
+
+class Lazy(object):
+    """
+    A log argument that is only computed when a record is actually emitted, e.g.
+
+        logger.debug('processing model %s', Lazy(repr, model))
+
+    :type func: callable
+    :param func: Computes the argument
+    :type args: tuple
+    :param args: The arguments passed to func
+    """
+    __slots__ = ('func', 'args')
+
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+
+    def resolve(self):
+        return self.func(*self.args)
+
+
+    def __str__(self):
+        return str(self.resolve())
 
 
 class MessageFormatter(object):
@@ -31,6 +60,9 @@ class MessageFormatter(object):
 
         formatted_args = []
         for arg in args:
+            if type(arg) is Lazy:
+                arg = arg.resolve()
+
             if type(arg) is not str:
                 try:
                     arg = self.to_str(arg)
@@ -78,8 +110,17 @@ class MessageFormatter(object):
 
 
 class Logging(object):
+    """
+    :type name: str
+    :param name: The name of the logger
+    :type format_pretty: bool
+    :param format_pretty: Whether to indent json formatted arguments
+    :type level: int
+    :param level: The log level. Records below this level are discarded before any argument is formatted
+    """
+
 
-    def __init__(self, name: str, format_pretty: bool = False):
+    def __init__(self, name: str, format_pretty: bool = False, level = logging.DEBUG):
         self.formatter = MessageFormatter(name, format_pretty)
         self.logger = logging.getLogger()
         # remove handlers from root logger
@@ -89,7 +130,11 @@ class Logging(object):
         # remove handlers from our logger
         for h in self.logger.handlers:
             self.logger.removeHandler(h)
-        self.logger.setLevel(logging.DEBUG)
+        self.logger.setLevel(level)
+
+
+    def set_level(self, level):
+        self.logger.setLevel(level)
 
 
     def add_handler(self, ch: logging.Handler, log_format: str):
@@ -134,7 +179,7 @@ class SnsHandler(logging.Handler):
     """
 
 
-    def __init__(self, sns_client: BaseClient, arn):
+    def __init__(self, sns_client: 'BaseClient', arn):
         self.sns_client = sns_client
         self.arn = arn
         super().__init__()
@@ -0,0 +1,129 @@
+from collections import OrderedDict
+from logging import Logger
+from queue import Full
+from queue import Queue
+from threading import Lock
+from threading import Thread
+
+from .clients import SnsClient
+from .ledger import CallLedger
+
+
+class NotificationQueue(object):
+    """
+    Collects the reports of an invocation on a worker thread and publishes them as a single digest when flushed.
+    The queue is bounded. Reports are dropped if it is full and the number of dropped reports is part of the
+    digest.
+
+    :type sns: SnsClient
+    :param sns: The client to publish the digest with
+    :type logger: Logger
+    :param logger: A logger instance
+    :type max_size: int
+    :param max_size: The maximum number of reports waiting for the worker
+    :type region: str
+    :param region: The region to publish the digest in
+    :type dropped: int
+    :param dropped: The number of reports dropped since the last flush
+    """
+
+    __FLUSH = 'flush'
+    __REPORT = 'report'
+    __ACTIVITY = 'activity'
+
+
+    def __init__(self, sns: SnsClient, logger: Logger, max_size: int = 100, region: str = 'eu-west-1'):
+        self.sns = sns
+        self.logger = logger
+        self.region = region
+        self.queue = Queue(max_size)
+        self.dropped = 0
+        self.worker = None
+        self.lock = Lock()
+
+
+    def put_report(self, status: str, subject: str, detail: str):
+        self.__put(self.__REPORT, {
+            'status': status,
+            'subject': subject,
+            'detail': detail
+        })
+
+
+    def put_activity(self, activity: dict):
+        self.__put(self.__ACTIVITY, activity)
+
+
+    def flush(self, title: str, timeout: float = 30):
+        """
+        Publish everything collected so far as a single digest and wait for the worker to finish.
+
+        :type title: str
+        :param title: The title of the digest
+        :type timeout: float
+        :param timeout: The maximum time to wait for the digest to be published
+        """
+        with self.lock:
+            worker = self.worker
+            self.worker = None
+
+        if worker is None:
+            return
+
+        # blocks only until the worker made room, even if the queue is full
+        self.queue.put((self.__FLUSH, title))
+        worker.join(timeout)
+        if worker.is_alive():
+            self.logger.warning('Notification digest %s has not been published within %s seconds.', title, timeout)
+
+
+    def __put(self, kind: str, data: dict):
+        with self.lock:
+            if self.worker is None:
+                self.worker = Thread(
+                    target = self.__work,
+                    args = (CallLedger.get_current(),),
+                    name = 'notifications',
+                    daemon = True
+                )
+                self.worker.start()
+
+        try:
+            self.queue.put_nowait((kind, data))
+        except Full:
+            with self.lock:
+                self.dropped += 1
+            self.logger.warning('Notification queue is full. Dropping %s.', kind)
+
+
+    def __work(self, ledger: CallLedger = None):
+        if ledger is not None:
+            ledger.activate()
+
+        reports = []
+        # only the latest state of an activity is reported
+        activities = OrderedDict()
+        while True:
+            kind, data = self.queue.get()
+            if kind == self.__FLUSH:
+                title = data
+                break
+            elif kind == self.__REPORT:
+                reports.append(data)
+            else:
+                activities.update({ data.get('Description', ''): data })
+
+        with self.lock:
+            dropped = self.dropped
+            self.dropped = 0
+
+        if dropped > 0:
+            self.logger.warning('%s notifications have been dropped.', dropped)
+
+        if len(reports) == 0 and len(activities) == 0 and dropped == 0:
+            return
+
+        try:
+            self.sns.publish_digest(title, reports, list(activities.values()), dropped, self.region)
+        except Exception as e:
+            self.logger.exception('Failed to publish notification digest: %s', repr(e))
@@ -0,0 +1,414 @@
+import heapq
+import random
+import time
+from collections import OrderedDict
+from logging import Logger
+from threading import Lock
+from threading import local
+
+from .exceptions import WaitTimeoutError
+
+
+class Backoff(object):
+    """
+    Poll with exponential backoff and jitter until a predicate is met or the timeout has passed.
+    A backoff does not keep state between waits and can be shared.
+
+    :type delay: float
+    :param delay: The delay before the second attempt in seconds
+    :type max_delay: float
+    :param max_delay: The maximum delay between two attempts in seconds
+    :type factor: float
+    :param factor: The factor the delay grows with each attempt
+    :type timeout: float
+    :param timeout: The maximum time to wait in seconds
+    :type jitter: bool
+    :param jitter: Randomize delays between half and the full delay to avoid synchronized polling
+    """
+
+
+    def __init__(self, delay: float = 1, max_delay: float = 15, factor: float = 2, timeout: float = 600,
+                 jitter: bool = True):
+        self.delay = delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.timeout = timeout
+        self.jitter = jitter
+
+
+    def get_delay(self, attempt: int) -> float:
+        """
+        :type attempt: int
+        :param attempt: The number of attempts made so far, starting with 1
+
+        :rtype: float
+        :return: The delay before the next attempt
+        """
+        # the exponent is capped, long waits with short delays would overflow a float otherwise
+        delay = min(self.max_delay, self.delay * self.factor ** min(attempt - 1, 64))
+        if self.jitter:
+            delay = random.uniform(delay / 2, delay)
+
+        return delay
+
+
+    def get_deadline(self, start: float, deadline: float = None) -> float:
+        """
+        :type start: float
+        :param start: The time.monotonic() value the wait started at
+        :type deadline: float
+        :param deadline: An overall deadline as time.monotonic() value, e.g. the end of the invocation
+
+        :rtype: float
+        :return: The earlier one of the timeout of this backoff and the overall deadline
+        """
+        if deadline is None:
+            return start + self.timeout
+
+        return min(start + self.timeout, deadline)
+
+
+    def wait(self, poll, predicate, description: str = 'condition', deadline: float = None):
+        """
+        :type poll: callable
+        :param poll: Fetches the current result
+        :type predicate: callable
+        :param predicate: Receives the result and returns whether waiting is complete
+        :type description: str
+        :param description: A description of the condition used in the timeout error
+        :type deadline: float
+        :param deadline: An overall deadline as time.monotonic() value
+
+        :return: The result that satisfied the predicate
+        :raises WaitTimeoutError: If the predicate is not met in time
+        """
+        deadline = self.get_deadline(time.monotonic(), deadline)
+        attempt = 0
+        while True:
+            attempt += 1
+            result = poll()
+            if predicate(result):
+                return result
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise WaitTimeoutError(
+                    'Timed out after %s attempts waiting for %s. Last result: %s' % (attempt, description, result)
+                )
+
+            time.sleep(min(self.get_delay(attempt), remaining))
+
+
+class Acceptor(object):
+    """
+    Decides the state of a wait from a response. Unlike the acceptors of botocore waiter models, the condition is a
+    python callable and no JMESPath expression is evaluated.
+
+    :type state: str
+    :param state: The state of the wait if the predicate matches: success, retry or failure
+    :type predicate: callable
+    :param predicate: Receives the response and the arguments of the wait and returns whether it matches
+    :type description: str
+    :param description: A description used in errors
+    """
+
+    SUCCESS = 'success'
+    RETRY = 'retry'
+    FAILURE = 'failure'
+
+    __slots__ = ('state', 'predicate', 'description')
+
+
+    def __init__(self, state: str, predicate, description: str = ''):
+        self.state = state
+        self.predicate = predicate
+        self.description = description
+
+
+    def matches(self, response: dict, arguments: dict) -> bool:
+        try:
+            return bool(self.predicate(response, arguments))
+        except (AttributeError, IndexError, KeyError, TypeError):
+            # the response does not have the expected shape
+            return False
+
+
+class WaiterConfig(object):
+    """
+    :type name: str
+    :param name: The name of the waiter
+    :type service: str
+    :param service: The service of the client to poll with
+    :type operation: str
+    :param operation: The client method to poll with, e.g. describe_instance_information
+    :type acceptors: list
+    :param acceptors: Acceptors in order of precedence
+    :type backoff: Backoff
+    :param backoff: The delays between attempts and the timeout of a wait
+    """
+
+
+    def __init__(self, name: str, service: str, operation: str, acceptors: list, backoff: Backoff):
+        self.name = name
+        self.service = service
+        self.operation = operation
+        self.acceptors = acceptors
+        self.backoff = backoff
+
+
+    def get_state(self, response: dict, arguments: dict):
+        """
+        :rtype: str
+        :return: The state of the first matching acceptor or None
+        """
+        for acceptor in self.acceptors:
+            if acceptor.matches(response, arguments):
+                return acceptor.state
+
+        return None
+
+
+class Waiter(object):
+    """
+    A waiter config bound to a client. wait() accepts the parameters of the operation like a botocore waiter.
+
+    Values the acceptors depend on, like an instance id, are passed as arguments and are not part of the config, so
+    one config serves all instances. with_arguments() returns a lightweight copy that is not registered anywhere.
+
+    :type config: WaiterConfig
+    :param config: The config
+    :type client: BotoClient
+    :param client: The client to poll with
+    :type engine: WaiterEngine
+    :param engine: The engine that runs the waits
+    :type arguments: dict
+    :param arguments: The arguments passed to the acceptors
+    """
+
+    __slots__ = ('config', 'client', 'engine', 'name', 'arguments')
+
+
+    def __init__(self, config: WaiterConfig, client, engine, arguments: dict = None):
+        self.config = config
+        self.client = client
+        self.engine = engine
+        self.name = config.name
+        self.arguments = arguments if arguments is not None else { }
+
+
+    def with_arguments(self, **arguments):
+        """
+        :rtype: Waiter
+        :return: A waiter sharing config, client and engine with this one, that passes arguments to the acceptors
+        """
+        return Waiter(self.config, self.client, self.engine, arguments)
+
+
+    def poll(self, parameters: dict) -> tuple:
+        """
+        :rtype: tuple
+        :return: The response and whether it is an error response
+        """
+        from botocore.exceptions import ClientError
+
+        try:
+            return getattr(self.client, self.config.operation)(**parameters), False
+        except ClientError as e:
+            return e.response, True
+
+
+    def wait(self, **kwargs) -> dict:
+        """
+        :return: The response that satisfied the waiter
+        :raises botocore.exceptions.WaiterError: On a failure state, an unexpected error or when the deadline passed
+        """
+        return self.engine.wait(self, kwargs)
+
+
+class WaiterRegistry(object):
+    """
+    Waiters by name, evicting the least recently used waiter once max_size is reached.
+
+    :type max_size: int
+    :param max_size: The maximum number of waiters kept
+    """
+
+
+    def __init__(self, max_size: int = 64):
+        self.max_size = max_size
+        self.waiters = OrderedDict()
+        self.lock = Lock()
+
+
+    def get(self, name: str, default = None):
+        with self.lock:
+            waiter = self.waiters.get(name, None)
+            if waiter is None:
+                return default
+            self.waiters.move_to_end(name)
+
+            return waiter
+
+
+    def add(self, waiter: Waiter):
+        with self.lock:
+            self.waiters[waiter.name] = waiter
+            self.waiters.move_to_end(waiter.name)
+            while len(self.waiters) > self.max_size:
+                self.waiters.popitem(last = False)
+
+
+    def clear(self):
+        with self.lock:
+            self.waiters.clear()
+
+
+    def keys(self) -> list:
+        with self.lock:
+            return list(self.waiters.keys())
+
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.waiters
+
+
+    def __len__(self) -> int:
+        return len(self.waiters)
+
+
+class _Wait(object):
+    __slots__ = ('index', 'waiter', 'parameters', 'arguments', 'attempt', 'deadline', 'response')
+
+
+    def __init__(self, index: int, waiter: Waiter, parameters: dict, arguments: dict, deadline: float):
+        self.index = index
+        self.waiter = waiter
+        self.parameters = parameters
+        self.arguments = arguments
+        self.deadline = deadline
+        self.attempt = 0
+        self.response = None
+
+
+class WaiterEngine(object):
+    """
+    Runs waits on the calling thread. Several waits are multiplexed: each is polled when its backoff delay has
+    passed, so they overlap instead of running one after another. Every wait ends at the timeout of its backoff or
+    at the overall deadline, whichever comes first.
+
+    The engine is shared by all threads. A deadline set with set_deadline() only applies to the waits of the
+    calling thread, e.g. the invocation it processes.
+
+    :type logger: Logger
+    :param logger: A logger instance
+    :type default_deadline: float
+    :param default_deadline: An overall deadline as time.monotonic() value or None, used by threads that have not
+        set a deadline
+    """
+
+
+    def __init__(self, logger: Logger, deadline: float = None):
+        self.logger = logger
+        self.default_deadline = deadline
+        self.local = local()
+
+
+    @property
+    def deadline(self) -> float:
+        return getattr(self.local, 'deadline', self.default_deadline)
+
+
+    def set_deadline(self, deadline: float = None):
+        """
+        :type deadline: float
+        :param deadline: The time.monotonic() value no wait of the calling thread may outlast, e.g. the end of the
+            invocation
+        """
+        self.local.deadline = deadline
+
+
+    def get_remaining(self):
+        """
+        :rtype: float
+        :return: The seconds left until the overall deadline or None
+        """
+        if self.deadline is None:
+            return None
+
+        return self.deadline - time.monotonic()
+
+
+    def wait(self, waiter: Waiter, parameters: dict = None, arguments: dict = None) -> dict:
+        return self.wait_all([(waiter, parameters, arguments)])[0]
+
+
+    def wait_all(self, waits: list) -> list:
+        """
+        :type waits: list
+        :param waits: Tuples of waiter, operation parameters and optional acceptor arguments, which default to the
+            arguments of the waiter
+
+        :rtype: list
+        :return: The responses that satisfied the waiters in the order of the waits
+        :raises botocore.exceptions.WaiterError: As soon as one of the waits fails
+        """
+        start = time.monotonic()
+        results = [None] * len(waits)
+        # (next poll, index, wait)
+        queue = []
+        for index, wait in enumerate(waits):
+            waiter, parameters = wait[0], wait[1] if wait[1] is not None else { }
+            arguments = wait[2] if len(wait) > 2 and wait[2] is not None else waiter.arguments
+            deadline = waiter.config.backoff.get_deadline(start, self.deadline)
+            queue.append((start, index, _Wait(index, waiter, parameters, arguments, deadline)))
+        heapq.heapify(queue)
+
+        while len(queue) > 0:
+            poll_at, _, wait = heapq.heappop(queue)
+            delay = poll_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            if self.__poll(wait):
+                results[wait.index] = wait.response
+                continue
+
+            now = time.monotonic()
+            if now >= wait.deadline:
+                raise self.__get_error(wait, 'Deadline exceeded after %s attempts' % wait.attempt)
+
+            next_poll = min(now + wait.waiter.config.backoff.get_delay(wait.attempt), wait.deadline)
+            heapq.heappush(queue, (next_poll, wait.index, wait))
+
+        return results
+
+
+    def __poll(self, wait: _Wait) -> bool:
+        """
+        :rtype: bool
+        :return: Whether the wait succeeded
+        """
+        wait.attempt += 1
+        wait.response, is_error = wait.waiter.poll(wait.parameters)
+        state = wait.waiter.config.get_state(wait.response, wait.arguments)
+        self.logger.debug('Waiter %s attempt %s: %s', wait.waiter.name, wait.attempt, state)
+
+        if state == Acceptor.SUCCESS:
+            return True
+
+        if state == Acceptor.FAILURE:
+            raise self.__get_error(wait, 'Waiter encountered a terminal failure state')
+
+        if state is None and is_error:
+            raise self.__get_error(wait, 'An error occurred (%s): %s' % (
+                wait.response.get('Error', { }).get('Code', 'Unknown'),
+                wait.response.get('Error', { }).get('Message', 'Unknown')
+            ))
+
+        return False
+
+
+    def __get_error(self, wait: _Wait, reason: str) -> Exception:
+        from botocore.exceptions import WaiterError
+
+        return WaiterError(name = wait.waiter.name, reason = reason, last_response = wait.response)
@@ -0,0 +1,213 @@
+"""
+Micro-benchmarks for the code that runs on every invocation, built on the fixtures in test/fixtures with stubbed
+boto clients.
+
+Results are written as json, so they can be stored and compared across commits:
+
+    python -m benchmark.hot_path --output before.json
+    python -m benchmark.hot_path --compare before.json --max-regression 20
+
+With --compare, the process exits with status 1 if a benchmark is slower than the baseline by more than
+--max-regression percent.
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import timeit
+from unittest import mock
+
+from AutoscalingLifecycle import Event
+from AutoscalingLifecycle import LifecycleHandler
+from AutoscalingLifecycle import TransitionTable
+from AutoscalingLifecycle.clients import DynamoDbClient
+from AutoscalingLifecycle.logging import Logging
+from AutoscalingLifecycle.logging import MessageFormatter
+from benchmark.transition_table import BenchmarkModel
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test', 'fixtures')
+
+
+def load_fixture(name: str) -> dict:
+    with open(os.path.join(FIXTURES, name), 'r') as fh:
+        return json.load(fh)
+
+
+def load_message(name: str) -> str:
+    return load_fixture(name).get('Records')[0].get('Sns').get('Message')
+
+
+class StubDynamoDb(object):
+    """
+    Answers the calls of DynamoDbClient without network access.
+    """
+
+
+    def __init__(self, item: dict):
+        self.item = item
+
+
+    def get_item(self, **kwargs):
+        return { 'Item': self.item }
+
+
+    def put_item(self, **kwargs):
+        return { }
+
+
+def create_logging() -> Logging:
+    log = Logging('BENCHMARK', level = logging.INFO)
+    log.add_handler(logging.StreamHandler(io.StringIO()), '[%(levelname)s] [%(name)s] %(message)s')
+
+    return log
+
+
+def create_model(states: int) -> BenchmarkModel:
+    BenchmarkModel.size = states
+    model = BenchmarkModel(mock.MagicMock(), mock.MagicMock(), create_logging(), 'benchmark', 'benchmark')
+    model.event = Event(json.loads(load_message('scheduled_event.json')))
+    model.digest_notifications = False
+    model._state = 'state_0'
+
+    return model
+
+
+def get_benchmarks() -> dict:
+    """
+    :rtype: dict
+    :return: Callables by benchmark name
+    """
+    autoscaling_message = load_message('autoscaling_event.json')
+    ssm_message = load_message('ssm_event.json')
+    scheduled_message = load_message('scheduled_event.json')
+
+    model = create_model(10)
+    LifecycleHandler(model)
+
+
+    def handler_cold():
+        TransitionTable.clear()
+        LifecycleHandler(model)
+
+
+    def chain():
+        model._state = 'state_0'
+        LifecycleHandler(model)()
+
+
+    node = load_fixture('i-007de616626a946ce.json').get('data')
+    dynamodb = DynamoDbClient(mock.Mock(), mock.Mock(), create_logging(), 'benchmark')
+    item = dynamodb.convert_expression_attribute_values(node)
+    dynamodb.client = StubDynamoDb(item)
+    command = load_fixture('2730b156-4765-4ae7-b870-56c380012717.json')
+
+    formatter = MessageFormatter('BENCHMARK')
+    pretty_formatter = MessageFormatter('BENCHMARK', True)
+
+    return {
+        'event.autoscaling': lambda: Event(json.loads(autoscaling_message)),
+        'event.ssm': lambda: Event(json.loads(ssm_message)),
+        'event.scheduled': lambda: Event(json.loads(scheduled_message)),
+        'handler.construct': lambda: LifecycleHandler(model),
+        'handler.construct_cold': handler_cold,
+        'handler.chain_10_transitions': chain,
+        'dynamodb.get_item': lambda: dynamodb.get_item(node.get('Ident')),
+        'dynamodb.put_item': lambda: dynamodb.put_item(node.get('Ident'), 'worker', dict(node)),
+        'formatter.to_str': lambda: formatter.to_str(command),
+        'formatter.to_str_pretty': lambda: pretty_formatter.to_str(command),
+    }
+
+
+def measure(func, repeat: int = 5) -> dict:
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    timings = sorted([t / number for t in timer.repeat(repeat = repeat, number = number)])
+
+    return {
+        'min_us': round(timings[0] * 1000000, 3),
+        'median_us': round(timings[len(timings) // 2] * 1000000, 3),
+        'number': number,
+        'repeat': repeat
+    }
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd = os.path.dirname(FIXTURES),
+            stderr = subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def run(names: list = None, repeat: int = 5) -> dict:
+    benchmarks = get_benchmarks()
+    results = { }
+    for name, func in benchmarks.items():
+        if names and not any([name.startswith(prefix) for prefix in names]):
+            continue
+        results.update({ name: measure(func, repeat) })
+
+    return {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'benchmarks': results
+    }
+
+
+def compare(results: dict, baseline: dict, max_regression: float) -> bool:
+    """
+    Print the change of every benchmark compared to the baseline.
+
+    :rtype: bool
+    :return: Whether all benchmarks are within max_regression percent of the baseline
+    """
+    passed = True
+    for name, result in results.get('benchmarks').items():
+        before = baseline.get('benchmarks', { }).get(name, None)
+        if before is None:
+            print('%-30s %10.3f us  (new)' % (name, result.get('min_us')))
+            continue
+
+        change = (result.get('min_us') / before.get('min_us') - 1) * 100
+        regression = max_regression is not None and change > max_regression
+        passed = passed and not regression
+        print('%-30s %10.3f us  %+7.1f%%%s' % (name, result.get('min_us'), change, '  REGRESSION' if regression else ''))
+
+    return passed
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description = 'Benchmark the handler hot path.')
+    parser.add_argument('names', nargs = '*', help = 'Only run benchmarks starting with these names')
+    parser.add_argument('--repeat', type = int, default = 5)
+    parser.add_argument('--output', help = 'Write the results to this file')
+    parser.add_argument('--compare', help = 'Compare the results with a previous output file')
+    parser.add_argument('--max-regression', type = float, default = None, help = 'Allowed slowdown in percent')
+    args = parser.parse_args(argv)
+
+    results = run(args.names, args.repeat)
+
+    if args.output is not None:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent = 2, sort_keys = True)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as fh:
+            baseline = json.load(fh)
+
+        return 0 if compare(results, baseline, args.max_regression) else 1
+
+    print(json.dumps(results, indent = 2, sort_keys = True))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,59 @@
+"""
+Measure the logging overhead per transition of a full handler run at INFO and at DEBUG level.
+
+Records are formatted and written to an in memory stream, so the numbers include argument formatting but no I/O.
+
+Usage: python -m benchmark.log_level [states] [rounds]
+"""
+import io
+import logging
+import sys
+import timeit
+from unittest import mock
+
+from AutoscalingLifecycle import Event
+from AutoscalingLifecycle import LifecycleHandler
+from AutoscalingLifecycle.logging import Logging
+from benchmark.transition_table import BenchmarkModel
+
+
+def create_model(level) -> BenchmarkModel:
+    log = Logging('BENCHMARK', level = level)
+    log.add_handler(logging.StreamHandler(io.StringIO()), '[%(levelname)s] [%(name)s] %(message)s')
+
+    model = BenchmarkModel(mock.MagicMock(), mock.MagicMock(), log, 'benchmark', 'benchmark')
+    model.event = Event({ 'source': 'aws.events', 'detail-type': 'Scheduled Event', 'resources': ['benchmark'] })
+    # at DEBUG level every transition is also reported, publish to the mocked topic directly instead of a worker
+    model.digest_notifications = False
+
+    return model
+
+
+def measure(level, states: int, rounds: int) -> float:
+    model = create_model(level)
+
+
+    def run():
+        model._state = 'state_0'
+        LifecycleHandler(model)()
+
+
+    run()
+
+    return min(timeit.repeat(run, number = rounds, repeat = 3)) / rounds / states
+
+
+def main(states: int = 20, rounds: int = 50):
+    BenchmarkModel.size = states
+    disabled_time = measure(logging.CRITICAL, states, rounds)
+    info_time = measure(logging.INFO, states, rounds)
+    debug_time = measure(logging.DEBUG, states, rounds)
+
+    print('states: %d' % states)
+    print('transition without logging: %.1f us' % (disabled_time * 1000000))
+    print('logging overhead at INFO: %.1f us per transition' % ((info_time - disabled_time) * 1000000))
+    print('logging overhead at DEBUG: %.1f us per transition' % ((debug_time - disabled_time) * 1000000))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
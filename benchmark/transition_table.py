@@ -0,0 +1,79 @@
+"""
+Compare compiling a transition table on every handler construction with reusing the cached table.
+
+Usage: python -m benchmark.transition_table [states] [rounds]
+"""
+import sys
+import timeit
+from unittest import mock
+
+from AutoscalingLifecycle import LifecycleHandler
+from AutoscalingLifecycle import Model
+from AutoscalingLifecycle import TransitionTable
+from AutoscalingLifecycle.logging import Logging
+
+
+class BenchmarkModel(Model):
+    size = 40
+
+
+    def get_transitions(self):
+        transitions = []
+        for i in range(self.size):
+            transitions.append({
+                'source': 'state_%d' % i,
+                'dest': 'state_%d' % (i + 1),
+                'triggers': [
+                    {
+                        'name': 'trigger_%d' % i,
+                        'conditions': [self.is_true],
+                        'before': [self.do_nothing],
+                        'after': [self.do_nothing],
+                    },
+                ]
+            })
+
+        return transitions
+
+
+    def is_true(self, *args):
+        return True
+
+
+    def do_nothing(self, *args):
+        pass
+
+
+def create_model() -> BenchmarkModel:
+    model = BenchmarkModel(mock.Mock(), mock.Mock(), Logging('BENCHMARK'), 'benchmark', 'benchmark')
+    model._state = 'state_0'
+
+    return model
+
+
+def main(states: int = 40, rounds: int = 200):
+    BenchmarkModel.size = states
+    model = create_model()
+
+
+    def cold():
+        TransitionTable.clear()
+        LifecycleHandler(model)
+
+
+    def warm():
+        LifecycleHandler(model)
+
+
+    warm()
+    cold_time = min(timeit.repeat(cold, number = rounds, repeat = 3)) / rounds
+    warm_time = min(timeit.repeat(warm, number = rounds, repeat = 3)) / rounds
+
+    print('states: %d' % states)
+    print('cold build: %.3f ms' % (cold_time * 1000))
+    print('cached reuse: %.3f ms' % (warm_time * 1000))
+    print('speedup: %.1fx' % (cold_time / warm_time))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,172 @@
+import json
+import threading
+import time
+import unittest
+from unittest import mock
+
+from AutoscalingLifecycle.batch import BatchProcessor
+from AutoscalingLifecycle.clients import Route53Client
+from AutoscalingLifecycle.exceptions import EventNotSupportedError
+from test.test_lifecycle_handler import get_fixture
+
+
+def get_record(file, message_id, instance_id = None):
+    fh = get_fixture(file)
+    record = json.load(fh).get('Records')[0]
+    fh.close()
+
+    message = json.loads(record.get('Sns').get('Message'))
+    if instance_id is not None:
+        message.get('detail').update({ 'EC2InstanceId': instance_id })
+    record.get('Sns').update({ 'MessageId': message_id, 'Message': json.dumps(message) })
+
+    return record
+
+
+class RecordingHandler(object):
+    calls = []
+    lock = threading.Lock()
+    failing = set()
+
+
+    def __init__(self, model):
+        self.model = model
+
+
+    def __call__(self):
+        instance_id = self.model.event.get_lifecycle_data().get_instance_id() \
+            if self.model.event.is_lifecycle() else None
+        with self.lock:
+            self.calls.append((threading.current_thread().name, instance_id, self.model.event.get_name()))
+        time.sleep(0.01)
+        if self.model.event.get_raw().get('id') in self.failing:
+            raise RuntimeError('failed')
+
+
+class DnsHandler(object):
+    route53 = None
+    barrier = None
+
+
+    def __init__(self, model):
+        self.model = model
+
+
+    def __call__(self):
+        instance_id = self.model.event.get_lifecycle_data().get_instance_id()
+        # a change without a zone, applied to the zone of the instance
+        self.route53.add_dns_change_set(instance_id + '.example.com', [{ 'Value': instance_id }], 60)
+        self.barrier.wait(5)
+        self.route53.apply_dns_change_set('zone-' + instance_id)
+
+
+class TestBatchProcessor(unittest.TestCase):
+
+    def setUp(self):
+        RecordingHandler.calls = []
+        RecordingHandler.failing = set()
+        self.models = []
+        self.processor = BatchProcessor(self.create_model, mock.Mock(), 4)
+        self.processor.handler_cls = RecordingHandler
+
+
+    def create_model(self):
+        model = mock.Mock()
+        model.initialize.side_effect = lambda event: setattr(model, 'event', event)
+        self.models.append(model)
+
+        return model
+
+
+    def get_records(self):
+        records = []
+        for i in range(3):
+            for instance in ['i-1', 'i-2']:
+                record = get_record('autoscaling_event.json', '%s-%s' % (instance, i), instance)
+                message = json.loads(record.get('Sns').get('Message'))
+                message.update({ 'id': '%s-%s' % (instance, i) })
+                record.get('Sns').update({ 'Message': json.dumps(message) })
+                records.append(record)
+
+        return records
+
+
+    def test_records_of_an_instance_are_processed_in_order(self):
+        results = self.processor.process(self.get_records())
+
+        self.assertEqual(6, len(results))
+        self.assertTrue(all([result.is_successful() for result in results]))
+        self.assertEqual(['i-1-0', 'i-2-0', 'i-1-1', 'i-2-1', 'i-1-2', 'i-2-2'], [result.id for result in results])
+        for instance in ['i-1', 'i-2']:
+            threads = set([call[0] for call in RecordingHandler.calls if call[1] == instance])
+            self.assertEqual(1, len(threads))
+        self.assertEqual(6, len(self.models))
+
+
+    def test_failure_skips_remaining_records_of_the_instance(self):
+        RecordingHandler.failing = { 'i-1-1' }
+        response = self.processor(self.get_records())
+
+        self.assertEqual(
+            { 'batchItemFailures': [{ 'itemIdentifier': 'i-1-1' }, { 'itemIdentifier': 'i-1-2' }] },
+            response
+        )
+        self.assertEqual(5, len(RecordingHandler.calls))
+
+
+    def test_unparsable_records_fail(self):
+        records = [{ 'messageId': 'broken', 'body': 'not json' }, get_record('scheduled_event.json', 'scheduled')]
+        results = self.processor.process(records)
+
+        self.assertFalse(results[0].is_successful())
+        self.assertTrue(results[1].is_successful())
+        self.assertIsNone(results[1].instance_id)
+
+
+    def test_sqs_records_with_sns_notifications_are_unwrapped(self):
+        sns = get_record('autoscaling_event.json', 'sns', 'i-3').get('Sns')
+        records = [{ 'messageId': 'sqs', 'body': json.dumps({ 'Type': 'Notification', 'Message': sns.get('Message') }) }]
+        results = self.processor.process(records)
+
+        self.assertEqual('sqs', results[0].id)
+        self.assertEqual('i-3', results[0].instance_id)
+
+
+    def test_unsupported_events_are_ignored(self):
+        self.processor.model_factory = mock.Mock()
+        self.processor.model_factory.return_value.initialize.side_effect = EventNotSupportedError('unsupported')
+        response = self.processor([get_record('ssm_event.json', 'command')])
+
+        self.assertEqual({ 'batchItemFailures': [] }, response)
+        self.assertEqual(0, len(RecordingHandler.calls))
+
+
+    def test_dns_changes_of_groups_processed_in_parallel_are_kept_apart(self):
+        boto_client = mock.Mock()
+        boto_client.change_resource_record_sets.return_value = { 'ChangeInfo': { 'Id': 'change' } }
+        route53 = Route53Client(boto_client, mock.Mock(), mock.Mock())
+        DnsHandler.route53 = route53
+        DnsHandler.barrier = threading.Barrier(2)
+
+
+        def create_model():
+            model = mock.Mock()
+            # like Model.initialize() resetting the clients
+            model.initialize.side_effect = lambda event: (setattr(model, 'event', event), route53.reset())
+
+            return model
+
+
+        processor = BatchProcessor(create_model, mock.Mock(), 2)
+        processor.handler_cls = DnsHandler
+        records = [record for record in self.get_records() if record.get('Sns').get('MessageId').endswith('-0')]
+        results = processor.process(records)
+
+        self.assertTrue(all([result.is_successful() for result in results]))
+        applied = {
+            call[1].get('HostedZoneId'): [
+                change.get('ResourceRecordSet').get('Name') for change in call[1].get('ChangeBatch').get('Changes')
+            ]
+            for call in boto_client.change_resource_record_sets.call_args_list
+        }
+        self.assertEqual({ 'zone-i-1': ['i-1.example.com'], 'zone-i-2': ['i-2.example.com'] }, applied)
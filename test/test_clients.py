@@ -0,0 +1,936 @@
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import boto3
+from botocore.exceptions import ClientError
+from botocore.exceptions import WaiterError
+
+from AutoscalingLifecycle.clients import AutoscalingClient
+from AutoscalingLifecycle.clients import Backoff
+from AutoscalingLifecycle.clients import ClientFactory
+from AutoscalingLifecycle.clients import CustomWaiters
+from AutoscalingLifecycle.clients import DynamoDbClient
+from AutoscalingLifecycle.clients import Ec2Client
+from AutoscalingLifecycle.clients import Route53Client
+from AutoscalingLifecycle.clients import SecretsmanagerClient
+from AutoscalingLifecycle.clients import SsmClient
+from AutoscalingLifecycle.entity import NodeRepository
+from AutoscalingLifecycle.exceptions import WaitTimeoutError
+from AutoscalingLifecycle.ledger import CallLedger
+from AutoscalingLifecycle.logging import Logging
+
+
+def get_activity(description, progress = 100):
+    return {
+        'Description': description,
+        'Progress': progress,
+        'StatusCode': 'Successful' if progress == 100 else 'InProgress'
+    }
+
+
+class TestClientFactory(unittest.TestCase):
+
+    def setUp(self):
+        session = boto3.Session(aws_access_key_id = 'key', aws_secret_access_key = 'secret', region_name = 'eu-west-1')
+        self.factory = ClientFactory(session, 'eu-west-1', mock.Mock(), { 'sns': { 'max_pool_connections': 3 } })
+
+
+    def test_clients_are_created_with_service_profiles(self):
+        dynamodb = self.factory.get('dynamodb')
+        sns = self.factory.get('sns', 'eu-central-1')
+
+        self.assertEqual(25, dynamodb.meta.config.max_pool_connections)
+        self.assertEqual('standard', dynamodb.meta.config.retries.get('mode'))
+        self.assertTrue(dynamodb.meta.config.tcp_keepalive)
+        self.assertEqual(3, sns.meta.config.max_pool_connections)
+        self.assertEqual('eu-central-1', sns.meta.region_name)
+
+
+    def test_profiles_are_merged(self):
+        profile = self.factory.get_profile('route53')
+
+        self.assertEqual({ 'mode': 'adaptive', 'max_attempts': 10 }, profile.get('retries'))
+        self.assertEqual(10, profile.get('max_pool_connections'))
+
+
+    def test_concurrent_callers_share_one_client(self):
+        with ThreadPoolExecutor(max_workers = 8) as executor:
+            clients = list(executor.map(lambda _: self.factory.get('ssm'), range(16)))
+
+        self.assertEqual(1, len(set([id(client) for client in clients])))
+
+
+    def test_prewarm_creates_clients_concurrently(self):
+        failed = self.factory.prewarm(['dynamodb', 'ssm', ('sns', 'eu-central-1'), 'no-such-service'])
+
+        self.assertEqual(['no-such-service'], failed)
+        self.assertEqual(
+            ['dynamodb_eu-west-1', 'sns_eu-central-1', 'ssm_eu-west-1'],
+            sorted(self.factory.clients.keys())
+        )
+
+
+    def test_first_client_is_created_before_any_other(self):
+        session = mock.Mock()
+        calls = []
+        lock = threading.Lock()
+
+
+        def create_client(name, **kwargs):
+            with lock:
+                calls.append(('start', name))
+            time.sleep(0.02)
+            with lock:
+                calls.append(('end', name))
+
+            return mock.Mock()
+
+
+        session.client.side_effect = create_client
+        factory = ClientFactory(session, 'eu-west-1', mock.Mock())
+
+        with ThreadPoolExecutor(max_workers = 4) as executor:
+            list(executor.map(factory.get, ['dynamodb', 'ssm', 'sns', 'ec2']))
+
+        self.assertEqual('start', calls[0][0])
+        self.assertEqual(('end', calls[0][1]), calls[1])
+        self.assertEqual(8, len(calls))
+
+
+    def test_prewarm_creates_waiters_and_their_clients(self):
+        waiters = CustomWaiters(self.factory, Logging('TEST').get_logger())
+
+        self.assertEqual([], waiters.prewarm())
+        self.assertEqual(
+            ['autoscaling', 'dynamodb', 'route53', 'ssm'],
+            sorted([key.split('_')[0] for key in self.factory.clients])
+        )
+        self.assertEqual(sorted(waiters.get_waiter_names()), sorted(waiters.waiters.keys()))
+
+
+class TestAutoscalingClient(unittest.TestCase):
+
+    def setUp(self):
+        self.boto_client = mock.Mock()
+        self.paginator = self.boto_client.get_paginator.return_value
+        self.paginator.paginate.return_value = [
+            {
+                'Activities': [
+                    get_activity('Launching a new EC2 instance: i-1', 50),
+                    get_activity('Terminating EC2 instance: i-2'),
+                ]
+            },
+            {
+                'Activities': [
+                    get_activity('Launching a new EC2 instance: i-1'),
+                    get_activity('Launching a new EC2 instance: i-3'),
+                ]
+            },
+        ]
+        self.client = AutoscalingClient(self.boto_client, mock.Mock(), Logging('TEST'))
+
+
+    def test_activities_are_loaded_from_all_pages(self):
+        self.assertEqual(
+            'Launching a new EC2 instance: i-3',
+            self.client.get_activity('group', True, 'i-3').get('Description')
+        )
+        self.boto_client.get_paginator.assert_called_once_with('describe_scaling_activities')
+
+
+    def test_latest_activity_is_returned(self):
+        self.assertEqual(50, self.client.get_activity('group', True, 'i-1').get('Progress'))
+
+
+    def test_activities_are_indexed_by_direction(self):
+        self.assertEqual({ }, self.client.get_activity('group', True, 'i-2'))
+        self.assertEqual(100, self.client.get_activity('group', False, 'i-2').get('Progress'))
+        self.assertEqual(100, self.client.get_autoscaling_activity('group', 'is terminating', 'i-2').get('Progress'))
+
+
+    def test_activities_are_loaded_once_per_group(self):
+        self.client.get_activity('group', True, 'i-1')
+        self.client.get_activity('group', False, 'i-2')
+        self.client.get_activity('group', True, 'unknown')
+        self.client.get_activity('other', True, 'i-1')
+
+        self.assertEqual(2, self.paginator.paginate.call_count)
+
+
+    def test_complete_lifecycle_action_invalidates_activities(self):
+        self.client.get_activity('group', True, 'i-1')
+        self.client.complete_lifecycle_action('hook', 'group', 'token', 'CONTINUE', 'i-1')
+        self.client.get_activity('group', True, 'i-1')
+
+        self.assertEqual(2, self.paginator.paginate.call_count)
+
+
+    def test_reset_invalidates_activities(self):
+        self.client.get_activity('group', True, 'i-1')
+        self.client.reset()
+        self.client.get_activity('group', True, 'i-1')
+
+        self.assertEqual(2, self.paginator.paginate.call_count)
+
+
+class TestDynamoDbClient(unittest.TestCase):
+
+    def setUp(self):
+        self.boto_client = mock.Mock()
+        self.boto_client.scan.side_effect = self.scan
+        self.client = DynamoDbClient(self.boto_client, mock.Mock(), Logging('TEST'), 'table')
+
+
+    def scan(self, **kwargs):
+        """
+        Two pages per segment with two items each
+        """
+        segment = kwargs.get('Segment', 0)
+        page = 1 if kwargs.get('ExclusiveStartKey', None) is not None else 0
+        response = {
+            'Items': [
+                {
+                    'Ident': { 'S': 'i-%s-%s-%s' % (segment, page, i) },
+                    'ItemType': { 'S': 'worker' },
+                    'ItemStatus': { 'S': 'ready' }
+                } for i in range(2)
+            ]
+        }
+        if page == 0:
+            response.update({ 'LastEvaluatedKey': { 'Ident': { 'S': 'i-%s-0-1' % segment } } })
+
+        return response
+
+
+    def test_scan_follows_last_evaluated_key(self):
+        items = self.client.scan('ItemType = :type', { ':type': 'worker' })
+
+        self.boto_client.scan.assert_not_called()
+        self.assertEqual(['i-0-0-0', 'i-0-0-1', 'i-0-1-0', 'i-0-1-1'], [item.get('Ident') for item in items])
+        self.assertEqual(2, self.boto_client.scan.call_count)
+        self.assertEqual(
+            { 'Ident': { 'S': 'i-0-0-1' } },
+            self.boto_client.scan.call_args_list[1][1].get('ExclusiveStartKey')
+        )
+
+
+    def test_parallel_scan_yields_items_of_all_segments(self):
+        items = list(self.client.scan('ItemType = :type', { ':type': 'worker' }, 3))
+
+        self.assertEqual(12, len(items))
+        self.assertEqual(6, self.boto_client.scan.call_count)
+        for call in self.boto_client.scan.call_args_list:
+            self.assertEqual(3, call[1].get('TotalSegments'))
+        self.assertEqual(
+            [0, 1, 2],
+            sorted(set([call[1].get('Segment') for call in self.boto_client.scan.call_args_list]))
+        )
+
+
+    def test_parallel_scan_raises_segment_errors(self):
+        self.boto_client.scan.side_effect = RuntimeError('scan failed')
+
+        with self.assertRaises(RuntimeError):
+            list(self.client.scan('ItemType = :type', { ':type': 'worker' }, 2))
+
+
+    def test_get_by_type_uses_scan_segments(self):
+        repository = NodeRepository(self.client, mock.Mock())
+        repository.scan_segments = 2
+        nodes = repository.get_by_type(['worker'])
+
+        self.assertEqual(8, len(nodes))
+        self.assertEqual('worker', nodes[0].get_type())
+        self.assertEqual('ready', nodes[0].get_state())
+
+
+    @mock.patch('AutoscalingLifecycle.clients.time.sleep')
+    def test_wait_for_item_polls_with_consistent_reads(self, sleep):
+        self.boto_client.get_item.side_effect = [
+            { },
+            { 'Item': { 'Ident': { 'S': 'i-1' }, 'ItemStatus': { 'S': 'pending' } } },
+            { 'Item': { 'Ident': { 'S': 'i-1' }, 'ItemStatus': { 'S': 'finished_cloud_init' } } },
+        ]
+        item = self.client.wait_for_item('i-1', lambda item: item.get('ItemStatus') == 'finished_cloud_init')
+
+        self.assertEqual('finished_cloud_init', item.get('ItemStatus'))
+        self.assertEqual(3, self.boto_client.get_item.call_count)
+        self.assertTrue(self.boto_client.get_item.call_args[1].get('ConsistentRead'))
+        self.assertEqual(2, sleep.call_count)
+        self.boto_client.scan.assert_not_called()
+
+
+    @mock.patch('AutoscalingLifecycle.clients.time.sleep')
+    def test_wait_for_scan_count_gt0_follows_pages(self, sleep):
+        self.client.wait_for_scan_count_gt0('ItemType = :type', { ':type': 'worker' })
+
+        sleep.assert_not_called()
+        self.assertEqual(2, self.boto_client.scan.call_count)
+
+
+class TestSsmClient(unittest.TestCase):
+
+    def setUp(self):
+        self.boto_client = mock.Mock()
+        self.boto_client.send_command.side_effect = lambda **kwargs: {
+            'Command': { 'CommandId': 'command-%s' % self.boto_client.send_command.call_count }
+        }
+        self.client = SsmClient(self.boto_client, mock.Mock(), Logging('TEST'))
+        # a fixed ping status or the number of polls before the agent is online by instance id
+        self.agents = { }
+        self.polls = 0
+
+
+        def get_status(instance_id):
+            agent = self.agents.get(instance_id, 0)
+            if type(agent) is str:
+                return agent
+
+            return 'Online' if self.polls > agent else 'ConnectionLost'
+
+
+        def paginate(Filters):
+            self.polls += 1
+            return [{ 'InstanceInformationList': [
+                { 'InstanceId': instance_id, 'PingStatus': get_status(instance_id) }
+                for instance_id in Filters[0].get('Values')
+            ] }]
+
+
+        self.boto_client.get_paginator.return_value.paginate.side_effect = paginate
+
+
+    def get_dispatched(self) -> list:
+        return [call[1].get('InstanceIds') for call in self.boto_client.send_command.call_args_list]
+
+
+    @mock.patch('AutoscalingLifecycle.clients.time.sleep')
+    def test_ready_instances_are_dispatched_while_waiting_for_others(self, sleep):
+        self.agents = { 'i-2': 1 }
+        dispatched = []
+        command_ids = self.client.dispatch_command(
+            ['i-1', 'i-2', 'i-3'],
+            'join',
+            ['/bin/join.sh'],
+            on_dispatch = lambda command_id, instance_ids: dispatched.append((command_id, instance_ids))
+        )
+
+        self.assertEqual(['command-1', 'command-2'], command_ids)
+        self.assertEqual([('command-1', ['i-1', 'i-3']), ('command-2', ['i-2'])], dispatched)
+        self.assertEqual(1, sleep.call_count)
+
+
+    @mock.patch('AutoscalingLifecycle.clients.time.sleep')
+    def test_large_target_sets_are_chunked(self, sleep):
+        instance_ids = ['i-%s' % index for index in range(120)]
+        self.client.dispatch_command(instance_ids, 'join', ['/bin/join.sh'], 60, '10%', '5')
+
+        self.assertEqual([50, 50, 20], [len(chunk) for chunk in self.get_dispatched()])
+        self.assertEqual(3, self.polls)
+        self.assertEqual('10%', self.boto_client.send_command.call_args[1].get('MaxConcurrency'))
+        self.assertEqual('5', self.boto_client.send_command.call_args[1].get('MaxErrors'))
+        sleep.assert_not_called()
+
+
+    @mock.patch('AutoscalingLifecycle.clients.time.sleep')
+    def test_inactive_agents_within_max_errors_are_skipped(self, sleep):
+        self.agents = { 'i-2': 'Inactive' }
+        failures = []
+
+        self.assertEqual(['command-1'], self.client.dispatch_command(
+            ['i-1', 'i-2'],
+            'join',
+            [],
+            max_errors = '50%',
+            on_failure = failures.append
+        ))
+        self.assertEqual([['i-1']], self.get_dispatched())
+        self.assertEqual([['i-2']], failures)
+
+
+    @mock.patch('AutoscalingLifecycle.clients.time.sleep')
+    def test_inactive_agents_exceeding_max_errors_raise(self, sleep):
+        self.agents = { 'i-2': 'Inactive' }
+
+        with self.assertRaises(WaiterError):
+            self.client.dispatch_command(['i-1', 'i-2'], 'join', [])
+
+
+    def test_agents_failing_after_the_first_command_do_not_raise(self):
+        self.agents = { 'i-2': 'ConnectionLost' }
+        self.client.agent_backoff = Backoff(delay = 0.001, max_delay = 0.001, timeout = 0.01, jitter = False)
+        failures = []
+
+        self.assertEqual(['command-1'], self.client.dispatch_command(
+            ['i-1', 'i-2'],
+            'join',
+            [],
+            on_failure = failures.append
+        ))
+        self.assertEqual([['i-2']], failures)
+
+
+    def test_agents_are_not_waited_for_beyond_the_deadline(self):
+        self.agents = { 'i-1': 'ConnectionLost' }
+        failures = []
+        start = time.monotonic()
+
+        with self.assertRaises(WaiterError):
+            self.client.dispatch_command(['i-1'], 'join', [], on_failure = failures.append, deadline = start + 0.05)
+        self.assertLess(time.monotonic() - start, 1)
+        self.boto_client.send_command.assert_not_called()
+
+
+    @mock.patch('AutoscalingLifecycle.clients.time.sleep')
+    def test_wait_for_command_polls_invocations(self, sleep):
+        self.boto_client.get_paginator.return_value.paginate.side_effect = [
+            [{ 'CommandInvocations': [] }],
+            [{ 'CommandInvocations': [{ 'InstanceId': 'i-1', 'Status': 'InProgress' }] }],
+            [{ 'CommandInvocations': [{ 'InstanceId': 'i-1', 'Status': 'Success' }] }],
+        ]
+
+        self.assertEqual({ 'i-1': 'Success' }, self.client.wait_for_command('command-1', ['i-1']))
+        self.assertEqual(2, sleep.call_count)
+
+
+    def test_wait_for_command_gives_up_at_the_deadline(self):
+        self.boto_client.get_paginator.return_value.paginate.side_effect = None
+        self.boto_client.get_paginator.return_value.paginate.return_value = [
+            { 'CommandInvocations': [{ 'InstanceId': 'i-1', 'Status': 'InProgress' }] }
+        ]
+
+        self.assertIsNone(self.client.wait_for_command('command-1', ['i-1'], time.monotonic() + 0.01))
+
+
+    @mock.patch('AutoscalingLifecycle.clients.time.sleep')
+    def test_agents_seen_online_are_not_checked_again(self, sleep):
+        self.client.send_command(['i-1', 'i-2'], 'join', [])
+        self.client.send_command('i-1', 'configure', [])
+        self.client.send_command(['i-2', 'i-3'], 'start', [])
+
+        self.assertEqual(2, self.polls)
+        self.assertEqual(
+            [['i-1', 'i-2'], ['i-3']],
+            [
+                call[1].get('Filters')[0].get('Values')
+                for call in self.boto_client.get_paginator.return_value.paginate.call_args_list
+            ]
+        )
+        self.assertEqual(3, self.boto_client.send_command.call_count)
+
+
+    def test_agents_are_checked_again_after_ttl(self):
+        self.client.agent_ttl = 0
+        self.client.get_agent_statuses(['i-1'])
+        self.client.get_agent_statuses(['i-1'])
+
+        self.assertEqual(2, self.polls)
+
+
+    def test_failed_sends_invalidate_agents(self):
+        self.boto_client.send_command.side_effect = ClientError(
+            { 'Error': { 'Code': 'InvalidInstanceId' } },
+            'SendCommand'
+        )
+
+        with self.assertRaises(ClientError):
+            self.client.send_command('i-1', 'join', [])
+        self.client.get_agent_statuses(['i-1'])
+
+        self.assertEqual(2, self.polls)
+
+
+    @mock.patch('AutoscalingLifecycle.clients.time.sleep')
+    def test_inactive_agents_fail_send_command(self, sleep):
+        self.agents = { 'i-2': 'Inactive' }
+
+        with self.assertRaises(WaiterError):
+            self.client.send_command(['i-1', 'i-2'], 'join', [])
+        self.boto_client.send_command.assert_not_called()
+
+
+    def test_error_limit(self):
+        self.assertEqual(0, SsmClient.get_error_limit(None, 10))
+        self.assertEqual(3, SsmClient.get_error_limit('3', 10))
+        self.assertEqual(2, SsmClient.get_error_limit('25%', 10))
+
+
+class TestEc2Client(unittest.TestCase):
+
+    def setUp(self):
+        self.boto_client = mock.Mock()
+        # running instances, returned with two reservations per page and two pages per call
+        self.running = ['i-%s' % index for index in range(300)]
+
+
+        def paginate(Filters):
+            ids = [instance_id for instance_id in Filters[0].get('Values') if instance_id in self.running]
+            if Filters[0].get('Name') == 'tag:Name':
+                ids = self.running[:3]
+            reservations = [{ 'Instances': [{ 'InstanceId': instance_id }] } for instance_id in ids]
+            return [{ 'Reservations': reservations[:2] }, { 'Reservations': reservations[2:] }]
+
+
+        self.boto_client.get_paginator.return_value.paginate.side_effect = paginate
+        self.client = Ec2Client(self.boto_client, mock.Mock(), Logging('TEST'))
+
+
+    def get_calls(self) -> list:
+        return [call[1].get('Filters') for call in self.boto_client.get_paginator.return_value.paginate.call_args_list]
+
+
+    def test_instances_are_described_in_chunks(self):
+        instance_ids = ['i-%s' % index for index in range(250)] + ['i-999', 'i-1']
+        instances = self.client.get_instances(instance_ids)
+
+        self.assertEqual(['i-%s' % index for index in range(250)], list(instances.keys()))
+        self.assertEqual({ 'InstanceId': 'i-42' }, instances.get('i-42'))
+        self.assertEqual([200, 51], [len(filters[0].get('Values')) for filters in self.get_calls()])
+        self.assertEqual(
+            { 'Name': 'instance-state-name', 'Values': ['running'] },
+            self.get_calls()[0][1]
+        )
+
+
+    def test_instances_are_cached_for_the_invocation(self):
+        self.client.get_instances(['i-1', 'i-2', 'i-999'])
+
+        self.assertEqual({ 'InstanceId': 'i-1' }, self.client.get_instance('i-1'))
+        self.assertEqual({ }, self.client.get_instance('i-999'))
+        self.assertEqual(['i-2', 'i-3'], list(self.client.get_instances(['i-2', 'i-3']).keys()))
+        self.assertEqual(
+            [['i-1', 'i-2', 'i-999'], ['i-999'], ['i-3']],
+            [filters[0].get('Values') for filters in self.get_calls()]
+        )
+
+        self.client.reset()
+        self.client.get_instance('i-1')
+        self.assertEqual(4, len(self.get_calls()))
+
+
+    def test_instances_that_are_not_running_yet_are_described_again(self):
+        self.assertEqual({ }, self.client.get_instance('i-999'))
+        self.running.append('i-999')
+
+        self.assertEqual({ 'InstanceId': 'i-999' }, self.client.get_instance('i-999'))
+
+
+    def test_instances_found_by_name_are_cached(self):
+        self.assertEqual(3, len(self.client.find_instances_by_name('worker')))
+        self.assertEqual('tag:Name', self.get_calls()[0][0].get('Name'))
+
+        self.client.get_instances(['i-0', 'i-1', 'i-2'])
+        self.assertEqual(1, len(self.get_calls()))
+
+        self.client.invalidate_instances(['i-0'])
+        self.client.get_instances(['i-0', 'i-1', 'i-2'])
+        self.assertEqual(['i-0'], self.get_calls()[1][0].get('Values'))
+
+
+class TestRoute53Client(unittest.TestCase):
+
+    def setUp(self):
+        self.boto_client = mock.Mock()
+        self.boto_client.change_resource_record_sets.side_effect = lambda **kwargs: {
+            'ChangeInfo': { 'Id': 'change-%s' % self.boto_client.change_resource_record_sets.call_count }
+        }
+        self.record_sets = []
+        self.boto_client.list_resource_record_sets.side_effect = self.list_resource_record_sets
+        self.waiters = mock.Mock()
+        self.client = Route53Client(self.boto_client, self.waiters, Logging('TEST'))
+
+
+    def list_resource_record_sets(self, HostedZoneId, StartRecordName, StartRecordType, MaxItems):
+        """
+        Records ordered like route53 does: by the labels of their names in reverse order and by type
+        """
+
+
+        def get_order(name, record_type):
+            return list(reversed(name.rstrip('.').replace('\\052', '*').split('.'))), record_type
+
+
+        start = get_order(StartRecordName, StartRecordType)
+        record_sets = [
+            record_set
+            for record_set in sorted(self.record_sets, key = lambda r: get_order(r.get('Name'), r.get('Type')))
+            if get_order(record_set.get('Name'), record_set.get('Type')) >= start
+        ]
+
+        return {
+            'ResourceRecordSets': record_sets[:int(MaxItems)],
+            'IsTruncated': len(record_sets) > int(MaxItems)
+        }
+
+
+    def add_record_set(self, name: str, values: list, ttl: int = 60):
+        self.record_sets.append({
+            'Name': name + '.',
+            'Type': 'A',
+            'TTL': ttl,
+            'ResourceRecords': [{ 'Value': value } for value in values]
+        })
+
+
+    def get_batches(self) -> list:
+        return [
+            call[1].get('ChangeBatch').get('Changes')
+            for call in self.boto_client.change_resource_record_sets.call_args_list
+        ]
+
+
+    def test_changes_of_a_record_are_merged(self):
+        self.client.add_dns_change_set('a.example.com', [{ 'Value': '10.0.0.1' }], 60)
+        self.client.add_dns_change_set('b.example.com', [{ 'Value': '10.0.0.2' }], 60)
+        self.client.add_dns_change_set('A.example.com.', [{ 'Value': '10.0.0.3' }], 60)
+        self.client.add_dns_change_set('c.example.com', [{ 'Value': '10.0.0.4' }], 60, 'CREATE')
+        self.client.add_dns_change_set('c.example.com', [{ 'Value': '10.0.0.4' }], 60, 'DELETE')
+        self.client.add_dns_change_set('d.example.com', [{ 'Value': '10.0.0.5' }], 60, 'DELETE')
+        self.client.add_dns_change_set('d.example.com', [{ 'Value': '10.0.0.6' }], 60, 'CREATE')
+
+        self.assertEqual(['change-1'], self.client.apply_dns_change_set('zone'))
+        self.assertEqual(
+            [
+                ('UPSERT', 'b.example.com', '10.0.0.2'),
+                ('UPSERT', 'A.example.com.', '10.0.0.3'),
+                ('UPSERT', 'd.example.com', '10.0.0.6')
+            ],
+            [
+                (
+                    change.get('Action'),
+                    change.get('ResourceRecordSet').get('Name'),
+                    change.get('ResourceRecordSet').get('ResourceRecords')[0].get('Value')
+                )
+                for change in self.get_batches()[0]
+            ]
+        )
+        self.assertEqual([], self.client.dns_change_set)
+
+
+    def test_changes_are_applied_per_zone(self):
+        self.client.add_dns_change_set('a.example.com', [{ 'Value': '10.0.0.1' }], 60, zone_id = 'zone-1')
+        self.client.add_dns_change_set('b.example.com', [{ 'Value': '10.0.0.2' }], 60, zone_id = 'zone-2')
+        self.client.add_dns_change_set('c.example.com', [{ 'Value': '10.0.0.3' }], 60)
+
+        self.client.apply_dns_change_set('zone-1')
+
+        self.assertEqual('zone-1', self.boto_client.change_resource_record_sets.call_args[1].get('HostedZoneId'))
+        self.assertEqual(2, len(self.get_batches()[0]))
+        self.boto_client.list_resource_record_sets.assert_not_called()
+        self.assertEqual(['b.example.com'], [
+            change.get('ResourceRecordSet').get('Name') for change in self.client.dns_change_set
+        ])
+
+
+    def test_changes_are_split_at_request_limits(self):
+        for index in range(700):
+            self.client.add_dns_change_set('node-%s.example.com' % index, [{ 'Value': '10.0.0.1' }], 60, 'DELETE')
+        self.client.add_dns_change_set('all.example.com', [{ 'Value': '10.0.0.%s' % i } for i in range(200)], 60)
+
+        self.assertEqual(['change-1', 'change-2'], self.client.apply_dns_change_set('zone'))
+        self.assertEqual([700, 1], [len(batch) for batch in self.get_batches()])
+
+        self.client.max_characters = 100
+        self.client.add_dns_change_set('a.example.com', [{ 'Value': 'x' * 40 }], 60)
+        self.client.add_dns_change_set('b.example.com', [{ 'Value': 'x' * 40 }], 60)
+        self.client.apply_dns_change_set('zone')
+        self.assertEqual([700, 1, 1, 1], [len(batch) for batch in self.get_batches()])
+
+
+    def test_changes_that_were_not_applied_are_kept(self):
+        self.client.max_changes = 1
+        self.boto_client.change_resource_record_sets.side_effect = [
+            { 'ChangeInfo': { 'Id': 'change-1' } },
+            ClientError({ 'Error': { 'Code': 'Throttling' } }, 'ChangeResourceRecordSets')
+        ]
+        self.client.add_dns_change_set('a.example.com', [{ 'Value': '10.0.0.1' }], 60)
+        self.client.add_dns_change_set('b.example.com', [{ 'Value': '10.0.0.2' }], 60)
+
+        with self.assertRaises(ClientError):
+            self.client.apply_dns_change_set('zone')
+
+        self.assertEqual(['b.example.com'], [
+            change.get('ResourceRecordSet').get('Name') for change in self.client.dns_change_set
+        ])
+        self.assertEqual(['change-1'], self.client.changes)
+
+
+    def test_wait_for_changes_of_the_invocation(self):
+        self.client.add_dns_change_set('a.example.com', [{ 'Value': '10.0.0.1' }], 60, zone_id = 'zone-1')
+        self.client.add_dns_change_set('b.example.com', [{ 'Value': '10.0.0.2' }], 60, zone_id = 'zone-2')
+        self.client.apply_dns_change_set('zone-1')
+        self.client.apply_dns_change_set('zone-2')
+
+        self.client.wait_for_changes()
+
+        self.waiters.get.assert_called_once_with('ChangeInSync')
+        waiter = self.waiters.get.return_value
+        self.waiters.wait_all.assert_called_once_with([(waiter, { 'Id': 'change-1' }), (waiter, { 'Id': 'change-2' })])
+        self.assertEqual([], self.client.changes)
+
+
+    def test_only_differences_are_applied(self):
+        self.client.diff_changes = True
+        self.add_record_set('a.example.com', ['10.0.0.2', '10.0.0.1'])
+        self.add_record_set('other.example.com', ['10.0.0.9'])
+        self.add_record_set('b.example.com', ['10.0.0.2'])
+        self.add_record_set('c.example.com', ['10.0.0.3'])
+        self.add_record_set('\\052.example.com', ['10.0.0.4'])
+        self.client.add_dns_change_set('a.example.com', [{ 'Value': '10.0.0.1' }, { 'Value': '10.0.0.2' }], 60)
+        self.client.add_dns_change_set('b.example.com', [{ 'Value': '10.0.0.2' }], 300)
+        self.client.add_dns_change_set('c.example.com', [{ 'Value': '10.0.0.30' }], 60, 'DELETE')
+        self.client.add_dns_change_set('d.example.com', [{ 'Value': '10.0.0.4' }], 60, 'DELETE')
+        self.client.add_dns_change_set('*.example.com', [{ 'Value': '10.0.0.4' }], 60)
+
+        self.client.apply_dns_change_set('zone')
+
+        self.assertEqual(
+            [('UPSERT', 'b.example.com', 300), ('DELETE', 'c.example.com.', 60)],
+            [
+                (
+                    change.get('Action'),
+                    change.get('ResourceRecordSet').get('Name'),
+                    change.get('ResourceRecordSet').get('TTL')
+                )
+                for change in self.get_batches()[0]
+            ]
+        )
+        self.assertEqual(
+            ['10.0.0.3'],
+            [record.get('Value') for record in self.get_batches()[0][1].get('ResourceRecordSet').get('ResourceRecords')]
+        )
+        self.assertEqual(['*.example.com', 'a.example.com', 'b.example.com', 'c.example.com', 'd.example.com'], sorted([
+            key[0] for key in self.client.records.get('zone').keys()
+        ]))
+        self.assertIsNone(self.client.records.get('zone').get(('d.example.com', 'A')))
+        # one lookup per record, the zone is not listed
+        self.assertEqual(
+            [('a.example.com', '1'), ('b.example.com', '1'), ('c.example.com', '1'), ('d.example.com', '1')],
+            sorted([
+                (call[1].get('StartRecordName'), call[1].get('MaxItems'))
+                for call in self.boto_client.list_resource_record_sets.call_args_list
+            ])[1:]
+        )
+
+
+    def test_record_view_is_loaded_once_and_updated_with_applied_changes(self):
+        self.client.diff_changes = True
+        self.add_record_set('a.example.com', ['10.0.0.1'])
+        self.client.add_dns_change_set('a.example.com', [{ 'Value': '10.0.0.2' }], 60)
+        self.client.apply_dns_change_set('zone')
+        self.client.add_dns_change_set('a.example.com', [{ 'Value': '10.0.0.2' }], 60)
+        self.client.add_dns_change_set('b.example.com', [{ 'Value': '10.0.0.3' }], 60, 'DELETE')
+
+        self.assertEqual([], self.client.apply_dns_change_set('zone', wait = True))
+        self.assertEqual(1, self.boto_client.change_resource_record_sets.call_count)
+        self.assertEqual(2, self.boto_client.list_resource_record_sets.call_count)
+        self.waiters.wait_all.assert_not_called()
+
+        self.client.add_dns_change_set('a.example.com', [{ 'Value': '10.0.0.2' }], 60)
+        self.client.apply_dns_change_set('zone')
+        self.assertEqual(2, self.boto_client.list_resource_record_sets.call_count)
+
+        self.client.reset()
+        self.client.add_dns_change_set('a.example.com', [{ 'Value': '10.0.0.2' }], 60)
+        self.client.apply_dns_change_set('zone')
+        self.assertEqual(3, self.boto_client.list_resource_record_sets.call_count)
+
+
+    def test_pending_changes_can_be_replaced(self):
+        self.client.add_dns_change_set('a.example.com', [{ 'Value': '10.0.0.1' }], 60, zone_id = 'zone')
+        self.client.dns_change_set = []
+        self.assertEqual([], self.client.dns_change_set)
+
+        change = {
+            'Action': 'UPSERT',
+            'ResourceRecordSet': { 'Name': 'b.example.com', 'Type': 'A', 'TTL': 60, 'ResourceRecords': [] }
+        }
+        self.client.dns_change_set = [change]
+        self.client.apply_dns_change_set('zone')
+
+        self.assertEqual([[change]], self.get_batches())
+
+
+    def test_invalid_change_batches_invalidate_the_record_view(self):
+        self.client.diff_changes = True
+        self.boto_client.change_resource_record_sets.side_effect = ClientError(
+            { 'Error': { 'Code': 'InvalidChangeBatch' } },
+            'ChangeResourceRecordSets'
+        )
+        self.client.add_dns_change_set('a.example.com', [{ 'Value': '10.0.0.1' }], 60)
+
+        with self.assertRaises(ClientError):
+            self.client.apply_dns_change_set('zone')
+
+        self.assertEqual({ }, self.client.records)
+        self.assertEqual(1, len(self.client.dns_change_set))
+
+
+class TestSecretsmanagerClient(unittest.TestCase):
+
+    def setUp(self):
+        self.boto_client = mock.Mock()
+        self.boto_client.get_secret_value.side_effect = lambda **kwargs: {
+            'SecretString': 'password-%s' % self.boto_client.get_secret_value.call_count
+        }
+        self.client = SecretsmanagerClient(self.boto_client, mock.Mock(), Logging('TEST'))
+        self.client.ttl = 100
+        self.client.refresh_margin = 10
+
+
+    @mock.patch('AutoscalingLifecycle.clients.time.monotonic')
+    def test_secrets_are_cached_by_id_and_stage_until_they_expire(self, monotonic):
+        monotonic.return_value = 0
+        self.assertEqual('password-1', self.client.get_current_secret_string('secret'))
+        self.assertEqual('password-1', self.client.get_current_secret_string('secret'))
+        self.assertEqual('password-2', self.client.get_current_secret_string('secret', 'AWSPREVIOUS'))
+
+        monotonic.return_value = 100
+        self.assertEqual('password-3', self.client.get_current_secret_string('secret'))
+        self.assertEqual(
+            [('secret', 'AWSCURRENT'), ('secret', 'AWSPREVIOUS')],
+            [
+                (call[1].get('SecretId'), call[1].get('VersionStage'))
+                for call in self.boto_client.get_secret_value.call_args_list[:2]
+            ]
+        )
+
+        self.client.invalidate_secrets('secret')
+        self.assertEqual('password-4', self.client.get_current_secret_string('secret'))
+
+
+    @mock.patch('AutoscalingLifecycle.clients.Thread')
+    @mock.patch('AutoscalingLifecycle.clients.time.monotonic')
+    def test_secrets_are_refreshed_in_the_background_before_they_expire(self, monotonic, thread):
+        monotonic.return_value = 0
+        self.client.get_current_secret_string('secret')
+
+        monotonic.return_value = 95
+        self.assertEqual('password-1', self.client.get_current_secret_string('secret'))
+        self.assertEqual('password-1', self.client.get_current_secret_string('secret'))
+        thread.assert_called_once()
+        self.assertEqual(1, self.boto_client.get_secret_value.call_count)
+
+        # run the refresh
+        thread.call_args[1].get('target')(*thread.call_args[1].get('args'))
+        monotonic.return_value = 150
+        self.assertEqual('password-2', self.client.get_current_secret_string('secret'))
+        self.assertEqual(2, self.boto_client.get_secret_value.call_count)
+
+
+    @mock.patch('AutoscalingLifecycle.clients.Thread')
+    @mock.patch('AutoscalingLifecycle.clients.time.monotonic')
+    def test_refresh_started_before_an_invalidation_is_not_cached(self, monotonic, thread):
+        monotonic.return_value = 0
+        self.client.get_current_secret_string('secret')
+        monotonic.return_value = 95
+        self.client.get_current_secret_string('secret')
+        fetch = self.boto_client.get_secret_value.side_effect
+
+
+        def rotate(**kwargs):
+            response = fetch(**kwargs)
+            self.client.invalidate_secrets('secret')
+
+            return response
+
+
+        self.boto_client.get_secret_value.side_effect = rotate
+        thread.call_args[1].get('target')(*thread.call_args[1].get('args'))
+        self.boto_client.get_secret_value.side_effect = fetch
+
+        self.assertEqual('password-3', self.client.get_current_secret_string('secret'))
+
+
+    @mock.patch('AutoscalingLifecycle.clients.Thread')
+    @mock.patch('AutoscalingLifecycle.clients.time.monotonic')
+    def test_refresh_is_not_recorded_in_the_ledger_of_the_invocation(self, monotonic, thread):
+        monotonic.return_value = 0
+        self.client.get_current_secret_string('secret')
+        CallLedger().activate()
+        monotonic.return_value = 95
+        self.client.get_current_secret_string('secret')
+        CallLedger.deactivate()
+        ledgers = []
+        fetch = self.boto_client.get_secret_value.side_effect
+        self.boto_client.get_secret_value.side_effect = lambda **kwargs: (
+            ledgers.append(CallLedger.get_current()) or fetch(**kwargs)
+        )
+        refresh = threading.Thread(target = thread.call_args[1].get('target'), args = thread.call_args[1].get('args'))
+        refresh.start()
+        refresh.join()
+
+        self.assertEqual([None], ledgers)
+
+
+    def test_concurrent_callers_share_one_fetch(self):
+        fetch = self.boto_client.get_secret_value.side_effect
+
+
+        def slow_fetch(**kwargs):
+            time.sleep(0.05)
+            return fetch(**kwargs)
+
+
+        self.boto_client.get_secret_value.side_effect = slow_fetch
+        with ThreadPoolExecutor(max_workers = 8) as executor:
+            secrets = list(executor.map(lambda _: self.client.get_current_secret_string('secret'), range(16)))
+
+        self.assertEqual(['password-1'], list(set(secrets)))
+        self.assertEqual(1, self.boto_client.get_secret_value.call_count)
+
+
+    @mock.patch('AutoscalingLifecycle.clients.Thread')
+    @mock.patch('AutoscalingLifecycle.clients.time.monotonic')
+    def test_secrets_are_never_logged(self, monotonic, thread):
+        monotonic.return_value = 0
+        self.client.logger.setLevel('DEBUG')
+        with self.assertLogs(self.client.logger, 'DEBUG') as logs:
+            self.client.get_current_secret_string('secret')
+            monotonic.return_value = 95
+            self.boto_client.get_secret_value.side_effect = ClientError(
+                { 'Error': { 'Code': 'ThrottlingException', 'Message': 'password-1' } },
+                'GetSecretValue'
+            )
+            self.client.get_current_secret_string('secret')
+            thread.call_args[1].get('target')(*thread.call_args[1].get('args'))
+
+        self.assertEqual(3, len(logs.output))
+        self.assertIn('ThrottlingException', logs.output[2])
+        self.assertNotIn('password', ''.join(logs.output))
+        self.assertEqual('password-1', self.client.get_current_secret_string('secret'))
+
+
+class TestBackoff(unittest.TestCase):
+
+    def test_delays_grow_exponentially_up_to_max_delay(self):
+        backoff = Backoff(delay = 1, max_delay = 10, jitter = False)
+
+        self.assertEqual([1, 2, 4, 8, 10, 10], [backoff.get_delay(attempt) for attempt in range(1, 7)])
+
+
+    def test_delays_of_long_waits_do_not_overflow(self):
+        backoff = Backoff(delay = 0.01, max_delay = 0.01, jitter = False)
+
+        self.assertEqual(0.01, backoff.get_delay(5000))
+
+
+    def test_jitter_keeps_delays_between_half_and_full_delay(self):
+        backoff = Backoff(delay = 4, max_delay = 4)
+        for _ in range(100):
+            self.assertTrue(2 <= backoff.get_delay(1) <= 4)
+
+
+    @mock.patch('AutoscalingLifecycle.clients.time.sleep')
+    @mock.patch('AutoscalingLifecycle.clients.time.monotonic')
+    def test_wait_raises_after_timeout(self, monotonic, sleep):
+        monotonic.side_effect = [0, 1, 3, 7, 11]
+        backoff = Backoff(delay = 1, max_delay = 4, timeout = 10, jitter = False)
+
+        with self.assertRaises(WaitTimeoutError):
+            backoff.wait(lambda: False, lambda result: result)
+
+        self.assertEqual([1, 2, 3], [call[0][0] for call in sleep.call_args_list])
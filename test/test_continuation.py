@@ -0,0 +1,247 @@
+import json
+import time
+import unittest
+from unittest import mock
+
+from AutoscalingLifecycle import Event
+from AutoscalingLifecycle import LifecycleHandler
+from AutoscalingLifecycle import TransitionTable
+from AutoscalingLifecycle.clients import Backoff
+from AutoscalingLifecycle.entity import CommandRepository
+from AutoscalingLifecycle.entity import NodeRepository
+from AutoscalingLifecycle.entity import Repositories
+from AutoscalingLifecycle.exceptions import WaitTimeoutError
+from AutoscalingLifecycle.logging import Logging
+from test.test_lifecycle_handler import MockDynamoDbClient
+from test.test_lifecycle_handler import MockModel
+from test.test_lifecycle_handler import get_event
+
+
+class TestContinuation(unittest.TestCase):
+
+    def setUp(self):
+        TransitionTable.clear()
+        self.logging = Logging('TEST')
+        client = MockDynamoDbClient(mock.Mock(), mock.Mock(), self.logging, 'table')
+        self.repositories = Repositories(client, mock.Mock())
+        self.repositories.add('node', NodeRepository)
+        self.repositories.add('command', CommandRepository)
+        self.continuations = mock.Mock()
+        self.repositories.set('continuation', self.continuations)
+        self.client = mock.Mock()
+        self.clients = mock.Mock()
+        self.clients.get.return_value = self.client
+
+
+    def create_model(self) -> MockModel:
+        model = MockModel(self.clients, self.repositories, self.logging, 'test', 'test')
+        model.suspend_waits = True
+        model.suspend_margin = 0
+        model.digest_notifications = False
+        model.call_metrics = False
+        model.cloud_init_backoff = Backoff(delay = 0.01, max_delay = 0.01, timeout = 60, jitter = False)
+        model.activity_backoff = Backoff(delay = 0.01, max_delay = 0.01, timeout = 60, jitter = False)
+
+        return model
+
+
+    def get_registered_continuation(self) -> dict:
+        self.continuations.register.assert_called_once()
+        continuation = dict(self.continuations.register.call_args[0][1])
+        continuation.update({ 'Ident': 'continuation:' + self.continuations.register.call_args[0][0] })
+
+        return continuation
+
+
+    def test_cloud_init_wait_is_suspended(self):
+        self.client.get_item.return_value = { 'ItemStatus': 'new' }
+        model = self.create_model()
+        model.initialize(get_event('autoscaling_event.json'), 50)
+        model.transitions = [{ 'source': 'new', 'dest': 'ready', 'triggers': [{ 'name': 'trigger_1' }] }]
+        LifecycleHandler(model)()
+
+        self.assertTrue(model.suspended)
+        self.assertEqual([], model.passed_states)
+        continuation = self.get_registered_continuation()
+        self.assertEqual('cloud_init', continuation.get('Wait'))
+        self.assertEqual('i-007de616626a94600', continuation.get('NodeId'))
+        self.assertNotIn('State', continuation)
+
+
+    def test_lifecycle_action_is_completed_once_across_suspension(self):
+        transitions = [
+            {
+                'source': 'finished_cloud_init',
+                'dest': 'ready',
+                'triggers': [{ 'name': 'complete', 'before': ['do_complete_lifecycle_action'] }],
+            },
+        ]
+        self.client.is_activity_complete.return_value = False
+        model = self.create_model()
+        model.initialize(get_event('ssm_event.json'), 50)
+        model.transitions = transitions
+        LifecycleHandler(model)()
+
+        self.assertTrue(model.suspended)
+        self.assertEqual('finished_cloud_init', model.state)
+        continuation = self.get_registered_continuation()
+        self.assertEqual('activity', continuation.get('Wait'))
+        self.assertEqual('complete', continuation.get('Trigger'))
+        self.assertEqual('finished_cloud_init', continuation.get('State'))
+
+        self.client.is_activity_complete.return_value = True
+        model = self.create_model()
+        self.assertTrue(model.resume(continuation, 1000))
+        model.transitions = transitions
+        LifecycleHandler(model)()
+
+        self.continuations.delete.assert_called_once_with('i-007de616626a946ce')
+        self.assertEqual('ready', model.state)
+        self.client.complete_lifecycle_action.assert_called_once()
+        self.client.is_activity_complete.assert_called_with('docker-swarm-worker-live', True, 'i-007de616626a946ce')
+
+
+    def test_custom_waits_end_at_the_deadline(self):
+        model = self.create_model()
+        model.initialize(get_event('scheduled_event.json'), 60000)
+
+        self.clients.set_deadline.assert_called_once_with(model.deadline)
+        self.assertAlmostEqual(time.monotonic() + 60, model.deadline, delta = 1)
+
+
+    def test_waits_after_the_state_change_are_not_suspended(self):
+        self.client.is_activity_complete.side_effect = [False] * 10 + [True]
+        model = self.create_model()
+        model.initialize(get_event('ssm_event.json'), 30)
+        reports = []
+        model.report = lambda direction, *args, **kwargs: reports.append(direction)
+        model.mark = mock.Mock()
+        model.transitions = [
+            {
+                'source': 'finished_cloud_init',
+                'dest': 'ready',
+                'triggers': [{ 'name': 'complete', 'after': ['do_complete_lifecycle_action', model.mark] }],
+            },
+        ]
+        LifecycleHandler(model)()
+
+        self.assertFalse(model.suspended)
+        self.continuations.register.assert_not_called()
+        self.assertEqual('ready', model.state)
+        self.assertEqual(11, self.client.is_activity_complete.call_count)
+        self.assertIn('Finished', reports)
+        model.mark.assert_called_once()
+
+
+    def test_resumed_trigger_is_pulled_first(self):
+        self.client.is_activity_complete.return_value = False
+        is_leaving = mock.Mock(return_value = False)
+        model = self.create_model()
+        model.initialize(get_event('ssm_event.json'), 50)
+        transitions = [
+            {
+                'source': 'finished_cloud_init',
+                'dest': 'leaving',
+                'triggers': [{ 'name': 'leave', 'conditions': [lambda *args: is_leaving()] }],
+            },
+            {
+                'source': 'finished_cloud_init',
+                'dest': 'ready',
+                'triggers': [{ 'name': 'complete', 'before': ['do_complete_lifecycle_action'] }],
+            },
+        ]
+        model.transitions = transitions
+        LifecycleHandler(model)()
+        continuation = self.get_registered_continuation()
+
+        self.client.is_activity_complete.return_value = True
+        is_leaving.return_value = True
+        model = self.create_model()
+        self.assertTrue(model.resume(continuation, 1000))
+        model.transitions = transitions
+        LifecycleHandler(model)()
+
+        self.assertEqual('ready', model.state)
+
+
+    def test_resume_suspends_again_while_condition_is_not_met(self):
+        self.client.is_activity_complete.return_value = False
+        model = self.create_model()
+        model.initialize(get_event('ssm_event.json'), 50)
+        model.trigger = 'complete'
+        model._suspend('activity', { 'InstanceId': 'i-1' }, time.time() + 60)
+        continuation = self.get_registered_continuation()
+        self.continuations.register.reset_mock()
+
+        model = self.create_model()
+
+        self.assertFalse(model.resume(continuation, 50))
+        self.assertEqual(continuation.get('Expires'), self.get_registered_continuation().get('Expires'))
+        self.continuations.delete.assert_not_called()
+
+
+    def test_expired_continuation_is_deleted(self):
+        self.client.is_activity_complete.return_value = False
+        model = self.create_model()
+        model.initialize(get_event('ssm_event.json'), 50)
+        model._suspend('activity', { 'InstanceId': 'i-1' }, time.time() - 1)
+        continuation = self.get_registered_continuation()
+
+        model = self.create_model()
+        self.assertTrue(model.resume(continuation, 1000))
+        self.continuations.delete.assert_called_once_with('i-007de616626a946ce')
+        with self.assertRaises(WaitTimeoutError):
+            model._pop_resumed_arguments('activity')
+
+
+    def test_expired_continuation_fails_the_trigger(self):
+        self.client.is_snapshot_completed.return_value = False
+        model = self.create_model()
+        model.initialize(get_event('scheduled_event.json'), 50)
+        model._suspend('snapshot', { 'SnapshotId': 'snap-1' }, time.time() - 1)
+        continuation = self.get_registered_continuation()
+
+        model = self.create_model()
+        self.assertTrue(model.resume(continuation, 1000))
+        model.backup = lambda *args: model.create_snapshot('backup', 'vol-1', [])
+        model.transitions = [
+            { 'source': 'backup', 'dest': 'backed_up', 'triggers': [{ 'name': 'snapshot', 'before': [model.backup] }] },
+            { 'source': 'failure', 'dest': 'failed', 'triggers': [{ 'name': 'give_up', 'ignore_errors': True }] },
+        ]
+        LifecycleHandler(model)()
+
+        self.continuations.delete.assert_called_once_with('backup')
+        self.assertEqual('failed', model.state)
+        self.client.create_snapshot.assert_not_called()
+
+
+    def test_expired_cloud_init_continuation_is_deleted_and_raises(self):
+        self.client.get_item.return_value = { 'ItemStatus': 'new' }
+        model = self.create_model()
+        model.initialize(get_event('autoscaling_event.json'), 50)
+        continuation = self.get_registered_continuation()
+        continuation.update({ 'Expires': str(time.time() - 1) })
+
+        with self.assertRaises(WaitTimeoutError):
+            self.create_model().resume(continuation, 1000)
+        self.continuations.delete.assert_called_once_with('i-007de616626a94600')
+
+
+    def test_resumed_snapshot_is_not_created_again(self):
+        self.client.is_snapshot_completed.return_value = True
+        model = self.create_model()
+        model.initialize(get_event('scheduled_event.json'), 50)
+        model._suspend('snapshot', { 'SnapshotId': 'snap-1' }, time.time() + 60)
+        continuation = self.get_registered_continuation()
+
+        model = self.create_model()
+        self.assertTrue(model.resume(continuation, 1000))
+
+        self.assertEqual('snap-1', model.create_snapshot('backup', 'vol-1', []))
+        self.client.create_snapshot.assert_not_called()
+
+
+    def test_command_events_are_restored_from_json(self):
+        event = get_event('ssm_event.json')
+
+        self.assertEqual(event.get_detail(), Event(json.loads(event.to_json())).get_detail())
@@ -0,0 +1,275 @@
+import copy
+import unittest
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+from AutoscalingLifecycle.entity import CommandRepository
+from AutoscalingLifecycle.entity import Node
+from AutoscalingLifecycle.entity import NodeRepository
+from AutoscalingLifecycle.exceptions import CommandNotFoundError
+
+
+def get_item(ident, node_type, status = 'ready'):
+    return { 'Ident': ident, 'ItemType': node_type, 'ItemStatus': status }
+
+
+class TestNodeRepository(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.Mock()
+        self.client.scan.return_value = iter([get_item('i-1', 'manager'), get_item('i-2', 'worker')])
+        self.client.query.side_effect = lambda key, values, *args: iter([
+            get_item('i-%s' % values.get(':node_type'), values.get(':node_type')),
+            get_item('i-%s-terminating' % values.get(':node_type'), values.get(':node_type'), 'terminating'),
+        ])
+        self.repository = NodeRepository(self.client, mock.Mock())
+
+
+    def test_get_by_type_scans_without_index(self):
+        nodes = self.repository.get_by_type(['manager', 'worker'], 'InstanceIp <> :ip', { ':ip': '' })
+
+        self.client.query.assert_not_called()
+        expression, values, segments = self.client.scan.call_args[0]
+        self.assertEqual(
+            '(ItemType = :node_type0 or ItemType = :node_type1) '
+            'and ItemStatus <> :terminating and ItemStatus <> :removing and (InstanceIp <> :ip)',
+            expression
+        )
+        self.assertEqual('worker', values.get(':node_type1'))
+        self.assertEqual(['i-1', 'i-2'], [node.get_id() for node in nodes])
+
+
+    def test_get_by_type_queries_type_index(self):
+        self.repository.type_index = 'ItemTypeIndex'
+        attribute_values = { ':ip': '' }
+        self.repository.get_by_type(['manager', 'worker'], 'InstanceIp <> :ip', attribute_values)
+
+        self.client.scan.assert_not_called()
+        self.assertEqual(2, self.client.query.call_count)
+        key, values, filter_expression, index = self.client.query.call_args_list[1][0]
+        self.assertEqual('ItemType = :node_type', key)
+        self.assertEqual('worker', values.get(':node_type'))
+        self.assertEqual(
+            'ItemStatus <> :terminating and ItemStatus <> :removing and (InstanceIp <> :ip)',
+            filter_expression
+        )
+        self.assertEqual('ItemTypeIndex', index)
+        self.assertEqual({ ':ip': '' }, attribute_values)
+
+
+    def test_get_by_type_excludes_terminating_nodes_if_status_is_sort_key(self):
+        self.repository.type_index = 'ItemTypeStatusIndex'
+        self.repository.type_index_status_key = True
+        nodes = self.repository.get_by_type(['worker'])
+
+        key, values, filter_expression, index = self.client.query.call_args[0]
+        self.assertIsNone(filter_expression)
+        self.assertEqual({ ':node_type': 'worker' }, values)
+        self.assertEqual(['i-worker'], [node.get_id() for node in nodes])
+
+
+    def test_get_by_type_includes_terminating_nodes(self):
+        self.repository.type_index = 'ItemTypeStatusIndex'
+        self.repository.type_index_status_key = True
+        nodes = self.repository.get_by_type(['worker'], include_terminating = True)
+
+        self.assertEqual(2, len(nodes))
+
+
+    def test_update_writes_immediately(self):
+        node = Node('i-1', 'worker')
+        self.repository.update(node, { 'ItemStatus': 'ready' })
+
+        self.client.update_item.assert_called_once_with('i-1', 'SET ItemStatus = :ItemStatus', { ':ItemStatus': 'ready' })
+
+
+    def test_write_behind_flushes_changes_with_one_update(self):
+        node = Node('i-1', 'worker')
+        node.set_write_behind(True)
+        self.repository.update(node, { 'ItemStatus': 'joining' })
+        self.repository.update(node, { 'ItemStatus': 'ready', 'InstanceIp': '10.0.0.1' })
+        self.repository.unset_property(node, ['InstanceIp'])
+        self.repository.update(node, { 'Token': 'abc' })
+        self.repository.unset_property(node, ['Token'])
+        self.repository.update(node, { 'Token': 'def' })
+
+        self.client.update_item.assert_not_called()
+        self.client.unset.assert_not_called()
+
+        self.repository.flush(node)
+        self.repository.flush(node)
+
+        self.client.update_item.assert_called_once_with(
+            'i-1',
+            'SET ItemStatus = :ItemStatus, Token = :Token REMOVE InstanceIp',
+            { ':ItemStatus': 'ready', ':Token': 'def' }
+        )
+
+
+    def test_write_behind_flushes_removals_only(self):
+        node = Node('i-1', 'worker')
+        node.set_write_behind(True)
+        node.set_property('InstanceIp', '10.0.0.1')
+        self.repository.unset_property(node, ['InstanceIp'])
+        self.repository.flush(node)
+
+        self.client.update_item.assert_not_called()
+        self.client.unset.assert_called_once_with('i-1', ['InstanceIp'])
+
+
+    def test_delete_discards_pending_changes(self):
+        node = Node('i-1', 'worker')
+        node.set_write_behind(True)
+        self.repository.update(node, { 'ItemStatus': 'removed' })
+        self.repository.delete(node)
+        self.repository.flush(node)
+
+        self.client.update_item.assert_not_called()
+
+
+class StubCommandTable(object):
+    """
+    Applies the conditional map updates of the CommandRepository to in memory items.
+    """
+
+
+    def __init__(self):
+        self.items = { }
+
+
+    def put_item(self, id, item_type, data):
+        self.items[id] = dict(data, Ident = id, ItemType = item_type)
+
+
+    def get_item(self, id, consistent = False):
+        return dict(self.items.get(id, { }))
+
+
+    def delete_item(self, id):
+        self.items.pop(id, None)
+
+
+    def update_item(self, id, expression, values, names, condition = None, return_values = None):
+        # SET <map>.#<name> = :<value>, conditions require the entry to be new or the map to exist
+        path, value = expression[len('SET '):].split(' = ')
+        attribute, name = path.split('.')
+        entries = self.items.get(id, { }).get(attribute, None)
+        is_new = entries is None or names.get(name) not in entries
+        exists = entries is not None or 'attribute_exists(%s)' % attribute not in (condition or '')
+        if condition is not None and not (is_new and exists):
+            raise ClientError({ 'Error': { 'Code': 'ConditionalCheckFailedException' } }, 'UpdateItem')
+        if entries is None:
+            raise ClientError({ 'Error': { 'Code': 'ValidationException' } }, 'UpdateItem')
+        entries.update({ names.get(name): values.get(value) })
+
+        return dict(self.items.get(id), **{ attribute: dict(entries) })
+
+
+class TestCommandRepository(unittest.TestCase):
+
+    def setUp(self):
+        self.table = StubCommandTable()
+        self.repository = CommandRepository(self.table, mock.Mock())
+
+
+    def register(self, max_errors = None):
+        data = { 'RunningOn': 'i-1, i-2, i-3', 'EventName': 'join' }
+        if max_errors is not None:
+            data.update({ 'MaxErrors': max_errors })
+        self.repository.register('command-1', data)
+
+
+    def test_command_completes_when_all_targets_reported(self):
+        self.register()
+
+        self.assertIsNone(self.repository.complete('command-1', 'i-1', 'Success'))
+        self.assertIsNone(self.repository.complete('command-1', 'i-2', 'Success'))
+        command = self.repository.complete('command-1', 'i-3', 'Success')
+
+        self.assertEqual({ 'i-1': 'Success', 'i-2': 'Success', 'i-3': 'Success' }, command.get('Results'))
+        self.assertEqual({ }, self.table.items)
+
+
+    def test_command_completes_once_when_error_limit_is_crossed(self):
+        self.register('1')
+
+        self.assertIsNone(self.repository.complete('command-1', 'i-1', 'Failed'))
+        self.assertIsNotNone(self.repository.complete('command-1', 'i-2', 'TimedOut'))
+        self.assertIsNone(self.repository.complete('command-1', 'i-3', 'Success'))
+        self.assertEqual({ }, self.table.items)
+
+
+    def test_command_completes_within_error_limit(self):
+        self.register('34%')
+
+        self.repository.complete('command-1', 'i-1', 'Failed')
+        self.repository.complete('command-1', 'i-2', 'Success')
+
+        self.assertEqual('i-1', list(self.repository.complete('command-1', 'i-3', 'Success').get('Results'))[0])
+
+
+    def test_duplicate_results_are_rejected(self):
+        self.register()
+        self.repository.complete('command-1', 'i-1', 'Success')
+
+        with self.assertRaises(CommandNotFoundError):
+            self.repository.complete('command-1', 'i-1', 'Success')
+
+
+    def test_commands_without_results_complete_on_first_event(self):
+        self.table.put_item('command-1', 'command', { 'RunningOn': 'i-1, i-2' })
+
+        self.assertEqual('i-1, i-2', self.repository.complete('command-1', 'i-1', 'Success').get('RunningOn'))
+        self.assertEqual({ }, self.table.items)
+
+
+    def test_chunks_of_a_group_complete_the_group_once(self):
+        self.repository.register_group('group-1', { 'RunningOn': 'i-1, i-2, i-3', 'MaxErrors': '1' })
+        self.repository.add_to_group('group-1', 'command-1', ['i-1', 'i-2'])
+        self.repository.add_to_group('group-1', 'command-2', ['i-3'])
+
+        self.assertIsNone(self.repository.complete('command-1', 'i-1', 'Failed'))
+        self.assertIsNone(self.repository.complete('command-2', 'i-3', 'Success'))
+        command = self.repository.complete('command-1', 'i-2', 'Success')
+
+        self.assertEqual('group-1', command.get('Ident'))
+        self.assertEqual({ 'i-1': 'Failed', 'i-2': 'Success', 'i-3': 'Success' }, command.get('Results'))
+        self.assertEqual({ }, self.table.items)
+        with self.assertRaises(CommandNotFoundError):
+            self.repository.complete('command-2', 'i-3', 'Success')
+
+
+    def test_error_limit_of_a_group_applies_to_all_targets(self):
+        self.repository.register_group('group-1', { 'RunningOn': 'i-1, i-2, i-3, i-4', 'MaxErrors': '25%' })
+        self.repository.add_to_group('group-1', 'command-1', ['i-1', 'i-2'])
+        self.repository.add_to_group('group-1', 'command-2', ['i-3', 'i-4'])
+
+        self.assertIsNone(self.repository.complete('command-1', 'i-1', 'Failed'))
+        self.assertIsNotNone(self.repository.complete('command-2', 'i-3', 'Failed'))
+        self.assertIsNone(self.repository.complete('command-2', 'i-4', 'Success'))
+
+
+    def test_duplicate_status_events_of_a_completed_group_raise_not_found(self):
+        self.repository.register_group('group-1', { 'RunningOn': 'i-1, i-2' })
+        self.repository.add_to_group('group-1', 'command-1', ['i-1', 'i-2'])
+        loaded = copy.deepcopy(self.table.items)
+        self.repository.complete('command-1', 'i-1', 'Success')
+        self.assertIsNotNone(self.repository.complete('command-1', 'i-2', 'Success'))
+
+        # a duplicate event that has loaded the group before it has been completed and deleted
+        self.table.get_item = lambda id, consistent = False: copy.deepcopy(loaded.get(id, { }))
+        with self.assertRaises(CommandNotFoundError):
+            self.repository.complete('command-1', 'i-2', 'Success')
+
+
+    def test_chunks_are_not_added_to_a_completed_group(self):
+        with self.assertRaises(CommandNotFoundError):
+            self.repository.add_to_group('group-1', 'command-1', ['i-1'])
+
+        self.assertEqual({ }, self.table.items)
+
+
+    def test_unknown_commands_raise(self):
+        with self.assertRaises(CommandNotFoundError):
+            self.repository.complete('command-1', 'i-1', 'Success')
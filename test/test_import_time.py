@@ -0,0 +1,59 @@
+import subprocess
+import sys
+import unittest
+from unittest import mock
+
+from AutoscalingLifecycle.clients import Ec2Client
+from AutoscalingLifecycle.logging import Logging
+
+# cumulative import time of the package in microseconds, including compilation if no bytecode is cached
+IMPORT_TIME_BUDGET = 150000
+DEFERRED_MODULES = ['boto3', 'botocore', 'boltons', 'transitions']
+
+
+def get_import_times(module: str) -> dict:
+    """
+    :return: Cumulative import times in microseconds by module name
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-W', 'ignore', '-c', 'import ' + module],
+        stdout = subprocess.PIPE,
+        stderr = subprocess.PIPE,
+        universal_newlines = True,
+        check = True
+    )
+    times = { }
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times.update({ name.strip(): int(cumulative) })
+
+    return times
+
+
+class TestImportTime(unittest.TestCase):
+
+    def test_heavy_dependencies_are_not_imported(self):
+        times = get_import_times('AutoscalingLifecycle')
+
+        for name in times.keys():
+            self.assertNotIn(name.split('.')[0], DEFERRED_MODULES)
+
+
+    def test_import_time_is_within_budget(self):
+        times = get_import_times('AutoscalingLifecycle')
+
+        self.assertLess(times.get('AutoscalingLifecycle'), IMPORT_TIME_BUDGET)
+
+
+class TestEc2Client(unittest.TestCase):
+
+    @mock.patch('boto3.resource')
+    def test_resource_is_created_on_first_use(self, resource):
+        client = Ec2Client(mock.Mock(), mock.Mock(), Logging('TEST'))
+        resource.assert_not_called()
+
+        self.assertIs(resource.return_value, client.resource)
+        self.assertIs(resource.return_value, client.resource)
+        resource.assert_called_once_with('ec2')
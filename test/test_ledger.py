@@ -0,0 +1,114 @@
+import io
+import json
+import unittest
+from unittest import mock
+
+import boto3
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+
+from AutoscalingLifecycle import LifecycleHandler
+from AutoscalingLifecycle.clients import ClientFactory
+from AutoscalingLifecycle.ledger import CallLedger
+from AutoscalingLifecycle.logging import Logging
+from test.test_lifecycle_handler import MockModel
+from test.test_lifecycle_handler import get_event
+
+
+class TestCallLedger(unittest.TestCase):
+
+    def setUp(self):
+        session = boto3.Session(aws_access_key_id = 'key', aws_secret_access_key = 'secret', region_name = 'eu-west-1')
+        self.factory = ClientFactory(session, 'eu-west-1', mock.Mock())
+        self.client = self.factory.get('autoscaling')
+        self.stubber = Stubber(self.client)
+        self.stubber.activate()
+        self.ledger = CallLedger().activate()
+
+
+    def tearDown(self):
+        self.stubber.deactivate()
+
+
+    def test_calls_are_recorded_per_trigger(self):
+        self.stubber.add_response('describe_scaling_activities', { 'Activities': [] })
+        self.stubber.add_response('describe_scaling_activities', { 'Activities': [] })
+        self.stubber.add_client_error('complete_lifecycle_action', 'ValidationError')
+
+        self.client.describe_scaling_activities(AutoScalingGroupName = 'group')
+        self.ledger.set_trigger('trigger_1')
+        self.client.describe_scaling_activities(AutoScalingGroupName = 'group')
+        with self.assertRaises(ClientError):
+            self.client.complete_lifecycle_action(
+                LifecycleHookName = 'hook',
+                AutoScalingGroupName = 'group',
+                LifecycleActionResult = 'CONTINUE'
+            )
+
+        self.assertEqual(3, len(self.ledger.entries))
+        summary = self.ledger.summarize()
+        self.assertEqual(['initialize', 'trigger_1'], list(summary.keys()))
+        self.assertEqual(1, summary.get('initialize').get(('autoscaling', 'DescribeScalingActivities')).get('Calls'))
+        failed = summary.get('trigger_1').get(('autoscaling', 'CompleteLifecycleAction'))
+        self.assertEqual(1, failed.get('Errors'))
+        self.assertEqual(['ValidationError'], failed.get('ErrorCodes'))
+        self.assertEqual(['eu-west-1'], failed.get('Regions'))
+
+
+    def test_calls_without_active_ledger_are_not_recorded(self):
+        CallLedger.deactivate()
+        self.stubber.add_response('describe_scaling_activities', { 'Activities': [] })
+        self.client.describe_scaling_activities(AutoScalingGroupName = 'group')
+
+        self.assertEqual(0, len(self.ledger.entries))
+
+
+    def test_metrics_are_emitted_in_embedded_metric_format(self):
+        self.ledger.record('dynamodb', 'GetItem', 'eu-west-1', 0.01)
+        self.ledger.record('dynamodb', 'GetItem', 'eu-west-1', 0.02, 1)
+        stream = io.StringIO()
+        self.ledger.emit('Test', { 'Event': 'event' }, stream)
+
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(1, len(lines))
+        document = json.loads(lines[0])
+        self.assertEqual('Test', document.get('_aws').get('CloudWatchMetrics')[0].get('Namespace'))
+        self.assertEqual('GetItem', document.get('Operation'))
+        self.assertEqual('event', document.get('Event'))
+        self.assertEqual(2, document.get('Calls'))
+        self.assertEqual(1, document.get('Retries'))
+        self.assertAlmostEqual(30, document.get('Latency'))
+
+
+class TestModelCallMetrics(unittest.TestCase):
+
+    def test_handler_records_calls_per_trigger_and_emits_metrics(self):
+        model = MockModel(mock.Mock(), mock.Mock(), Logging('TEST'), 'test', 'test')
+        model.initialize(get_event('scheduled_event.json'))
+        model.digest_notifications = False
+        model.call_metrics = True
+        model.call_api = lambda *args: CallLedger.get_current().record('ec2', 'DescribeInstances', 'eu-west-1', 0.1)
+        model.transitions = [
+            {
+                'source': 'backup',
+                'dest': 'backup_prepare',
+                'triggers': [{ 'name': 'trigger_1', 'before': [model.call_api] }],
+            },
+        ]
+        stream = io.StringIO()
+        with mock.patch('sys.stdout', stream):
+            LifecycleHandler(model)()
+
+        self.assertEqual(['trigger_1'], list(model.ledger.summarize().keys()))
+        self.assertEqual('trigger_1', json.loads(stream.getvalue()).get('Trigger'))
+
+
+    def test_metrics_are_not_emitted_by_default(self):
+        model = MockModel(mock.Mock(), mock.Mock(), Logging('TEST'), 'test', 'test')
+        model.initialize(get_event('scheduled_event.json'))
+        model.ledger.record('ec2', 'DescribeInstances', 'eu-west-1', 0.1)
+        stream = io.StringIO()
+        with mock.patch('sys.stdout', stream):
+            model.emit_call_metrics()
+
+        self.assertEqual('', stream.getvalue())
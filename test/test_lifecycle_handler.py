@@ -12,12 +12,14 @@ from AutoscalingLifecycle import LifecycleHandler
 from AutoscalingLifecycle import Model
 from AutoscalingLifecycle import Event
 from AutoscalingLifecycle import ConfigurationError
+from AutoscalingLifecycle import TransitionTable
 from AutoscalingLifecycle.clients import DynamoDbClient
 from AutoscalingLifecycle.entity import CommandRepository
 from AutoscalingLifecycle.entity import NodeRepository
 from AutoscalingLifecycle.entity import Node
 from AutoscalingLifecycle.entity import Repositories
 from AutoscalingLifecycle.logging import Logging
+from test.test_entity import StubCommandTable
 
 
 def get_fixture(name):
@@ -51,8 +53,44 @@ class MockModel(Model):
         self.passed_states = []
 
 
+class CountingModel(MockModel):
+    calls = 0
+
+
+    def count_calls(self, *args, **kwargs):
+        self.calls += 1
+        return True
+
+
+    def get_shared_transitions(self):
+        return [
+            {
+                'source': 'backup',
+                'dest': 'backup_prepare',
+                'triggers': [
+                    {
+                        'name': 'trigger_1',
+                        'before': [self.count_calls]
+                    },
+                ],
+            },
+            {
+                'source': 'backup_prepare',
+                'dest': 'backing_up',
+                'triggers': [
+                    {
+                        'name': 'trigger_2',
+                        'conditions': ['count_calls'],
+                        'after': [self.count_calls],
+                        'ignore_errors': True
+                    },
+                ]
+            },
+        ]
+
+
 class MockDynamoDbClient(DynamoDbClient):
-    def get_item(self, id):
+    def get_item(self, id, consistent = False):
         try:
             fh = get_fixture(id + '.json')
             data = json.load(fh)
@@ -72,6 +110,7 @@ class TestLifecycleHandler(unittest.TestCase):
 
     def setUp(self):
         self.count = 0
+        TransitionTable.clear()
         logging = Logging("TEST", True)
         #h = StreamHandler()
         #h.setLevel(INFO)
@@ -1150,13 +1189,17 @@ class TestLifecycleHandler(unittest.TestCase):
         client = mock.Mock()
         clients = mock.Mock()
         clients.get.return_value = client
-        client.wait_for_scan_count_is = mock.MagicMock()
+        client.wait_for_item = mock.MagicMock()
         model = Model(clients, repositories, mock.Mock(), 'test', 'test')
 
         event = get_event('autoscaling_event.json')
         model.initialize(event)
 
-        client.wait_for_scan_count_is.assert_called_once()
+        client.wait_for_item.assert_called_once()
+        node_id, predicate, backoff = client.wait_for_item.call_args[0]
+        self.assertEqual(event.get_lifecycle_data().get_instance_id(), node_id)
+        self.assertTrue(predicate({ 'ItemStatus': 'finished_cloud_init' }))
+        self.assertFalse(predicate({ }))
 
 
     def test_scheduled_event_does_not_load_a_node_by_default(self):
@@ -1209,3 +1252,356 @@ class TestLifecycleHandler(unittest.TestCase):
 
         self.assertEqual(1, len(self.model.passed_states))
         self.assertEqual('destination', self.model.state)
+
+
+    def test_transition_table_is_shared_between_models_of_the_same_class(self):
+        handlers = []
+        for _ in range(2):
+            model = CountingModel(mock.Mock(), mock.Mock(), mock.Mock(), 'test', 'test')
+            model.initialize(get_event('scheduled_event.json'))
+            model.transitions = model.get_shared_transitions()
+            handlers.append(LifecycleHandler(model))
+
+        self.assertTrue(handlers[0].table.is_shared)
+        self.assertIs(handlers[0].table, handlers[1].table)
+        self.assertIs(handlers[0].machine, handlers[1].machine)
+
+
+    def test_shared_transition_table_binds_callbacks_to_the_current_model(self):
+        models = []
+        for _ in range(2):
+            model = CountingModel(mock.Mock(), mock.Mock(), mock.Mock(), 'test', 'test')
+            model.initialize(get_event('scheduled_event.json'))
+            model.transitions = model.get_shared_transitions()
+            models.append(model)
+
+        LifecycleHandler(models[0])
+        LifecycleHandler(models[1])()
+
+        self.assertEqual(0, models[0].calls)
+        self.assertEqual(3, models[1].calls)
+        self.assertEqual('backing_up', models[1].state)
+        self.assertEqual('backup', models[0].state)
+
+
+    def test_transition_table_is_not_shared_with_foreign_callbacks(self):
+        handlers = []
+        for _ in range(2):
+            model = MockModel(mock.Mock(), mock.Mock(), mock.Mock(), 'test', 'test')
+            model.initialize(get_event('scheduled_event.json'))
+            model.transitions = self.get_backup_tansition_config()
+            handlers.append(LifecycleHandler(model))
+
+        self.assertFalse(handlers[0].table.is_shared)
+        self.assertIsNot(handlers[0].machine, handlers[1].machine)
+
+
+    def test_changed_transition_config_compiles_a_new_table(self):
+        model = CountingModel(mock.Mock(), mock.Mock(), mock.Mock(), 'test', 'test')
+        model.initialize(get_event('scheduled_event.json'))
+        model.transitions = model.get_shared_transitions()
+        handler = LifecycleHandler(model)
+
+        config = model.get_shared_transitions()
+        config[1].update({ 'stop_after_state_change': True })
+        model.transitions = config
+
+        self.assertIsNot(handler.table, LifecycleHandler(model).table)
+
+
+    def test_state_updates_are_written_immediately_by_default(self):
+        event = get_event('ssm_event.json')
+        self.model.initialize(event)
+        self.model.transitions = self.get_handle_conditions_transition_config()
+        LifecycleHandler(self.model)()
+
+        self.assertEqual(3, self.model.get_node_repository().client.client.update_item.call_count)
+
+
+    def test_write_behind_coalesces_state_updates(self):
+        event = get_event('ssm_event.json')
+        self.model.write_behind = True
+        self.model.initialize(event)
+        self.model.transitions = self.get_handle_conditions_transition_config()
+        LifecycleHandler(self.model)()
+
+        update_item = self.model.get_node_repository().client.client.update_item
+        update_item.assert_called_once()
+        self.assertEqual({ ':ItemStatus': { 'S': 'last' } }, update_item.call_args[1].get('ExpressionAttributeValues'))
+        self.assertFalse(self.model.node.has_pending_changes())
+
+
+    def test_write_behind_flushes_when_entering_failure_handling(self):
+        event = get_event('ssm_event.json')
+        self.model.write_behind = True
+        self.model.initialize(event)
+        self.model.transitions = self.get_handle_failure_in_failure_transition_config()
+        handler = LifecycleHandler(self.model)
+
+        with self.assertRaises(RuntimeError):
+            handler()
+
+        update_item = self.model.get_node_repository().client.client.update_item
+        update_item.assert_called_once()
+        self.assertEqual(
+            { ':ItemStatus': { 'S': 'failure' } },
+            update_item.call_args[1].get('ExpressionAttributeValues')
+        )
+
+
+    def test_command_results_of_all_targets_are_aggregated_on_the_event(self):
+        event = get_event('ssm_event.json')
+        repository = mock.Mock()
+        repository.complete.return_value = {
+            'RunningOn': 'i-1, i-0f5eb341c49cb9185',
+            'MaxErrors': '1',
+            'Results': { 'i-1': 'Failed', 'i-0f5eb341c49cb9185': 'Success' }
+        }
+        self.model.repositories.set('command', repository)
+        try:
+            self.model.initialize(event)
+        finally:
+            self.model.repositories.add('command', CommandRepository)
+
+        repository.complete.assert_called_once_with(
+            '2730b156-4765-4ae7-b870-56c380012717',
+            'i-0f5eb341c49cb9185',
+            'Success'
+        )
+        self.assertEqual('Failed', event.get_command_results().get('i-1'))
+        self.assertTrue(event.is_successful())
+        event.set_command_results(event.get_command_results())
+        self.assertFalse(event.is_successful())
+
+
+    def get_sync_command_model(self, results):
+        model = MockModel(mock.Mock(), self.model.repositories, Logging('TEST'), 'test', 'test')
+        model.digest_notifications = False
+        model.call_metrics = False
+        model.initialize(get_event('scheduled_event.json'))
+        ssm = model.clients.get('ssm')
+        ssm.dispatch_command.side_effect = lambda ids, comment, commands, timeout, concurrency, errors, **callbacks: (
+            callbacks.get('on_dispatch')('command-1', ids)
+        )
+        ssm.wait_for_command.return_value = results
+        model.send = lambda *args: model._send_command('join', ['/bin/join.sh'], [Node('i-1')], sync_timeout = 5)
+        model.transitions = [
+            {
+                'source': 'backup',
+                'dest': 'joining',
+                'triggers': [{ 'name': 'join', 'before': [model.send] }],
+                'stop_after_state_change': True
+            },
+            {
+                'source': 'joining',
+                'dest': 'joined',
+                'triggers': [{ 'name': 'joined', 'conditions': [lambda *args: model.event.is_command()] }],
+            },
+        ]
+
+        return model
+
+
+    def test_short_commands_continue_in_the_same_invocation(self):
+        repository = mock.Mock()
+        repository.complete.return_value = {
+            'RunningOn': 'i-1',
+            'EventName': 'joined',
+            'Results': { 'i-1': 'Success' }
+        }
+        self.model.repositories.set('command', repository)
+        try:
+            model = self.get_sync_command_model({ 'i-1': 'Success' })
+            LifecycleHandler(model)()
+        finally:
+            self.model.repositories.add('command', CommandRepository)
+
+        repository.complete.assert_called_once_with('command-1', 'i-1', 'Success')
+        self.assertEqual('joined', model.state)
+        self.assertEqual('joined', model.event.get_name())
+        self.assertEqual({ 'i-1': 'Success' }, model.event.get_command_results())
+
+
+    def test_short_commands_continue_after_interleaved_status_events(self):
+        table = StubCommandTable()
+        self.model.repositories.set('command', CommandRepository(table, mock.Mock()))
+        try:
+            model = self.get_sync_command_model({ 'i-1': 'Success', 'i-2': 'Success' })
+            model.send = lambda *args: model._send_command(
+                'join',
+                ['/bin/join.sh'],
+                [Node('i-1'), Node('i-2')],
+                sync_timeout = 5
+            )
+            model.transitions[0].get('triggers')[0].update({ 'before': [model.send] })
+
+
+            def wait_for_command(command_id, instance_ids, deadline):
+                # the status event of the second target records its result while the command is polled
+                self.assertIsNone(model.get_command_repository().complete(command_id, 'i-2', 'Success'))
+                return { 'i-1': 'Success', 'i-2': 'Success' }
+
+
+            model.clients.get('ssm').wait_for_command.side_effect = wait_for_command
+            LifecycleHandler(model)()
+        finally:
+            self.model.repositories.add('command', CommandRepository)
+
+        self.assertEqual('joined', model.state)
+        self.assertEqual({ 'i-1': 'Success', 'i-2': 'Success' }, model.event.get_command_results())
+        self.assertEqual({ }, table.items)
+
+
+    def test_short_commands_continue_after_triggers_that_stop(self):
+        repository = mock.Mock()
+        repository.complete.return_value = {
+            'RunningOn': 'i-1',
+            'EventName': 'joined',
+            'Results': { 'i-1': 'Success' }
+        }
+        self.model.repositories.set('command', repository)
+        try:
+            model = self.get_sync_command_model({ 'i-1': 'Success' })
+            model.transitions[0].get('triggers')[0].update({ 'stop_after_trigger': True })
+            LifecycleHandler(model)()
+        finally:
+            self.model.repositories.add('command', CommandRepository)
+
+        self.assertEqual('joined', model.state)
+        self.assertEqual({ 'i-1': 'Success' }, model.event.get_command_results())
+        self.assertIsNone(model.next_event)
+
+
+    def test_commands_are_not_polled_if_the_state_does_not_wait(self):
+        repository = mock.Mock()
+        self.model.repositories.set('command', repository)
+        try:
+            model = self.get_sync_command_model({ 'i-1': 'Success' })
+            model.transitions[0].update({ 'stop_after_state_change': False })
+            LifecycleHandler(model)()
+        finally:
+            self.model.repositories.add('command', CommandRepository)
+
+        model.clients.get('ssm').wait_for_command.assert_not_called()
+        repository.complete.assert_not_called()
+        self.assertEqual('joining', model.state)
+        self.assertTrue(model.event.is_scheduled())
+
+
+    def test_long_commands_wait_for_their_status_event(self):
+        repository = mock.Mock()
+        self.model.repositories.set('command', repository)
+        try:
+            model = self.get_sync_command_model(None)
+            LifecycleHandler(model)()
+        finally:
+            self.model.repositories.add('command', CommandRepository)
+
+        repository.complete.assert_not_called()
+        self.assertEqual('joining', model.state)
+        self.assertTrue(model.event.is_scheduled())
+
+
+    def test_commands_sent_in_chunks_are_registered_as_one_group(self):
+        table = StubCommandTable()
+        self.model.repositories.set('command', CommandRepository(table, mock.Mock()))
+        try:
+            self.model.initialize(get_event('scheduled_event.json'))
+            self.model.clients.get('ssm').dispatch_command.side_effect = lambda ids, *args, **callbacks: [
+                callbacks.get('on_dispatch')('command-1', ids[:2]),
+                callbacks.get('on_dispatch')('command-2', ids[2:])
+            ]
+            nodes = [Node('i-1'), Node('i-2'), Node('i-3')]
+            self.model._send_command('join', ['/bin/join.sh'], nodes, max_errors = '1')
+
+            groups = [item for item in table.items.values() if item.get('Group', None) is None]
+            self.assertEqual(1, len(groups))
+            self.assertEqual('i-1, i-2, i-3', groups[0].get('RunningOn'))
+            self.assertEqual({ 'command-1': 'i-1, i-2', 'command-2': 'i-3' }, groups[0].get('Chunks'))
+            self.assertEqual(groups[0].get('Ident'), table.items.get('command-2').get('Group'))
+
+            repository = self.model.get_command_repository()
+            self.assertIsNone(repository.complete('command-1', 'i-1', 'Failed'))
+            self.assertIsNone(repository.complete('command-2', 'i-3', 'Success'))
+            self.assertIsNotNone(repository.complete('command-1', 'i-2', 'Success'))
+        finally:
+            self.model.repositories.add('command', CommandRepository)
+
+
+    def test_nodes_without_online_agent_are_recorded_as_undeliverable(self):
+        table = StubCommandTable()
+        self.model.repositories.set('command', CommandRepository(table, mock.Mock()))
+        try:
+            self.model.initialize(get_event('scheduled_event.json'))
+            repository = self.model.get_command_repository()
+
+
+            def dispatch(ids, *args, on_dispatch, on_failure, **kwargs):
+                on_dispatch('command-1', ids[:1])
+                # the status event of the dispatched node arrives before the agent of the other one times out
+                self.assertIsNone(repository.complete('command-1', 'i-1', 'Success'))
+                on_failure(ids[1:])
+
+
+            self.model.clients.get('ssm').dispatch_command.side_effect = dispatch
+            self.model._send_command('join', ['/bin/join.sh'], [Node('i-1'), Node('i-2')], max_errors = '1')
+        finally:
+            self.model.repositories.add('command', CommandRepository)
+
+        self.assertEqual({ }, table.items)
+        self.assertEqual(
+            { 'i-1': 'Success', 'i-2': 'Undeliverable' },
+            self.model.next_event.get_command_results()
+        )
+        self.assertTrue(self.model.next_event.is_successful())
+
+
+    def test_agents_are_waited_for_until_the_deadline_of_the_invocation(self):
+        self.model.initialize(get_event('scheduled_event.json'), 60000)
+        self.model._send_command('join', ['/bin/join.sh'], [Node('i-1')])
+
+        self.assertEqual(
+            self.model.deadline,
+            self.model.clients.get('ssm').dispatch_command.call_args[1].get('deadline')
+        )
+
+
+    def test_undeliverable_commands_fail_if_the_state_does_not_wait(self):
+        table = StubCommandTable()
+        self.model.repositories.set('command', CommandRepository(table, mock.Mock()))
+        try:
+            model = self.get_sync_command_model(None)
+            model.clients.get('ssm').dispatch_command.side_effect = lambda ids, *args, **callbacks: (
+                callbacks.get('on_failure')(ids)
+            )
+            model.transitions[0].update({ 'stop_after_state_change': False })
+            model.transitions.append({
+                'source': 'failure',
+                'dest': 'failed',
+                'triggers': [{ 'name': 'fail', 'ignore_errors': True }],
+            })
+            LifecycleHandler(model)()
+        finally:
+            self.model.repositories.add('command', CommandRepository)
+
+        self.assertEqual({ }, table.items)
+        self.assertEqual({ 'i-1': 'Undeliverable' }, model.event.get_command_results())
+        self.assertEqual('failed', model.state)
+        self.assertIsNone(model.next_event)
+
+
+    def test_write_behind_flushes_before_sending_commands(self):
+        event = get_event('ssm_event.json')
+        self.model.write_behind = True
+        self.model.initialize(event)
+        node_repository = self.model.get_node_repository()
+        node_repository.update(self.model.node, { 'ItemStatus': 'joining' })
+        node_repository.client.client.update_item.assert_not_called()
+
+        self.model.clients.get('ssm').dispatch_command.side_effect = lambda *args, **kwargs: self.assertFalse(
+            self.model.node.has_pending_changes()
+        )
+        self.model._send_command('join', ['/bin/join_cluster.sh'])
+
+        self.model.clients.get('ssm').dispatch_command.assert_called_once()
+        node_repository.client.client.update_item.assert_called_once()
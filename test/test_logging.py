@@ -0,0 +1,36 @@
+import io
+import logging
+import unittest
+from unittest import mock
+
+from AutoscalingLifecycle.logging import Lazy
+from AutoscalingLifecycle.logging import Logging
+
+
+class TestLogging(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.logging = Logging('TEST', level = logging.INFO)
+        self.logging.add_handler(logging.StreamHandler(self.stream), '%(message)s')
+
+
+    def test_lazy_arguments_are_not_resolved_below_level(self):
+        func = mock.Mock(return_value = 'value')
+        self.logging.get_logger().debug('value: %s', Lazy(func, 'arg'))
+
+        func.assert_not_called()
+        self.assertEqual('', self.stream.getvalue())
+
+
+    def test_lazy_arguments_are_resolved_and_formatted_when_emitted(self):
+        self.logging.get_logger().info('value: %s, %s', Lazy(dict, [('a', 1)]), Lazy(repr, 'b'))
+
+        self.assertEqual('value: {"a": 1}, \'b\'\n', self.stream.getvalue())
+
+
+    def test_level_can_be_changed(self):
+        self.logging.set_level(logging.DEBUG)
+        self.logging.get_logger().debug('value: %s', Lazy(str, 1))
+
+        self.assertEqual('value: 1\n', self.stream.getvalue())
@@ -0,0 +1,127 @@
+import unittest
+from queue import Full
+from unittest import mock
+
+from AutoscalingLifecycle import LifecycleHandler
+from AutoscalingLifecycle import Model
+from AutoscalingLifecycle.clients import SnsClient
+from AutoscalingLifecycle.logging import Logging
+from AutoscalingLifecycle.notifications import NotificationQueue
+from test.test_lifecycle_handler import MockModel
+from test.test_lifecycle_handler import get_event
+
+
+class TestNotificationQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.sns = mock.Mock()
+        self.queue = NotificationQueue(self.sns, mock.Mock(), 10)
+
+
+    def test_reports_are_published_as_one_digest(self):
+        self.queue.put_report('INFO', 'Transitioning from a to b via t', 'detail 1')
+        self.queue.put_activity({ 'Description': 'Launching a new EC2 instance: i-1', 'Progress': 50 })
+        self.queue.put_report('ERROR', 'Transitioned from a to b via t', 'detail 2')
+        self.queue.put_activity({ 'Description': 'Launching a new EC2 instance: i-1', 'Progress': 100 })
+        self.queue.flush('event')
+
+        self.sns.publish_digest.assert_called_once()
+        title, reports, activities, dropped, region = self.sns.publish_digest.call_args[0]
+        self.assertEqual('event', title)
+        self.assertEqual(['detail 1', 'detail 2'], [report.get('detail') for report in reports])
+        self.assertEqual([100], [activity.get('Progress') for activity in activities])
+        self.assertEqual(0, dropped)
+        self.assertIsNone(self.queue.worker)
+
+
+    def test_flush_without_reports_does_not_publish(self):
+        self.queue.flush('event')
+
+        self.sns.publish_digest.assert_not_called()
+
+
+    def test_reports_are_dropped_if_the_queue_is_full(self):
+        self.queue.put_report('INFO', 'subject', 'detail')
+        with mock.patch.object(self.queue.queue, 'put_nowait', side_effect = Full):
+            self.queue.put_report('INFO', 'subject', 'dropped')
+            self.queue.put_report('INFO', 'subject', 'dropped')
+        self.queue.flush('event')
+
+        title, reports, activities, dropped, region = self.sns.publish_digest.call_args[0]
+        self.assertEqual(1, len(reports))
+        self.assertEqual(2, dropped)
+        self.assertEqual(0, self.queue.dropped)
+
+
+    def test_publish_errors_do_not_raise(self):
+        self.sns.publish_digest.side_effect = RuntimeError('throttled')
+        self.queue.put_report('INFO', 'subject', 'detail')
+        self.queue.flush('event')
+
+
+class TestSnsDigest(unittest.TestCase):
+
+    def test_digest_reports_errors(self):
+        client = mock.Mock()
+        sns = SnsClient(client, mock.Mock(), Logging('TEST'), client, 'arn', 'account', 'test')
+        sns.publish_digest('event', [{ 'status': 'INFO' }, { 'status': 'ERROR' }], [], 0, 'eu-west-1')
+
+        self.assertTrue(client.publish.call_args[1].get('Subject').startswith('TEST: ERROR : event in test'))
+
+
+class TestModelNotifications(unittest.TestCase):
+
+    def get_transitions(self):
+        return [
+            {
+                'source': 'backup',
+                'dest': 'backup_prepare',
+                'triggers': [{ 'name': 'trigger_1' }],
+            },
+            {
+                'source': 'backup_prepare',
+                'dest': 'backing_up',
+                'triggers': [{ 'name': 'trigger_2' }]
+            },
+        ]
+
+
+    def get_model(self) -> Model:
+        model = MockModel(mock.Mock(), mock.Mock(), Logging('TEST'), 'test', 'test')
+        model.initialize(get_event('scheduled_event.json'))
+        model.digest_notifications = True
+        model.transitions = self.get_transitions()
+
+        return model
+
+
+    def test_handler_publishes_one_digest(self):
+        model = self.get_model()
+        LifecycleHandler(model)()
+
+        sns = model.clients.get('sns')
+        sns.publish_activity.assert_not_called()
+        sns.publish_digest.assert_called_once()
+        self.assertEqual(4, len(sns.publish_digest.call_args[0][1]))
+
+
+    def test_handler_publishes_digest_on_errors(self):
+        model = self.get_model()
+        model.get_node_repository = mock.Mock(side_effect = RuntimeError('flush failed'))
+        model.node = mock.Mock()
+        model.node.is_new.return_value = False
+
+        with self.assertRaises(RuntimeError):
+            LifecycleHandler(model)()
+
+        model.clients.get('sns').publish_digest.assert_called_once()
+
+
+    def test_reports_are_published_immediately_without_digest(self):
+        model = self.get_model()
+        model.digest_notifications = False
+        LifecycleHandler(model)()
+
+        sns = model.clients.get('sns')
+        sns.publish_digest.assert_not_called()
+        self.assertEqual(4, sns.publish_activity.call_count)
@@ -0,0 +1,238 @@
+import logging
+import threading
+import time
+import tracemalloc
+import unittest
+from unittest import mock
+
+from botocore.exceptions import ClientError
+from botocore.exceptions import WaiterError
+
+from AutoscalingLifecycle.clients import CustomWaiters
+from AutoscalingLifecycle.logging import Logging
+from AutoscalingLifecycle.waiters import Acceptor
+from AutoscalingLifecycle.waiters import Backoff
+from AutoscalingLifecycle.waiters import Waiter
+from AutoscalingLifecycle.waiters import WaiterConfig
+from AutoscalingLifecycle.waiters import WaiterEngine
+from AutoscalingLifecycle.waiters import WaiterRegistry
+
+
+def get_agent_response(*statuses):
+    return { 'InstanceInformationList': [{ 'PingStatus': status } for status in statuses] }
+
+
+class TestCustomWaiters(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.Mock()
+        self.factory = mock.Mock()
+        self.factory.get.return_value = self.client
+        self.waiters = CustomWaiters(self.factory, Logging('TEST').get_logger())
+        self.backoffs = { }
+        for config in self.waiters.configs.values():
+            self.backoffs.update({ config.name: config.backoff })
+            config.backoff = Backoff(delay = 0.001, max_delay = 0.001)
+
+
+    def tearDown(self):
+        for config in self.waiters.configs.values():
+            config.backoff = self.backoffs.get(config.name)
+
+
+    def test_existing_waiter_names_are_available(self):
+        self.assertEqual(
+            [
+                'AgentIsOnline',
+                'AutoscalingComplete',
+                'ChangeInSync',
+                'InstancesInService',
+                'ScanCountGt0',
+                'ScanCountIs'
+            ],
+            sorted(self.waiters.get_waiter_names())
+        )
+        for name in self.waiters.get_waiter_names():
+            self.assertIsInstance(self.waiters.get(name), Waiter)
+
+
+    def test_agent_is_online_retries_until_online(self):
+        self.client.describe_instance_information.side_effect = [
+            get_agent_response(),
+            get_agent_response('ConnectionLost'),
+            get_agent_response('Online'),
+        ]
+        self.waiters.get('AgentIsOnline').wait(Filters = [])
+
+        self.assertEqual(3, self.client.describe_instance_information.call_count)
+
+
+    def test_agent_is_inactive_fails(self):
+        self.client.describe_instance_information.return_value = get_agent_response('Inactive')
+
+        with self.assertRaises(WaiterError):
+            self.waiters.get('AgentIsOnline').wait(Filters = [])
+
+
+    def test_autoscaling_complete_for(self):
+        activity = { 'Description': 'Launching a new EC2 instance: i-1', 'Progress': 50 }
+        self.client.describe_scaling_activities.side_effect = [
+            { 'Activities': [dict(activity)] },
+            { 'Activities': [dict(activity, Progress = 100)] },
+        ]
+        waiter = self.waiters.get_autoscaling_complete_for('i-1', True)
+
+        self.assertEqual(100, waiter.wait(AutoScalingGroupName = 'group').get('Activities')[0].get('Progress'))
+
+
+    def test_parameterized_waiters_share_one_registered_waiter(self):
+        self.client.scan.return_value = { 'Items': [{ }, { }] }
+        self.waiters.get_dynamodb_scan_count_is('2').wait(TableName = 'table')
+        self.waiters.get_autoscaling_complete_for('i-1', True)
+        self.waiters.get_autoscaling_complete_for('i-2', False)
+
+        self.assertEqual(['AutoscalingComplete', 'ScanCountIs'], sorted(self.waiters.waiters.keys()))
+        self.assertEqual(
+            { 'description': 'Terminating EC2 instance: i-2' },
+            self.waiters.get_autoscaling_complete_for('i-2', False).arguments
+        )
+
+
+    def test_autoscaling_complete_for_fails_without_activity(self):
+        self.client.describe_scaling_activities.return_value = { 'Activities': [] }
+
+        with self.assertRaises(WaiterError):
+            self.waiters.get_autoscaling_complete_for('i-1', False).wait(AutoScalingGroupName = 'group')
+
+
+    def test_unmatched_errors_fail(self):
+        self.client.scan.side_effect = ClientError({ 'Error': { 'Code': 'AccessDenied' } }, 'Scan')
+
+        with self.assertRaises(WaiterError) as context:
+            self.waiters.get('ScanCountGt0').wait(TableName = 'table')
+        self.assertIn('AccessDenied', str(context.exception))
+
+
+class TestWaiterRegistry(unittest.TestCase):
+
+    def test_least_recently_used_waiters_are_evicted(self):
+        registry = WaiterRegistry(2)
+        engine = WaiterEngine(mock.Mock())
+        for name in ['a', 'b']:
+            registry.add(Waiter(WaiterConfig(name, 'test', 'poll', [], Backoff()), mock.Mock(), engine))
+        registry.get('a')
+        registry.add(Waiter(WaiterConfig('c', 'test', 'poll', [], Backoff()), mock.Mock(), engine))
+
+        self.assertEqual(['a', 'c'], registry.keys())
+        self.assertIsNone(registry.get('b'))
+
+
+class StubAutoscaling(object):
+    """
+    Reports every activity as complete without recording calls.
+    """
+
+
+    def __init__(self):
+        self.description = ''
+
+
+    def describe_scaling_activities(self, **kwargs):
+        return { 'Activities': [{ 'Description': self.description, 'Progress': 100 }] }
+
+
+class TestWaiterMemory(unittest.TestCase):
+
+    def test_memory_stays_flat_for_many_instances(self):
+        logger = logging.getLogger('test.waiters.memory')
+        logger.setLevel(logging.WARNING)
+        client = StubAutoscaling()
+        factory = mock.Mock()
+        factory.get.return_value = client
+        waiters = CustomWaiters(factory, logger)
+
+
+        def process(start: int, count: int):
+            for index in range(start, start + count):
+                instance_id = 'i-%017x' % index
+                client.description = 'Launching a new EC2 instance: ' + instance_id
+                waiters.get_autoscaling_complete_for(instance_id, True).wait(AutoScalingGroupName = 'group')
+                waiters.get_dynamodb_scan_count_is(index)
+
+
+        process(0, 1000)
+        tracemalloc.start()
+        try:
+            before = tracemalloc.take_snapshot()
+            process(1000, 10000)
+            after = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+
+        growth = sum([stat.size_diff for stat in after.compare_to(before, 'filename')])
+        self.assertLess(growth, 64 * 1024)
+        self.assertEqual(2, len(waiters.waiters))
+
+
+class TestWaiterEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = WaiterEngine(mock.Mock())
+        self.polls = []
+
+
+    def get_waiter(self, name: str, succeed_after: int, timeout: float = 5) -> Waiter:
+        client = mock.Mock()
+        responses = iter(range(1, 1000))
+
+
+        def operation(**kwargs):
+            self.polls.append(name)
+            return { 'Attempt': next(responses) }
+
+
+        client.poll.side_effect = operation
+        config = WaiterConfig(name, 'test', 'poll', [
+            Acceptor(Acceptor.SUCCESS, lambda response, arguments: response['Attempt'] >= succeed_after),
+        ], Backoff(delay = 0.01, max_delay = 0.01, timeout = timeout, jitter = False))
+
+        return Waiter(config, client, self.engine)
+
+
+    def test_waits_are_multiplexed(self):
+        slow = self.get_waiter('slow', 3)
+        fast = self.get_waiter('fast', 2)
+        responses = self.engine.wait_all([(slow, { }), (fast, { })])
+
+        self.assertEqual([3, 2], [response.get('Attempt') for response in responses])
+        self.assertEqual(['slow', 'fast', 'slow', 'fast', 'slow'], self.polls)
+
+
+    def test_overall_deadline_ends_waits(self):
+        waiter = self.get_waiter('never', 1000)
+        self.engine.set_deadline(time.monotonic() + 0.05)
+        start = time.monotonic()
+
+        with self.assertRaises(WaiterError) as context:
+            waiter.wait()
+        self.assertIn('Deadline exceeded', str(context.exception))
+        self.assertLess(time.monotonic() - start, 1)
+
+
+    def test_deadline_applies_to_the_waits_of_the_calling_thread(self):
+        self.engine.set_deadline(time.monotonic() + 0.05)
+        deadlines = []
+        thread = threading.Thread(target = lambda: deadlines.append(self.engine.deadline))
+        thread.start()
+        thread.join()
+
+        self.assertEqual([None], deadlines)
+        self.assertIsNotNone(self.engine.deadline)
+
+
+    def test_backoff_timeout_ends_waits(self):
+        waiter = self.get_waiter('never', 1000, 0.05)
+
+        with self.assertRaises(WaiterError):
+            waiter.wait()
+        self.assertTrue(2 < len(self.polls) < 10)